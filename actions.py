@@ -4,12 +4,13 @@
 """
 Actions - user defined actions
 
+Each action returns the desired state of the devices it cares about.  The Valet works out which devices actually
+need a command and dispatches them as a batch.
+
 © Delaney & Morgan Computing 2019
 www.delaneymorgan.com.au
 """
 
-import time
-
 
 def do_arrivals(manifest):
     ACTIVE_ON_OCCUPIED = [
@@ -18,11 +19,8 @@ def do_arrivals(manifest):
         "office_stereo",
         "sub_woofer"
     ]
-    for name in ACTIVE_ON_OCCUPIED:
-        instance = manifest.instance(name)
-        if not instance.state():
-            instance.turn_on()
-    return
+    _ = manifest
+    return dict((name, True) for name in ACTIVE_ON_OCCUPIED)
 
 
 def do_departures(manifest):
@@ -33,11 +31,8 @@ def do_departures(manifest):
         "office_stereo",
         "sub_woofer"
     ]
-    for name in DEACTIVATE_ON_DEPARTURE:
-        instance = manifest.instance(name)
-        if instance.state():
-            instance.turn_off()
-    return
+    _ = manifest
+    return dict((name, False) for name in DEACTIVATE_ON_DEPARTURE)
 
 
-ACTIONS = {"do_arrivals": do_arrivals, "do_departures": do_departures}
+ACTIONS = {"do_arrival": do_arrivals, "start_departure": do_departures}
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Activity module - polls whether devices are on (active), as opposed to merely present
+
+Each device type has a query that asks the device (or its bridge) directly.  Devices whose states come back from
+one bulk request - every light on a Hue bridge, say - are queried together, once per bridge.  Devices whose states
+are being pushed (see events.py) are left out of the polls until their push source fails.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import random
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+from pollschedule import AdaptivePoll, intervals_for_types
+from sharedvar import SharedVarCollection
+
+
+DEFAULT_ACTIVITY_PERIOD = 15
+
+
+# =============================================================================
+
+
+class ActivityQuery(object):
+    """
+    Finds out whether devices are on.  Devices with the same group key are fetched together.
+    """
+
+    def group_key(self, name, instance):
+        return name
+
+    def fetch(self, members):
+        """
+        :param members: list of (device name, device instance) sharing a group key
+        :return: dictionary of device name -> active, leaving out any that couldn't be determined
+        """
+        raise NotImplementedError()
+
+
+class SamsungTvQuery(ActivityQuery):
+    """
+    asks the TV's REST API, on the same channel the device itself uses
+    """
+
+    def fetch(self, members):
+        return dict((name, instance.channel().power_state()) for name, instance in members
+                    if instance.channel() is not None)
+
+
+class WemoQuery(ActivityQuery):
+    """
+    GetBinaryState on each Wemo's own channel
+    """
+
+    def fetch(self, members):
+        return dict((name, instance.channel().binary_state()) for name, instance in members
+                    if instance.channel() is not None)
+
+
+class HueQuery(ActivityQuery):
+    """
+    one light list request per bridge, however many of its lights are wanted
+    """
+
+    def group_key(self, name, instance):
+        channel = instance.channel()
+        return channel if channel is not None else name
+
+    def fetch(self, members):
+        channel = members[0][1].channel()
+        if channel is None:
+            return {}
+        lights = channel.light_states()
+        return dict((name, lights[instance.address()]) for name, instance in members if instance.address() in lights)
+
+
+class FakeQuery(ActivityQuery):
+    """
+    Random answers for development without the devices
+    """
+
+    def __init__(self, rng=None):
+        self._rng = rng if rng is not None else random
+        return
+
+    def fetch(self, members):
+        return dict((name, self._rng.randint(0, 3) == 3) for name, _ in members)
+
+
+# queries to use for each manifest device type
+ACTIVITY_QUERIES = {
+    "samsungtv": SamsungTvQuery,
+    "wemo": WemoQuery,
+    "hue": HueQuery,
+}
+
+
+# =============================================================================
+
+
+class ActivityPoller(object):
+    """
+    Keeps the active store up to date.  Presents check/next_deadline, so it can share the surveyor's scheduler.
+    What it finds also goes into the state cache, so the devices' own state() (and the dispatcher) agree with the
+    judge.
+    """
+
+    def __init__(self, manifest, devices, notifier, polling_intervals=None, test=False, rng=None, max_workers=4,
+                 state_cache=None):
+        self._manifest = manifest
+        self._notifier = notifier
+        self._state_cache = state_cache
+        self._active = SharedVarCollection({})
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._queries = {}
+        self._fake_query = FakeQuery(rng) if test else None
+        self._poll = AdaptivePoll(self.poll_devices, "poll_activity", notifier)
+        self._make_interval = intervals_for_types(polling_intervals or {}, DEFAULT_ACTIVITY_PERIOD)
+        self._devices = []
+        self._covers = None
+        self._duration_metric = metrics.REGISTRY.histogram("activity_query_duration_seconds",
+                                                           "time taken by each activity query")
+        self.update_devices(devices)
+        return
+
+    def _query_for(self, device_type):
+        if self._fake_query is not None:
+            return self._fake_query
+        if device_type not in self._queries:
+            constructor = ACTIVITY_QUERIES.get(device_type)
+            self._queries[device_type] = constructor() if constructor is not None else None
+        return self._queries[device_type]
+
+    def update_devices(self, devices):
+        for name in devices:
+            if name not in self._devices:
+                self._poll.add(name, self._make_interval(self._manifest.type(name).lower()))
+        dropped = [name for name in self._devices if name not in devices]
+        for name in dropped:
+            self._poll.remove(name)
+        # the store keeps a slot per name, so a dropped device is marked inactive rather than left as last seen
+        self._active.set_many(dict((name, False) for name in dropped))
+        self._devices = list(devices)
+        return
+
+    def _fetch(self, query, members):
+        try:
+            with self._duration_metric.time():
+                return query.fetch(members)
+        except Exception as e:
+            self._notifier.warning("can't get activity of %s: %s", [name for name, _ in members], str(e))
+            return {}
+
+    def set_push(self, covers):
+        """
+        :param covers: function telling whether a device's state is currently being pushed, so needn't be polled
+        """
+        self._covers = covers
+        return
+
+    def push(self, name, active):
+        """
+        a device's state, as pushed by the device itself - safe to call from any thread
+        """
+        if name in self._devices:
+            self._active.set(name, active)
+        return
+
+    def poll_devices(self, names):
+        """
+        :return: dictionary of name -> (active, changed)
+        """
+        groups = {}
+        pushed = []
+        for name in names:
+            if self._covers is not None and self._covers(name):
+                pushed.append(name)
+                continue
+            query = self._query_for(self._manifest.type(name).lower())
+            if query is None:
+                continue
+            try:
+                instance = self._manifest.instance(name)
+            except KeyError:
+                self._notifier.warning("%s must be managed to poll its activity", name)
+                continue
+            groups.setdefault((query, query.group_key(name, instance)), []).append((name, instance))
+        futures = [self._pool.submit(self._fetch, query, members) for (query, _), members in groups.items()]
+        wait(futures)
+        results = {}
+        for future in futures:
+            results.update(future.result())
+        previous = self._active.snapshot()
+        self._active.set_many(results)
+        if self._state_cache is not None:
+            for name, active in results.items():
+                self._state_cache.put(name, active)
+        outcomes = dict((name, (active, previous.get(name) != active)) for name, active in results.items())
+        # unchanged as far as polling is concerned, so pushed devices back off to their longest interval
+        outcomes.update((name, (bool(previous.get(name)), False)) for name in pushed)
+        return outcomes
+
+    def add_listener(self, listener):
+        """
+        :param listener: called (from the polling thread) whenever a device's activity changes
+        """
+        self._active.subscribe(lambda version, changed: listener())
+        return
+
+    def active(self):
+        return self._active.snapshot()
+
+    def active_changes(self, since_version):
+        return self._active.changes_since(since_version)
+
+    def export(self):
+        return dict(self._active.snapshot())
+
+    def restore(self, saved, age):
+        self._active.set_many(dict((name, bool(active)) for name, active in saved.items() if name in self._devices))
+        return
+
+    def next_deadline(self):
+        return self._poll.next_deadline()
+
+    def check(self):
+        return self._poll.check()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Activity start")
+    import time
+    from fakebridge import FakeHueBridge, FAKE_USERNAME
+    from channels import PhilipsHueChannel
+
+    class FakeNotifier(object):
+        def warning(self, template, *args):
+            print("Warning: " + (template % args))
+            return
+
+        def diagnostic(self, template, *args):
+            return
+
+    class FakeLight(object):
+        def __init__(self, light_id, channel):
+            self.light_id = light_id
+            self.bridge = channel
+            return
+
+        def address(self):
+            return self.light_id
+
+        def channel(self):
+            return self.bridge
+
+    class FakeManifest(object):
+        def __init__(self, lights):
+            self.lights = lights
+            return
+
+        def type(self, name):
+            return "hue"
+
+        def instance(self, name):
+            return self.lights[name]
+
+    bridge = FakeHueBridge(num_lights=20).start()
+    hue = PhilipsHueChannel("hue", bridge.host, FAKE_USERNAME, port=bridge.port)
+    the_lights = dict(("light%d" % idx, FakeLight(str(idx), hue)) for idx in range(1, 21))
+    hue.set_light("3", True)
+    poller = ActivityPoller(FakeManifest(the_lights), sorted(the_lights), FakeNotifier())
+    requests = bridge.state.requests
+    start = time.time()
+    the_results = poller.poll_devices(sorted(the_lights))
+    print("activity of %d lights in %d bridge request(s), %4.3f sec: %s active" % (
+        len(the_results), bridge.state.requests - requests, time.time() - start,
+        [name for name, (active, _) in sorted(the_results.items()) if active]))
+    poller.shutdown()
+    bridge.stop()
+    print("Activity end")
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Channels module - shared, rate-limited connections to bridges and hubs
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import http.client
+import json
+import queue
+import threading
+import time
+
+
+# Hue bridges start dropping commands beyond roughly this many per second
+HUE_COMMANDS_PER_SECOND = 10.0
+
+WEMO_BASIC_EVENT = "urn:Belkin:service:basicevent:1"
+WEMO_PORT = 49153
+
+# Samsung (Tizen) TVs answer their REST API on this port, including in standby
+SAMSUNG_REST_PORT = 8001
+
+
+# =============================================================================
+
+
+class RateLimiter(object):
+    """
+    token bucket - acquire blocks until a token is available
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._clock = clock
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+        return
+
+    def acquire(self, tokens=1.0):
+        while True:
+            with self._lock:
+                time_now = self._clock()
+                self._tokens = min(self.burst, self._tokens + ((time_now - self._last) * self.rate))
+                self._last = time_now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# =============================================================================
+
+
+class Channel(object):
+    """
+    A route to one or more devices.  Devices send their commands through their channel rather than opening their
+    own connections.
+    """
+
+    max_concurrency = 1
+
+    def __init__(self, name):
+        self._name = name
+        return
+
+    def name(self):
+        return self._name
+
+    def authenticate(self):
+        raise NotImplementedError()
+
+    def apply_batch(self, commands):
+        for this_command in commands:
+            this_command.apply()
+        return
+
+
+# =============================================================================
+
+
+class HttpChannel(Channel):
+    """
+    Keeps a small pool of persistent (keep-alive) HTTP connections to one host, shared by every device on it
+    """
+
+    def __init__(self, name, host, port=80, max_concurrency=2, rate=None, timeout=5.0):
+        super(HttpChannel, self).__init__(name)
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.requests = 0
+        self._limiter = RateLimiter(rate) if rate else None
+        self._connections = queue.LifoQueue()
+        for _ in range(max_concurrency):
+            self._connections.put(None)
+        return
+
+    def _connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        :return: (status, response body)
+        """
+        if self._limiter is not None:
+            self._limiter.acquire()
+        connection = self._connections.get()
+        try:
+            if connection is None:
+                connection = self._connect()
+            # a kept-alive connection may have been dropped by the far end, so retry once on a fresh one
+            for attempt in range(2):
+                try:
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                    data = response.read()
+                    self.requests += 1
+                    return response.status, data
+                except (http.client.HTTPException, IOError, OSError):
+                    connection.close()
+                    if attempt:
+                        raise
+        finally:
+            self._connections.put(connection)
+
+    def request_json(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        status, data = self.request(method, path, body, {"Content-Type": "application/json"})
+        if status >= 400:
+            raise IOError("%s %s: HTTP %d" % (method, path, status))
+        return json.loads(data.decode("utf-8")) if data else None
+
+    def close(self):
+        while True:
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                break
+            if connection is not None:
+                connection.close()
+        return
+
+
+# =============================================================================
+
+
+class PhilipsHueChannel(HttpChannel):
+    """
+    One authenticated session with a Hue bridge (v1 API).  Batches of lights are switched through a scratch group
+    in two requests, however many lights are involved.  The group is found by name on the bridge, so each run (and
+    each channel) reuses the one group rather than adding another until the bridge runs out.
+    """
+
+    SCRATCH_GROUP_NAME = "homer"
+
+    def __init__(self, name, host, username=None, port=80):
+        super(PhilipsHueChannel, self).__init__(name, host, port, max_concurrency=1, rate=HUE_COMMANDS_PER_SECOND)
+        self._username = username
+        self._scratch_group = None
+        self._lock = threading.Lock()
+        return
+
+    def authenticate(self):
+        if self._username:
+            return self._username
+        reply = self.request_json("POST", "/api", {"devicetype": "homer#%s" % self._name})
+        for item in reply:
+            if "success" in item:
+                self._username = item["success"]["username"]
+                return self._username
+        raise IOError("%s: bridge refused to authenticate: %s" % (self._name, reply))
+
+    def _path(self, suffix):
+        with self._lock:
+            if not self._username:
+                self.authenticate()
+        return "/api/%s/%s" % (self._username, suffix)
+
+    def set_light(self, light_id, state):
+        self.request_json("PUT", self._path("lights/%s/state" % light_id), {"on": bool(state)})
+        return
+
+    def light_states(self):
+        """
+        :return: dictionary of light id -> on, for every light on the bridge, in one request
+        """
+        lights = self.request_json("GET", self._path("lights"))
+        return dict((light_id, bool(info.get("state", {}).get("on"))) for light_id, info in lights.items())
+
+    def _find_group(self):
+        """
+        :return: id of the bridge's scratch group, or None if it hasn't one
+        """
+        groups = self.request_json("GET", self._path("groups"))
+        for group_id, info in sorted(groups.items()):
+            if info.get("name") == self.SCRATCH_GROUP_NAME:
+                return group_id
+        return None
+
+    def _group(self, light_ids):
+        if self._scratch_group is None:
+            self._scratch_group = self._find_group()
+        if self._scratch_group is not None:
+            try:
+                reply = self.request_json("PUT", self._path("groups/%s" % self._scratch_group), {"lights": light_ids})
+            except IOError:
+                reply = None
+            if reply and all("success" in item for item in reply):
+                return self._scratch_group
+            # deleted from the bridge since
+            self._scratch_group = None
+        reply = self.request_json("POST", self._path("groups"),
+                                  {"name": self.SCRATCH_GROUP_NAME, "type": "LightGroup", "lights": light_ids})
+        self._scratch_group = reply[0]["success"]["id"]
+        return self._scratch_group
+
+    def apply_batch(self, commands):
+        by_state = {}
+        for this_command in commands:
+            by_state.setdefault(bool(this_command.state), []).append(this_command.instance.address())
+        for state, light_ids in by_state.items():
+            if len(light_ids) > 2:
+                group = self._group(sorted(light_ids))
+                self.request_json("PUT", self._path("groups/%s/action" % group), {"on": state})
+            else:
+                for light_id in light_ids:
+                    self.set_light(light_id, state)
+        return
+
+
+# =============================================================================
+
+
+class WemoChannel(HttpChannel):
+    """
+    Persistent connection to a single Wemo device's UPnP basicevent service
+    """
+
+    def __init__(self, name, host, port=WEMO_PORT):
+        super(WemoChannel, self).__init__(name, host, port, max_concurrency=1)
+        return
+
+    def authenticate(self):
+        return None
+
+    def _soap(self, action, arguments):
+        body = ('<?xml version="1.0" encoding="utf-8"?>'
+                '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+                's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+                '<u:%s xmlns:u="%s">%s</u:%s></s:Body></s:Envelope>') % (action, WEMO_BASIC_EVENT, arguments, action)
+        headers = {"Content-Type": 'text/xml; charset="utf-8"',
+                   "SOAPACTION": '"%s#%s"' % (WEMO_BASIC_EVENT, action)}
+        status, data = self.request("POST", "/upnp/control/basicevent1", body, headers)
+        if status >= 400:
+            raise IOError("%s %s: HTTP %d" % (self._name, action, status))
+        return data.decode("utf-8")
+
+    def set_binary_state(self, state):
+        self._soap("SetBinaryState", "<BinaryState>%d</BinaryState>" % (1 if state else 0))
+        return
+
+    def binary_state(self):
+        reply = self._soap("GetBinaryState", "")
+        start = reply.find("<BinaryState>") + len("<BinaryState>")
+        return reply[start:reply.find("</BinaryState>")].strip().startswith("1")
+
+
+# =============================================================================
+
+
+class SamsungTvChannel(HttpChannel):
+    """
+    A Samsung TV's REST API - only used to ask whether the TV is on
+    """
+
+    def __init__(self, name, host, port=SAMSUNG_REST_PORT):
+        super(SamsungTvChannel, self).__init__(name, host, port, max_concurrency=1, timeout=2.0)
+        return
+
+    def authenticate(self):
+        return None
+
+    def power_state(self):
+        """
+        :return: True if the TV is on - a TV that doesn't answer at all is taken to be off
+        """
+        try:
+            reply = self.request_json("GET", "/api/v2/")
+        except (http.client.HTTPException, IOError, OSError, ValueError):
+            return False
+        # older models don't report PowerState, but only answer at all when on
+        return reply.get("device", {}).get("PowerState", "on") == "on"
+
+
+# =============================================================================
+
+
+CHANNEL_CLASSES = {"PhilipsHueChannel": PhilipsHueChannel, "WemoChannel": WemoChannel,
+                   "SamsungTvChannel": SamsungTvChannel}
+
+
+def make_channels(settings):
+    """
+    :param settings: dictionary of channel name -> dict(type=, address=, plus any extra constructor arguments)
+    :return: dictionary of channel name -> channel
+    """
+    channels = {}
+    for name, this_setting in settings.items():
+        arguments = dict(this_setting)
+        constructor = CHANNEL_CLASSES[arguments.pop("type")]
+        channels[name] = constructor(name, arguments.pop("address"), **arguments)
+    return channels
@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Cluster module - several surveying nodes, one judging coordinator
+
+On a site too big for one Pi (several VLANs or buildings), each node surveys a shard of the monitored devices -
+those in its rooms, or on its subnets - and streams roll call deltas (only the devices that changed) to the
+coordinator over TCP, as newline separated compact JSON.  The coordinator keeps the combined roll call for the
+judge.  Both ends send heartbeats; a node that goes quiet is dropped and its shards handed to the nodes still
+alive, which report their new devices in full.  Nodes must present the cluster's shared token to join.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import hmac
+import json
+import socket
+import struct
+import threading
+import time
+
+import metrics
+from history import PresenceHistory
+from periodic import Periodic, Scheduler
+from sharedvar import SharedVarCollection
+
+
+# seconds between heartbeats, and how many may be missed before the other end counts as gone
+HEARTBEAT_PERIOD = 2.0
+HEARTBEAT_MISSES = 3
+
+# seconds a node waits before reconnecting to the coordinator
+RECONNECT_PERIOD = 5.0
+
+# seconds the coordinator lets a send to a node block before giving up on the node
+SEND_TIMEOUT = HEARTBEAT_PERIOD
+
+
+# =============================================================================
+
+
+def encode(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def shard_key(manifest, name, shard_by="room"):
+    """
+    :param shard_by: "room", or "subnet" - devices without a room fall back to their /24 subnet
+    :return: the shard the device belongs to
+    """
+    if shard_by == "room" and manifest.room(name) is not None:
+        return manifest.room(name)
+    address = manifest.address(name)
+    return address.rpartition(".")[0] + ".0/24" if address.count(".") == 3 else address
+
+
+class Connection(object):
+    """
+    one end of a node <-> coordinator link - sends from any thread, receives on one
+    """
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._reader = sock.makefile("rb")
+        self._lock = threading.Lock()
+        return
+
+    def send(self, message):
+        """
+        :return: False if the link has failed
+        """
+        try:
+            with self._lock:
+                self._socket.sendall(encode(message))
+        except (IOError, OSError):
+            # part of a message may have gone, so the link is no use any more - ending it wakes the receiving end
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+            return False
+        return True
+
+    def receive(self):
+        """
+        :return: the next message, or None once the link is closed (or silent for too long)
+        """
+        try:
+            line = self._reader.readline()
+            return json.loads(line.decode("utf-8")) if line else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self._socket.close()
+        return
+
+
+# =============================================================================
+
+
+class NodeRecord(object):
+    def __init__(self, name, connection, prefers, time_now):
+        self.name = name
+        self.connection = connection
+        self.prefers = set(prefers)
+        self.last_heard = time_now
+        self.devices = []
+        return
+
+
+class Coordinator(threading.Thread):
+    """
+    Stands in for the surveyor, as far as the judge is concerned, with the roll call assembled from the nodes' deltas.
+
+    All node and shard bookkeeping happens on the coordinator's own thread; the network threads only queue work for it.
+    """
+
+    def __init__(self, port, manifest, monitored_devices, notifier, token, shard_by="room", address="127.0.0.1",
+                 clock=time.monotonic):
+        """
+        :param token: shared secret every node must send in its hello
+        :param address: interface to listen on - only this host's, by default
+        """
+        super(Coordinator, self).__init__()
+        self.daemon = True
+        self._manifest = manifest
+        self._monitored_devices = list(monitored_devices)
+        self._notifier = notifier
+        self._token = token.encode("utf-8")
+        self._shard_by = shard_by
+        self._clock = clock
+        self._roll_call = SharedVarCollection({})
+        # the nodes have already debounced their probe results, so any change reported is a change
+        self._history = PresenceHistory(1, 1, 1, clock)
+        self._nodes = {}
+        self._owners = {}
+        self._scheduler = Scheduler(notifier=notifier)
+        self._scheduler.add(Periodic(HEARTBEAT_PERIOD, self._heartbeat, "heartbeat", notifier))
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((address, port))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        self._nodes_metric = metrics.REGISTRY.gauge("cluster_nodes", "surveying nodes connected")
+        self._deltas_metric = metrics.REGISTRY.counter("cluster_deltas_total", "roll call deltas received")
+        self._reassignments_metric = metrics.REGISTRY.counter("cluster_reassignments_total",
+                                                              "shards moved from one node to another")
+        return
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except (IOError, OSError):
+                break  # closed by stop
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # no read timeout - _heartbeat drops nodes that go quiet, closing their connections - but a node that
+            # stops reading mustn't be able to block the coordinator's thread in a send
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                            struct.pack("ll", int(SEND_TIMEOUT), int(SEND_TIMEOUT % 1 * 1000000)))
+            reader = threading.Thread(target=self._serve, args=(Connection(sock),), name="cluster_node")
+            reader.daemon = True
+            reader.start()
+        return
+
+    def _serve(self, connection):
+        hello = connection.receive()
+        if hello is None or hello.get("t") != "hello" or not hello.get("node"):
+            connection.close()
+            return
+        if not hmac.compare_digest(str(hello.get("token", "")).encode("utf-8"), self._token):
+            self._notifier.warning("node %s rejected: wrong token", hello["node"])
+            connection.close()
+            return
+        name = hello["node"]
+        self._scheduler.call_soon(lambda: self._join(name, connection, hello.get("prefers", [])))
+        while True:
+            message = connection.receive()
+            if message is None:
+                break
+            if message.get("t") == "delta":
+                self._scheduler.call_soon(lambda states=message.get("states", {}):
+                                          self._apply(name, connection, states))
+            elif message.get("t") == "hb":
+                self._scheduler.call_soon(lambda: self._heard(name, connection))
+        self._scheduler.call_soon(lambda: self._leave(name, connection, "disconnected"))
+        return
+
+    def _join(self, name, connection, prefers):
+        previous = self._nodes.get(name)
+        if previous is not None:
+            # a restarted node - its old link is finished with
+            previous.connection.close()
+        self._nodes[name] = NodeRecord(name, connection, prefers, self._clock())
+        self._nodes_metric.set(len(self._nodes))
+        self._notifier.note("node %s joined", name)
+        self._rebalance()
+        return
+
+    def _leave(self, name, connection, reason):
+        node = self._nodes.get(name)
+        if node is None or node.connection is not connection:
+            return
+        del self._nodes[name]
+        connection.close()
+        self._nodes_metric.set(len(self._nodes))
+        self._notifier.warning("node %s %s, reassigning its %d devices", name, reason, len(node.devices))
+        self._rebalance()
+        return
+
+    def _heard(self, name, connection):
+        node = self._nodes.get(name)
+        if node is not None and node.connection is connection:
+            node.last_heard = self._clock()
+        return
+
+    def _apply(self, name, connection, states):
+        node = self._nodes.get(name)
+        if node is None or node.connection is not connection:
+            return
+        node.last_heard = self._clock()
+        # a node may still be reporting devices that have since been moved to another
+        states = dict((device, bool(state)) for device, state in states.items() if self._owners.get(device) == name)
+        self._deltas_metric.inc()
+        self._history.record(states)
+        self._roll_call.set_many(states)
+        return
+
+    def _heartbeat(self):
+        time_now = self._clock()
+        for node in list(self._nodes.values()):
+            if time_now - node.last_heard > HEARTBEAT_PERIOD * HEARTBEAT_MISSES:
+                self._leave(node.name, node.connection, "stopped responding")
+            else:
+                node.connection.send({"t": "hb"})
+        return
+
+    def _rebalance(self):
+        """
+        keep shards where they are if their node is still alive, still the right place for them and not carrying more
+        than its share, and give the rest to whichever node prefers them, else to the least loaded node
+        """
+        shards = {}
+        for name in self._monitored_devices:
+            shards.setdefault(shard_key(self._manifest, name, self._shard_by), []).append(name)
+        load = dict((name, 0) for name in self._nodes)
+        fair_share = -(-len(self._monitored_devices) // max(1, len(self._nodes)))
+        assignments = {}
+        orphans = []
+        for key in sorted(shards):
+            owner = self._owners.get(shards[key][0])
+            preferring = [name for name, node in self._nodes.items() if key in node.prefers]
+            if owner in self._nodes and (owner in preferring or
+                                         (not preferring and load[owner] + len(shards[key]) <= fair_share)):
+                assignments[key] = owner
+                load[owner] += len(shards[key])
+            else:
+                orphans.append(key)
+        for key in orphans:
+            preferring = [name for name, node in self._nodes.items() if key in node.prefers]
+            candidates = sorted(preferring or self._nodes, key=lambda name: (load[name], name))
+            if not candidates:
+                continue
+            assignments[key] = candidates[0]
+            load[candidates[0]] += len(shards[key])
+        owners = {}
+        for key, node_name in assignments.items():
+            for name in shards[key]:
+                owners[name] = node_name
+        moved = [name for name in owners if name in self._owners and self._owners[name] != owners[name]]
+        self._reassignments_metric.inc(len(moved))
+        unowned = [name for name in self._monitored_devices if name not in owners]
+        if unowned:
+            self._notifier.warning("no node to survey %d devices, counting them absent", len(unowned))
+            # rather than leave them as they were last reported, with nothing to say otherwise
+            self._roll_call.set_many(self._history.record(dict((name, False) for name in unowned)))
+        self._owners = owners
+        for node in self._nodes.values():
+            devices = sorted(name for name, node_name in owners.items() if node_name == node.name)
+            if devices != node.devices:
+                node.devices = devices
+                node.connection.send({"t": "shard", "devices": devices})
+        for name in list(self._roll_call.snapshot()):
+            if name not in self._monitored_devices:
+                self._history.remove(name)
+        return
+
+    def shards(self):
+        """
+        :return: dictionary of node name -> devices it surveys
+        """
+        return dict((node.name, list(node.devices)) for node in list(self._nodes.values()))
+
+    # the surveyor's interface, for the judge, reloader and main
+
+    def add_listener(self, listener):
+        """
+        :param listener: called (from the coordinator thread) whenever the roll call changes
+        """
+        self._roll_call.subscribe(lambda version, changed: listener())
+        return
+
+    def update_devices(self, monitored_devices):
+        def update():
+            self._monitored_devices = list(monitored_devices)
+            self._rebalance()
+            return
+        self._scheduler.call_soon(update)
+        return
+
+    def add_poll(self, poll):
+        self._scheduler.add(poll)
+        return
+
+    def call_soon(self, task):
+        self._scheduler.call_soon(task)
+        return
+
+    def report(self, name, found):
+        def record():
+            if name in self._monitored_devices:
+                self._roll_call.set_many(self._history.record({name: found}))
+            return
+        self._scheduler.call_soon(record)
+        return
+
+    def roll_call(self):
+        return self._roll_call.snapshot()
+
+    def roll_call_changes(self, since_version):
+        return self._roll_call.changes_since(since_version)
+
+    def history(self):
+        return self._history
+
+    def export(self):
+        return dict(roll_call=dict(self._roll_call.snapshot()), history=self._history.export())
+
+    def restore(self, saved, age):
+        self._history.restore(saved["history"])
+        self._roll_call.set_many(dict((name, bool(state)) for name, state in saved["roll_call"].items()
+                                      if name in self._monitored_devices))
+        return
+
+    def run(self):
+        acceptor = threading.Thread(target=self._accept, name="cluster_accept")
+        acceptor.daemon = True
+        acceptor.start()
+        self._scheduler.run()
+        return
+
+    def stop(self):
+        self._scheduler.stop()
+        if self.is_alive():
+            self.join()
+        # after the scheduler, so the closed links aren't taken for nodes leaving
+        self._server.close()
+        for node in list(self._nodes.values()):
+            node.connection.close()
+        return
+
+
+# =============================================================================
+
+
+class ShardClient(threading.Thread):
+    """
+    The node's end: surveys whatever the coordinator assigns, and streams back what changes.
+    """
+
+    def __init__(self, node_name, host, port, surveyor, notifier, token, prefers=()):
+        """
+        :param surveyor: anything with update_devices, add_listener and roll_call_changes
+        :param token: the cluster's shared secret
+        :param prefers: shards (rooms or subnets) this node is best placed to survey
+        """
+        super(ShardClient, self).__init__()
+        self.daemon = True
+        self._node_name = node_name
+        self._address = (host, port)
+        self._surveyor = surveyor
+        self._notifier = notifier
+        self._token = token
+        self._prefers = list(prefers)
+        self._connection = None
+        self._devices = []
+        self._version = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        surveyor.add_listener(self._send_changes)
+        return
+
+    def _send_changes(self, full=False):
+        """
+        send the devices in our shard whose states changed - or all of them, on (re)connecting or a new shard
+        """
+        with self._lock:
+            connection = self._connection
+            if connection is None:
+                return
+            roll_call, changed = self._surveyor.roll_call_changes(None if full else self._version)
+            self._version = roll_call.version
+            names = self._devices if changed is None else [name for name in self._devices if name in changed]
+            states = dict((name, 1 if roll_call[name] else 0) for name in names if name in roll_call)
+        if states:
+            connection.send({"t": "delta", "states": states})
+        return
+
+    def _heartbeats(self, connection):
+        while not self._stopping.wait(HEARTBEAT_PERIOD):
+            if not connection.send({"t": "hb"}):
+                break
+        return
+
+    def _session(self):
+        sock = socket.create_connection(self._address, timeout=HEARTBEAT_PERIOD * HEARTBEAT_MISSES)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(sock)
+        try:
+            if not connection.send({"t": "hello", "node": self._node_name, "token": self._token,
+                                    "prefers": self._prefers}):
+                return
+            with self._lock:
+                self._connection = connection
+            self._notifier.note("connected to coordinator %s:%d", *self._address)
+            heartbeats = threading.Thread(target=self._heartbeats, args=(connection,), name="cluster_heartbeat")
+            heartbeats.daemon = True
+            heartbeats.start()
+            while not self._stopping.is_set():
+                message = connection.receive()
+                if message is None:
+                    break
+                if message.get("t") == "shard":
+                    devices = list(message.get("devices", []))
+                    self._notifier.note("surveying %s", devices)
+                    with self._lock:
+                        self._devices = devices
+                    self._surveyor.update_devices(devices)
+                    self._send_changes(full=True)
+        finally:
+            with self._lock:
+                self._connection = None
+            connection.close()
+        return
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self._session()
+                self._notifier.warning("lost coordinator %s:%d", *self._address)
+            except (IOError, OSError) as e:
+                self._notifier.warning("can't reach coordinator %s:%d: %s", self._address[0], self._address[1],
+                                       str(e))
+            # keep surveying the current shard meanwhile - the coordinator may only have restarted
+            self._stopping.wait(RECONNECT_PERIOD)
+        return
+
+    def stop(self):
+        self._stopping.set()
+        with self._lock:
+            connection = self._connection
+        if connection is not None:
+            connection.close()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Cluster start")
+    import multiprocessing
+    import os
+    import signal
+
+    NUM_NODES = 3
+    TOKEN = "demo"
+    ROOMS = ["lounge", "bedroom", "office", "garage", "library", "laundry"]
+
+    class FakeNotifier(object):
+        def __init__(self, prefix):
+            self.prefix = prefix
+            return
+
+        def note(self, template, *args):
+            return
+
+        def warning(self, template, *args):
+            print("%s: %s" % (self.prefix, template % args))
+            return
+
+        def diagnostic(self, template, *args):
+            return
+
+    class FakeManifest(object):
+        def room(self, name):
+            return name.partition("_")[0]
+
+        def address(self, name):
+            return "192.168.1.%d" % (sum(ord(ch) for ch in name) % 250)
+
+    class FakeSurveyor(object):
+        """
+        finds every device it's given, straight away
+        """
+
+        def __init__(self):
+            self.roll_call = SharedVarCollection({})
+            return
+
+        def update_devices(self, devices):
+            self.roll_call.set_many(dict((name, True) for name in devices))
+            return
+
+        def add_listener(self, listener):
+            self.roll_call.subscribe(lambda version, changed: listener())
+            return
+
+        def roll_call_changes(self, since_version):
+            return self.roll_call.changes_since(since_version)
+
+    def run_node(node_name, port):
+        client = ShardClient(node_name, "127.0.0.1", port, FakeSurveyor(), FakeNotifier(node_name), TOKEN)
+        client.start()
+        client.join()
+        return
+
+    def wait_for(condition, timeout=15.0):
+        start = time.time()
+        while not condition() and time.time() - start < timeout:
+            time.sleep(0.05)
+        return time.time() - start
+
+    the_devices = ["%s_device%d" % (room, idx) for room in ROOMS for idx in range(20)]
+    coordinator = Coordinator(0, FakeManifest(), the_devices, FakeNotifier("coordinator"), TOKEN)
+    coordinator.start()
+    nodes = [multiprocessing.Process(target=run_node, args=("node%d" % idx, coordinator.port))
+             for idx in range(NUM_NODES)]
+    for node_process in nodes:
+        node_process.start()
+    elapsed = wait_for(lambda: sum(coordinator.roll_call().values()) == len(the_devices))
+    print("%d nodes surveying %s, all %d devices reported in %4.2f sec" % (
+        NUM_NODES, dict((name, len(devices)) for name, devices in sorted(coordinator.shards().items())),
+        len(the_devices), elapsed))
+    # stop a node without it closing its connection, so only the heartbeats can tell
+    os.kill(nodes[0].pid, signal.SIGSTOP)
+    elapsed = wait_for(lambda: "node0" not in coordinator.shards())
+    print("node0 frozen, shards reassigned after %4.2f sec: %s" % (
+        elapsed, dict((name, len(devices)) for name, devices in sorted(coordinator.shards().items()))))
+    coordinator.stop()
+    for node_process in nodes:
+        node_process.kill()
+        node_process.join()
+    print("Cluster end")
@@ -3,13 +3,20 @@ Homer Configuration Parser
 
 Loads configuration from config.ini and produces a configuration dictionary.
 
+The parsed result is cached in a JSON sidecar next to the .ini file, keyed by the file's mtime and size, so
+repeated startups skip parsing.
+
 © Delaney & Morgan Computing 2019
 www.delaneymorgan.com.au
 """
 
 
+import ast
 import configparser
+import copy
 import json
+import os
+import time
 from enum import Enum
 
 
@@ -21,35 +28,125 @@ class Sections(Enum):
     DEVICES = 1
 
 
-# Defines the various required configuration members and their types.
-GENERAL_MEMBERS = {'rules_filename': 'string'}
-DEVICES_MEMBERS = {'monitored_devices': 'list', 'managed_devices': 'list', 'rooms': 'list'}
+# Defines the various configuration members and their types - all required, bar those in MEMBER_DEFAULTS.
+GENERAL_MEMBERS = {'rules_filename': 'string', 'manifest_filename': 'string', 'max_probes_in_flight': 'integer',
+                   'probe_timeout': 'float', 'probe_processes': 'integer', 'state_ttl': 'float',
+                   'state_refresh': 'float', 'history_length': 'integer', 'absent_misses': 'integer',
+                   'absent_window': 'integer',
+                   'metrics_port': 'integer', 'metrics_filename': 'string', 'snapshot_filename': 'string',
+                   'snapshot_period': 'float', 'snapshot_max_age': 'float', 'event_port': 'integer',
+                   'event_address': 'string', 'shard_by': 'string', 'cluster_address': 'string',
+                   'cluster_token': 'string', 'state_filename': 'string'}
+DEVICES_MEMBERS = {'monitored_devices': 'list', 'managed_devices': 'list', 'active_devices': 'list', 'rooms': 'list',
+                   'polling_intervals': 'dict', 'channels': 'dict'}
+
+# Members added since the first release are optional tuning, so an older config.ini still loads - these are their
+# values when left out.
+MEMBER_DEFAULTS = {
+    Sections.GENERAL.name: {'max_probes_in_flight': 16, 'probe_timeout': 2.0, 'probe_processes': 0, 'state_ttl': 30.0,
+                            'state_refresh': 10.0, 'history_length': 32, 'absent_misses': 2, 'absent_window': 3,
+                            'metrics_port': 0, 'metrics_filename': '', 'snapshot_filename': '',
+                            'snapshot_period': 60.0, 'snapshot_max_age': 3600.0, 'event_port': 0,
+                            'event_address': '', 'shard_by': 'room', 'cluster_address': '127.0.0.1',
+                            'cluster_token': '', 'state_filename': ''},
+    Sections.DEVICES.name: {'active_devices': [], 'polling_intervals': {}, 'channels': {}},
+}
+
+CACHE_SUFFIX = ".cache.json"
 
 
 # =============================================================================
 
 
-class HomerConfig:
-    config = {}
+class ConfigError(Exception):
+    pass
+
+
+# =============================================================================
+
+
+def parse_literal(text, expected_type):
+    """
+    parse a JSON (or failing that, Python) literal - never evaluates code
+    """
+    try:
+        value = json.loads(text)
+    except ValueError:
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            raise ConfigError("not a valid %s: %s" % (expected_type.__name__, text))
+    if not isinstance(value, expected_type):
+        raise ConfigError("expected a %s, got: %s" % (expected_type.__name__, text))
+    return value
+
 
+# =============================================================================
+
+
+class HomerConfig:
     # A list of parsers for given data types. Note that many are non-standard types that
     # we do special case handling for.
     configTypeParsers = {
-        'dict': lambda self, settings, section, member: eval(settings.get(section, member)),
-        'list': lambda self, settings, section, member: eval(settings.get(section, member)),
+        'dict': lambda self, settings, section, member: parse_literal(settings.get(section, member), dict),
+        'list': lambda self, settings, section, member: parse_literal(settings.get(section, member), list),
         'string': lambda self, settings, section, member: settings.get(section, member),
         'integer': lambda self, settings, section, member: settings.getint(section, member),
         'bool': lambda self, settings, section, member: settings.getboolean(section, member),
         'float': lambda self, settings, section, member: settings.getfloat(section, member),
     }
 
-    def __init__(self, filename='config.ini'):
+    def __init__(self, filename='config.ini', use_cache=True):
         self.filename = filename
+        self.cache_filename = filename + CACHE_SUFFIX
+        self.config = {}
+        key = self._cache_key()
+        cached = self._read_cache(key) if use_cache else None
+        if cached is not None:
+            self.config[Sections.GENERAL] = cached[Sections.GENERAL.name]
+            self.config[Sections.DEVICES] = cached[Sections.DEVICES.name]
+            return
         settings = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
-        settings.read(self.filename)
+        if not settings.read(self.filename):
+            raise ConfigError("can't read %s" % self.filename)
 
         self.config[Sections.GENERAL] = self.read_general(settings)
         self.config[Sections.DEVICES] = self.read_devices(settings)
+        if use_cache:
+            self._write_cache(key)
+        return
+
+    def _cache_key(self):
+        # the member definitions are part of the key, so a change to them also invalidates the cache
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size, GENERAL_MEMBERS, DEVICES_MEMBERS, MEMBER_DEFAULTS]
+
+    def _read_cache(self, key):
+        if key is None:
+            return None
+        try:
+            with open(self.cache_filename, "r") as the_file:
+                cached = json.load(the_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if cached.get("key") != key:
+            return None
+        return cached["config"]
+
+    def _write_cache(self, key):
+        if key is None:
+            return
+        cached = dict(key=key, config=self.as_dict())
+        temp_filename = self.cache_filename + ".tmp"
+        try:
+            with open(temp_filename, "w") as the_file:
+                json.dump(cached, the_file)
+            os.rename(temp_filename, self.cache_filename)
+        except (IOError, OSError):
+            pass  # read-only filesystem - just parse every time
         return
 
     def read_general(self, settings):
@@ -73,7 +170,13 @@ class HomerConfig:
         return self.parse_config_entry(settings, Sections.DEVICES.name, member, member_type)
 
     def parse_config_entry(self, settings, section, member, member_type):
-        return self.configTypeParsers[member_type](self, settings, section, member)
+        defaults = MEMBER_DEFAULTS.get(section, {})
+        if member in defaults and not settings.has_option(section, member):
+            return copy.deepcopy(defaults[member])
+        try:
+            return self.configTypeParsers[member_type](self, settings, section, member)
+        except (configparser.Error, ValueError, ConfigError) as e:
+            raise ConfigError("%s: [%s] %s: %s" % (self.filename, section, member, str(e)))
 
     def general_details(self):
         return self.config[Sections.GENERAL]
@@ -81,10 +184,24 @@ class HomerConfig:
     def devices_details(self):
         return self.config[Sections.DEVICES]
 
+    def as_dict(self):
+        return dict((section.name, details) for section, details in self.config.items())
+
 
 # =============================================================================
 
 
 if __name__ == "__main__":
     cfg = HomerConfig()
-    print(json.dumps(cfg.config, indent=4))
+    print(json.dumps(cfg.as_dict(), indent=4))
+    RUNS = 200
+    start = time.time()
+    for _ in range(RUNS):
+        HomerConfig(use_cache=False)
+    cold = (time.time() - start) / RUNS
+    HomerConfig()
+    start = time.time()
+    for _ in range(RUNS):
+        HomerConfig()
+    warm = (time.time() - start) / RUNS
+    print("cold start: %5.2f ms, warm start (cached): %5.2f ms" % (cold * 1000, warm * 1000))
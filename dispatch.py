@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Dispatch module - batched device command dispatch
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# concurrent commands allowed through a channel that doesn't say otherwise
+DEFAULT_CHANNEL_LIMIT = 2
+
+
+# =============================================================================
+
+
+class Command(object):
+    __slots__ = ("name", "instance", "state")
+
+    def __init__(self, name, instance, state):
+        self.name = name
+        self.instance = instance
+        self.state = state
+        return
+
+    def apply(self):
+        if self.state:
+            self.instance.turn_on()
+        else:
+            self.instance.turn_off()
+        return
+
+    def __repr__(self):
+        return "%s=%s" % (self.name, "on" if self.state else "off")
+
+
+# =============================================================================
+
+
+class Dispatcher(object):
+    """
+    Turns a batch of desired device states into the fewest commands, and sends them concurrently.
+
+    Commands are grouped by the device's channel.  A channel with an apply_batch method gets its whole group in one
+    call; otherwise its commands run individually, at most max_concurrency (or DEFAULT_CHANNEL_LIMIT) at a time.
+    Devices without a channel are each treated as their own channel.
+    """
+
+    def __init__(self, notifier, max_workers=8):
+        self._notifier = notifier
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._limits = {}
+        self._limits_lock = threading.Lock()
+        return
+
+    def plan(self, desired, manifest):
+        """
+        :param desired: dictionary of device name -> desired state
+        :param manifest: source of device instances
+        :return: dictionary of channel -> commands, omitting devices already in their desired state
+        """
+        groups = {}
+        for name, state in sorted(desired.items()):
+            try:
+                instance = manifest.instance(name)
+                current = instance.state()
+            except KeyError:
+                self._notifier.warning("%s is not a managed device", name)
+                continue
+            except Exception as e:
+                self._notifier.error("can't get state of %s: %s", name, str(e))
+                continue
+            if bool(current) == bool(state):
+                continue
+            channel = instance.channel()
+            key = channel if channel is not None else instance
+            groups.setdefault(key, []).append(Command(name, instance, state))
+        return groups
+
+    def _limit(self, channel):
+        with self._limits_lock:
+            if channel not in self._limits:
+                limit = getattr(channel, "max_concurrency", DEFAULT_CHANNEL_LIMIT)
+                self._limits[channel] = threading.BoundedSemaphore(limit)
+            return self._limits[channel]
+
+    def _send(self, channel, commands):
+        with self._limit(channel):
+            try:
+                if hasattr(channel, "apply_batch"):
+                    channel.apply_batch(commands)
+                    for this_command in commands:
+                        this_command.instance.remember_state(this_command.state)
+                else:
+                    for this_command in commands:
+                        this_command.apply()
+            except Exception as e:
+                self._notifier.error("failed to apply %s: %s", commands, str(e))
+        return
+
+    def dispatch(self, groups):
+        """
+        send every group concurrently and wait for them all
+        """
+        futures = []
+        for channel, commands in groups.items():
+            if hasattr(channel, "apply_batch"):
+                futures.append(self._pool.submit(self._send, channel, commands))
+            else:
+                futures.extend(self._pool.submit(self._send, channel, [this_command]) for this_command in commands)
+        wait(futures)
+        return
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Dispatch start")
+
+    class FakeNotifier(object):
+        def warning(self, template, *args):
+            print("Warning: " + (template % args))
+            return
+
+        def error(self, template, *args):
+            print("Error: " + (template % args))
+            return
+
+    class FakeBridge(object):
+        max_concurrency = 1
+
+        def __init__(self):
+            self.requests = 0
+            return
+
+        def apply_batch(self, commands):
+            self.requests += 1
+            time.sleep(0.1)
+            return
+
+    class FakeDevice(object):
+        def __init__(self, bridge):
+            self.on = False
+            self.bridge = bridge
+            return
+
+        def channel(self):
+            return self.bridge
+
+        def state(self):
+            return self.on
+
+        def remember_state(self, state):
+            self.on = state
+            return
+
+        def turn_on(self):
+            time.sleep(0.1)
+            self.on = True
+            return
+
+        def turn_off(self):
+            time.sleep(0.1)
+            self.on = False
+            return
+
+    class FakeManifest(object):
+        def __init__(self, devices):
+            self.devices = devices
+            return
+
+        def instance(self, name):
+            return self.devices[name]
+
+    the_bridge = FakeBridge()
+    the_devices = dict(("lamp%d" % idx, FakeDevice(the_bridge)) for idx in range(20))
+    the_devices.update(("plug%d" % idx, FakeDevice(None)) for idx in range(8))
+    the_devices["lamp0"].on = True
+    dispatcher = Dispatcher(FakeNotifier())
+    the_groups = dispatcher.plan(dict((name, True) for name in the_devices), FakeManifest(the_devices))
+    start = time.time()
+    dispatcher.dispatch(the_groups)
+    print("%d commands in %d groups took %4.2f sec (%d bridge requests); serially would be %4.1f sec" % (
+        sum(len(commands) for commands in the_groups.values()), len(the_groups), time.time() - start,
+        the_bridge.requests, 0.1 * (len(the_devices) - 1)))
+    dispatcher.shutdown()
+    print("Dispatch end")
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Events module - device state pushed to homer, rather than polled
+
+Wemos are subscribed to with UPnP GENA: homer runs a small HTTP server for their NOTIFY callbacks, and renews each
+subscription before it expires.  Hue bridges are followed through their (v2 API) event stream.  While a device's
+push source is up, it needn't be polled; when a subscription fails or a stream drops (or goes quiet for too long),
+covers() says so and polling takes over until the source is back.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import http.client
+import json
+import re
+import socket
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+
+# seconds asked for when subscribing, and how long before expiry a subscription is renewed.  A Wemo forgets its
+# subscriptions when it restarts, and only a failed renewal shows it, so a subscription is trusted for no longer
+# than this (the margin must exceed the period between checks, so renewals happen before expiry)
+GENA_TIMEOUT = 120
+GENA_RENEW_MARGIN = 45
+
+# seconds between attempts to bring back a failed subscription or stream
+RETRY_PERIOD = 30.0
+
+# seconds of silence after which an event stream is taken to have died without closing, and is reconnected
+STREAM_TIMEOUT = 60.0
+
+# most seconds a NOTIFY waits for a SUBSCRIBE in progress, in case it's for the SID that's about to come back
+SID_WAIT = 2.0
+
+WEMO_EVENT_PATH = "/upnp/event/basicevent1"
+HUE_EVENT_PATH = "/eventstream/clip/v2"
+
+BINARY_STATE_PATTERN = re.compile(r"<BinaryState>\s*(\d)")
+TIMEOUT_PATTERN = re.compile(r"Second-(\d+)")
+
+
+# =============================================================================
+
+
+class GenaSubscription(object):
+    """
+    one UPnP event subscription, to a Wemo's basicevent service
+    """
+
+    def __init__(self, name, channel, callback_url, timeout=GENA_TIMEOUT, clock=time.monotonic):
+        self.name = name
+        self.channel = channel
+        self._callback_url = callback_url
+        self._timeout = timeout
+        self._clock = clock
+        self.sid = None
+        self.expires = 0.0
+        self.retry_at = 0.0
+        return
+
+    def _request(self, headers):
+        status, _ = self.channel.request("SUBSCRIBE", WEMO_EVENT_PATH, None, headers)
+        if status != 200:
+            raise IOError("%s: SUBSCRIBE: HTTP %d" % (self.name, status))
+        return
+
+    def subscribe(self):
+        time_now = self._clock()
+        connection = http.client.HTTPConnection(self.channel.host, self.channel.port, timeout=self.channel.timeout)
+        try:
+            # a dedicated connection, as the SID comes back in a header HttpChannel.request doesn't return
+            connection.request("SUBSCRIBE", WEMO_EVENT_PATH, None, {
+                "CALLBACK": "<%s>" % self._callback_url, "NT": "upnp:event", "TIMEOUT": "Second-%d" % self._timeout})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200 or not response.getheader("SID"):
+                raise IOError("%s: SUBSCRIBE: HTTP %d" % (self.name, response.status))
+            self.sid = response.getheader("SID")
+            match = TIMEOUT_PATTERN.search(response.getheader("TIMEOUT", ""))
+            self.expires = time_now + (int(match.group(1)) if match else self._timeout)
+        finally:
+            connection.close()
+        return
+
+    def renew(self):
+        time_now = self._clock()
+        self._request({"SID": self.sid, "TIMEOUT": "Second-%d" % self._timeout})
+        self.expires = time_now + self._timeout
+        return
+
+    def alive(self):
+        return self.sid is not None and self._clock() < self.expires
+
+    def drop(self):
+        self.sid = None
+        self.retry_at = self._clock() + RETRY_PERIOD
+        return
+
+
+# =============================================================================
+
+
+class HueEventStream(object):
+    """
+    Follows a Hue bridge's event stream from a background thread, reconnecting when it drops.  A stream that dies
+    without closing (the bridge lost power, say) would otherwise look connected forever, so one that's been silent
+    for STREAM_TIMEOUT seconds is reconnected too.
+
+    Real bridges only serve it over HTTPS (with a self-signed certificate) on port 443.
+    """
+
+    def __init__(self, channel, lights, on_update, notifier=None, port=443):
+        """
+        :param lights: dictionary of light id -> device name
+        """
+        self._channel = channel
+        self._lights = lights
+        self._on_update = on_update
+        self._notifier = notifier
+        self._port = port
+        self._connected = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="hue_events")
+        self._thread.daemon = True
+        return
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def alive(self):
+        return self._connected
+
+    def set_lights(self, lights):
+        """
+        :param lights: dictionary of light id -> device name, replacing those followed so far
+        """
+        self._lights = lights
+        return
+
+    def _connect(self):
+        host = self._channel.host
+        if self._port == 443:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return http.client.HTTPSConnection(host, self._port, timeout=STREAM_TIMEOUT, context=context)
+        return http.client.HTTPConnection(host, self._port, timeout=STREAM_TIMEOUT)
+
+    def _follow(self):
+        """
+        :return: True if the stream went quiet, and should be reconnected straight away
+        """
+        connection = self._connect()
+        try:
+            connection.request("GET", HUE_EVENT_PATH, None, {"hue-application-key": self._channel.authenticate(),
+                                                            "Accept": "text/event-stream"})
+            response = connection.getresponse()
+            if response.status != 200:
+                raise IOError("%s event stream: HTTP %d" % (self._channel.name(), response.status))
+            self._connected = True
+            while not self._stop.is_set():
+                try:
+                    line = response.readline()
+                except socket.timeout:
+                    if self._notifier is not None:
+                        self._notifier.diagnostic("%s event stream silent for %d sec, reconnecting",
+                                                  self._channel.name(), STREAM_TIMEOUT)
+                    return True
+                if not line:
+                    break  # bridge closed the stream
+                if line.startswith(b"data:"):
+                    self._deliver(json.loads(line[5:].decode("utf-8")))
+        finally:
+            self._connected = False
+            connection.close()
+        return False
+
+    def _deliver(self, events):
+        lights = self._lights
+        for event in events:
+            if event.get("type") != "update":
+                continue
+            for item in event.get("data", []):
+                light_id = item.get("id_v1", "").rpartition("/")[2]
+                if item.get("type") == "light" and "on" in item and light_id in lights:
+                    self._on_update(lights[light_id], bool(item["on"].get("on")))
+        return
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                silent = self._follow()
+            except Exception as e:
+                silent = False
+                if self._notifier is not None:
+                    self._notifier.warning("%s event stream dropped: %s", self._channel.name(), str(e))
+            if not silent:
+                self._stop.wait(RETRY_PERIOD)
+        return
+
+    def stop(self):
+        self._stop.set()
+        return
+
+
+# =============================================================================
+
+
+class NotifyHandler(BaseHTTPRequestHandler):
+    def log_message(self, format_string, *args):
+        return
+
+    def do_NOTIFY(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8", "replace") if length else ""
+        known = self.server.hub.deliver(self.headers.get("SID"), body)
+        self.send_response(200 if known else 412)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+
+
+# =============================================================================
+
+
+class EventHub(object):
+    """
+    Keeps every push source alive.  sync() says which sources there should be, and check() (run periodically) renews
+    and re-establishes subscriptions.
+
+    on_update(device name, state) is called from the hub's threads as events arrive.
+    """
+
+    def __init__(self, callback_host, port, on_update, notifier=None, clock=time.monotonic):
+        self._on_update = on_update
+        self._notifier = notifier
+        self._clock = clock
+        self._server = ThreadingHTTPServer(("", port), NotifyHandler)
+        self._server.daemon_threads = True
+        self._server.hub = self
+        self.callback_url = "http://%s:%d/" % (callback_host, self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, name="event_hub")
+        self._thread.daemon = True
+        self._subscriptions = {}
+        self._by_sid = {}
+        self._subscribing = 0
+        self._streams = {}
+        self._stream_devices = {}
+        self._condition = threading.Condition()
+        self._events_metric = metrics.REGISTRY.counter("push_events_total", "device states pushed to homer")
+        return
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def sync(self, wemos, bridges):
+        """
+        bring the push sources into line with the manifest - at start, and again whenever it's reloaded
+
+        :param wemos: dictionary of device name -> channel, for the Wemos to subscribe to
+        :param bridges: dictionary of channel -> dictionary of light id -> device name, for the Hue bridges to follow
+        """
+        with self._condition:
+            for name, subscription in list(self._subscriptions.items()):
+                if wemos.get(name) is not subscription.channel:
+                    del self._subscriptions[name]  # left to expire
+            for name, channel in wemos.items():
+                if name not in self._subscriptions:
+                    self._subscriptions[name] = GenaSubscription(name, channel, self.callback_url, clock=self._clock)
+            self._index_sids()
+            for channel in list(self._streams):
+                if channel not in bridges:
+                    self._streams.pop(channel).stop()
+            for channel, lights in bridges.items():
+                if channel in self._streams:
+                    self._streams[channel].set_lights(lights)
+                else:
+                    # real bridges only stream events over HTTPS
+                    self._streams[channel] = HueEventStream(channel, lights, self._update, self._notifier,
+                                                            443 if channel.port == 80 else channel.port).start()
+            self._stream_devices = dict((name, self._streams[channel])
+                                        for channel, lights in bridges.items() for name in lights.values())
+        return
+
+    def _index_sids(self):
+        # caller holds self._condition
+        self._by_sid = dict((subscription.sid, subscription) for subscription in self._subscriptions.values()
+                            if subscription.sid is not None)
+        self._condition.notify_all()
+        return
+
+    def _update(self, name, state):
+        self._events_metric.inc()
+        self._on_update(name, state)
+        return
+
+    def deliver(self, sid, body):
+        """
+        :return: False if sid isn't one of ours
+        """
+        deadline = time.monotonic() + SID_WAIT
+        with self._condition:
+            subscription = self._by_sid.get(sid)
+            # a Wemo sends its first NOTIFY straight after answering SUBSCRIBE, which can beat us to its SID
+            while subscription is None and self._subscribing and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+                subscription = self._by_sid.get(sid)
+        if subscription is None:
+            return False
+        match = BINARY_STATE_PATTERN.search(body)
+        if match is not None:
+            # 8 means on, on some models' insight events
+            self._update(subscription.name, match.group(1) != "0")
+        return True
+
+    def covers(self, name):
+        """
+        :return: True if the device's state is currently being pushed, so it needn't be polled
+        """
+        subscription = self._subscriptions.get(name)
+        if subscription is not None:
+            return subscription.alive()
+        stream = self._stream_devices.get(name)
+        return stream is not None and stream.alive()
+
+    def _subscribe(self, subscription):
+        with self._condition:
+            self._subscribing += 1
+        try:
+            subscription.subscribe()
+        finally:
+            with self._condition:
+                self._subscribing -= 1
+                self._index_sids()
+        return
+
+    def check(self):
+        time_now = self._clock()
+        with self._condition:
+            subscriptions = list(self._subscriptions.values())
+        for subscription in subscriptions:
+            try:
+                if subscription.alive():
+                    if subscription.expires - time_now < GENA_RENEW_MARGIN:
+                        try:
+                            subscription.renew()
+                        except (IOError, OSError, http.client.HTTPException):
+                            # the device restarted and lost the subscription, most likely - start a new one
+                            self._subscribe(subscription)
+                elif time_now >= subscription.retry_at:
+                    self._subscribe(subscription)
+            except Exception as e:
+                if self._notifier is not None:
+                    self._notifier.warning("event subscription to %s failed, polling instead: %s",
+                                           subscription.name, str(e))
+                subscription.drop()
+                with self._condition:
+                    self._index_sids()
+        return
+
+    def stop(self):
+        with self._condition:
+            streams = list(self._streams.values())
+        for stream in streams:
+            stream.stop()
+        self._server.shutdown()
+        self._server.server_close()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Events start")
+    from channels import PhilipsHueChannel
+    from fakebridge import FakeHueBridge, FAKE_USERNAME
+
+    received = []
+    arrived = threading.Event()
+
+    def on_update(name, state):
+        received.append((time.time(), name, state))
+        arrived.set()
+        return
+
+    bridge = FakeHueBridge(num_lights=4).start()
+    hue = PhilipsHueChannel("hue", bridge.host, FAKE_USERNAME, port=bridge.port)
+    hub = EventHub("127.0.0.1", 0, on_update).start()
+    hub.sync({}, {hue: {"1": "lounge_lamp_left", "2": "lounge_lamp_right"}})
+    while not hub.covers("lounge_lamp_left"):
+        time.sleep(0.01)
+    start = time.time()
+    hue.set_light("2", True)
+    arrived.wait(2.0)
+    print("pushed %s in %4.1f ms, no polling" % (received, (received[0][0] - start) * 1000 if received else -1))
+    hub.stop()
+    bridge.stop()
+    print("Events end")
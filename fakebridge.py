@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Fake Bridge - a local stand-in for a Philips Hue bridge (v1 API subset)
+
+Used for trying out and benchmarking the channel layer without real hardware.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from channels import HttpChannel, PhilipsHueChannel
+
+
+FAKE_USERNAME = "homer-fake-user"
+
+
+# =============================================================================
+
+
+class FakeHueState(object):
+    def __init__(self, num_lights):
+        self.lock = threading.Lock()
+        self.lights = dict((str(idx), dict(name="light %d" % idx, state=dict(on=False)))
+                           for idx in range(1, num_lights + 1))
+        self.groups = {}
+        self.requests = 0
+        self.connections = 0
+        self.streams = []
+        return
+
+    def changed(self, light_id):
+        """
+        tell every event stream client about a light's new state - call with lock held
+        """
+        event = [{"type": "update", "data": [{"type": "light", "id_v1": "/lights/%s" % light_id,
+                                              "on": {"on": bool(self.lights[light_id]["state"].get("on"))}}]}]
+        for stream in self.streams:
+            stream.put(event)
+        return
+
+
+# =============================================================================
+
+
+class FakeHueHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(FakeHueHandler, self).setup()
+        with self.server.state.lock:
+            self.server.state.connections += 1
+        return
+
+    def log_message(self, format_string, *args):
+        return
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+
+    def _route(self, method):
+        state = self.server.state
+        body = self._body()
+        parts = [part for part in self.path.split("/") if part]
+        with state.lock:
+            state.requests += 1
+            if parts == ["api"] and method == "POST":
+                return [{"success": {"username": FAKE_USERNAME}}]
+            if len(parts) < 3 or parts[0] != "api" or parts[1] != FAKE_USERNAME:
+                return [{"error": {"type": 1, "description": "unauthorized user"}}]
+            resource = parts[2:]
+            if resource == ["lights"] and method == "GET":
+                return state.lights
+            if len(resource) == 3 and resource[0] == "lights" and resource[2] == "state" and method == "PUT":
+                state.lights[resource[1]]["state"].update(body)
+                state.changed(resource[1])
+                return [{"success": {"/lights/%s/state/on" % resource[1]: body.get("on")}}]
+            if resource == ["groups"] and method == "GET":
+                return state.groups
+            if resource == ["groups"] and method == "POST":
+                group_id = str(len(state.groups) + 1)
+                state.groups[group_id] = body
+                return [{"success": {"id": group_id}}]
+            if len(resource) == 2 and resource[0] == "groups" and method == "PUT" and resource[1] in state.groups:
+                state.groups[resource[1]].update(body)
+                return [{"success": {"/groups/%s/lights" % resource[1]: body.get("lights")}}]
+            if len(resource) == 3 and resource[0] == "groups" and resource[2] == "action" and method == "PUT":
+                for light_id in state.groups[resource[1]]["lights"]:
+                    state.lights[light_id]["state"].update(body)
+                    state.changed(light_id)
+                return [{"success": {"/groups/%s/action/on" % resource[1]: body.get("on")}}]
+        return None
+
+    def _handle(self, method):
+        payload = self._route(method)
+        if payload is None:
+            self._reply([{"error": {"type": 3, "description": "resource not available"}}], 404)
+        else:
+            self._reply(payload)
+        return
+
+    def _event_stream(self):
+        # v2 API server-sent events, for as long as the client stays connected
+        if self.headers.get("hue-application-key") != FAKE_USERNAME:
+            self._reply([{"error": {"type": 1, "description": "unauthorized user"}}], 403)
+            return
+        stream = queue.Queue()
+        with self.server.state.lock:
+            self.server.state.streams.append(stream)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.wfile.write(b": hi\n\n")
+            self.wfile.flush()
+            while True:
+                event = stream.get()
+                if event is None:
+                    break
+                self.wfile.write(("data: %s\n\n" % json.dumps(event)).encode("utf-8"))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            with self.server.state.lock:
+                self.server.state.streams.remove(stream)
+        return
+
+    def do_GET(self):
+        if self.path == "/eventstream/clip/v2":
+            self._event_stream()
+            return
+        self._handle("GET")
+        return
+
+    def do_PUT(self):
+        self._handle("PUT")
+        return
+
+    def do_POST(self):
+        self._handle("POST")
+        return
+
+
+# =============================================================================
+
+
+class FakeHueBridge(object):
+    def __init__(self, num_lights=20, host="127.0.0.1", port=0):
+        self.state = FakeHueState(num_lights)
+        self._server = ThreadingHTTPServer((host, port), FakeHueHandler)
+        self._server.daemon_threads = True
+        self._server.state = self.state
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake_hue_bridge")
+        self._thread.daemon = True
+        return
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self.state.lock:
+            for stream in self.state.streams:
+                stream.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("FakeBridge start")
+
+    class FakeLight(object):
+        def __init__(self, light_id):
+            self.light_id = light_id
+            return
+
+        def address(self):
+            return self.light_id
+
+    class FakeCommand(object):
+        def __init__(self, light_id, state):
+            self.instance = FakeLight(light_id)
+            self.state = state
+            return
+
+    bridge = FakeHueBridge(num_lights=20).start()
+    NUM_REQUESTS = 200
+    start = time.time()
+    for _ in range(NUM_REQUESTS):
+        once = HttpChannel("once", bridge.host, bridge.port)
+        once.request("GET", "/api/%s/lights" % FAKE_USERNAME)
+        once.close()
+    fresh = time.time() - start
+    pooled = HttpChannel("pooled", bridge.host, bridge.port)
+    connections = bridge.state.connections
+    start = time.time()
+    for _ in range(NUM_REQUESTS):
+        pooled.request("GET", "/api/%s/lights" % FAKE_USERNAME)
+    kept_alive = time.time() - start
+    print("%d requests: %4.3f sec on fresh connections, %4.3f sec on %d kept-alive connection(s)" % (
+        NUM_REQUESTS, fresh, kept_alive, bridge.state.connections - connections))
+
+    hue = PhilipsHueChannel("hue", bridge.host, port=bridge.port)
+    hue.authenticate()
+    requests = bridge.state.requests
+    start = time.time()
+    hue.apply_batch([FakeCommand(str(idx), True) for idx in range(1, 21)])
+    print("20 lights on in %d bridge requests, %4.3f sec, %d lit" % (
+        bridge.state.requests - requests, time.time() - start, sum(hue.light_states().values())))
+    start = time.time()
+    for idx in range(1, 21):
+        hue.set_light(str(idx), False)
+    print("20 lights off one at a time (rate limited): %4.3f sec" % (time.time() - start))
+    bridge.stop()
+    print("FakeBridge end")
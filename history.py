@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+History module - bounded per-device presence history with debouncing
+
+Each device keeps its last few raw probe results in a fixed-size ring buffer, so memory use doesn't grow however
+long homer runs.  A device only counts as absent once k of its last n probes have missed, so a single dropped ping
+doesn't flip it, and the time of its last (debounced) change is kept so "held for N seconds" is O(1).
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import array
+import random
+import threading
+import time
+
+
+DEFAULT_HISTORY_LENGTH = 32
+DEFAULT_ABSENT_MISSES = 2
+DEFAULT_ABSENT_WINDOW = 3
+
+
+# =============================================================================
+
+
+class StateHistory(object):
+    """
+    Ring buffer of (monotonic timestamp, raw state) for one device, plus its debounced state.
+
+    The device becomes present as soon as one probe finds it, and absent once absent_misses of the last
+    absent_window probes have missed.
+    """
+
+    __slots__ = ("_times", "_states", "_head", "_count", "_window", "_threshold", "_misses", "state", "since")
+
+    def __init__(self, length=DEFAULT_HISTORY_LENGTH, absent_misses=DEFAULT_ABSENT_MISSES,
+                 absent_window=DEFAULT_ABSENT_WINDOW):
+        if not 0 < absent_misses <= absent_window <= length:
+            raise ValueError("need 0 < absent_misses (%d) <= absent_window (%d) <= length (%d)" % (
+                absent_misses, absent_window, length))
+        self._times = array.array("d", [0.0] * length)
+        self._states = array.array("b", [0] * length)
+        self._head = 0
+        self._count = 0
+        self._window = absent_window
+        self._threshold = absent_misses
+        self._misses = 0
+        self.state = None
+        self.since = None
+        return
+
+    def __len__(self):
+        return self._count
+
+    def record(self, time_now, found):
+        """
+        :return: True if the debounced state changed
+        """
+        length = len(self._states)
+        if self._count >= self._window:
+            # the oldest sample in the window drops out of the miss count
+            self._misses -= 1 - self._states[(self._head - self._window) % length]
+        self._times[self._head] = time_now
+        self._states[self._head] = 1 if found else 0
+        self._head = (self._head + 1) % length
+        self._count = min(self._count + 1, length)
+        if not found:
+            self._misses += 1
+        if found:
+            state = True
+        elif self.state is None or self._misses >= self._threshold:
+            state = False
+        else:
+            state = self.state
+        if state == self.state:
+            return False
+        self.state = state
+        self.since = time_now
+        return True
+
+    def held_for(self, time_now):
+        """
+        :return: seconds the debounced state has held, or 0.0 if nothing has been recorded
+        """
+        if self.since is None:
+            return 0.0
+        return time_now - self.since
+
+    def samples(self):
+        """
+        :return: the recorded (timestamp, found) pairs, oldest first
+        """
+        length = len(self._states)
+        start = self._head - self._count
+        return [(self._times[idx % length], bool(self._states[idx % length])) for idx in range(start, self._head)]
+
+
+# =============================================================================
+
+
+class PresenceHistory(object):
+    """
+    StateHistory for every monitored device.  Written by the surveyor thread, read by the judge.
+    """
+
+    def __init__(self, length=DEFAULT_HISTORY_LENGTH, absent_misses=DEFAULT_ABSENT_MISSES,
+                 absent_window=DEFAULT_ABSENT_WINDOW, clock=time.monotonic):
+        self._length = length
+        self._absent_misses = absent_misses
+        self._absent_window = absent_window
+        self._clock = clock
+        # converts the clock's times to wall clock times (and back) for saving across restarts
+        self._wall_offset = time.time() - clock()
+        self._histories = {}
+        self._lock = threading.Lock()
+        # validate the settings now rather than on the first probe result
+        StateHistory(length, absent_misses, absent_window)
+        return
+
+    def record(self, results, time_now=None):
+        """
+        :param results: dictionary of device name -> raw probe result
+        :return: dictionary of device name -> debounced state
+        """
+        if time_now is None:
+            time_now = self._clock()
+        states = {}
+        with self._lock:
+            for name, found in results.items():
+                history = self._histories.get(name)
+                if history is None:
+                    history = StateHistory(self._length, self._absent_misses, self._absent_window)
+                    self._histories[name] = history
+                history.record(time_now, found)
+                states[name] = history.state
+        return states
+
+    def remove(self, name):
+        with self._lock:
+            self._histories.pop(name, None)
+        return
+
+    def held_for(self, name, time_now=None):
+        """
+        :return: seconds the device's debounced state has held
+        """
+        if time_now is None:
+            time_now = self._clock()
+        with self._lock:
+            history = self._histories.get(name)
+            return history.held_for(time_now) if history is not None else 0.0
+
+    def unchanged_for(self, names, time_now=None):
+        """
+        :return: seconds since any of the devices last changed (debounced) state
+        """
+        if time_now is None:
+            time_now = self._clock()
+        with self._lock:
+            held = None
+            for name in names:
+                history = self._histories.get(name)
+                this_held = history.held_for(time_now) if history is not None else 0.0
+                held = this_held if held is None else min(held, this_held)
+        return held if held is not None else 0.0
+
+    def samples(self, name):
+        with self._lock:
+            history = self._histories.get(name)
+            return history.samples() if history is not None else []
+
+    def export(self):
+        """
+        :return: dictionary of device name -> [debounced state, wall clock time it took that state]
+        """
+        with self._lock:
+            return dict((name, [history.state, history.since + self._wall_offset])
+                        for name, history in self._histories.items() if history.state is not None)
+
+    def restore(self, saved):
+        """
+        :param saved: from export - the probe samples themselves aren't kept, only the debounced states
+        """
+        with self._lock:
+            for name, (state, since) in saved.items():
+                history = StateHistory(self._length, self._absent_misses, self._absent_window)
+                history.state = bool(state)
+                history.since = float(since) - self._wall_offset
+                self._histories[name] = history
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("History start")
+    the_rng = random.Random(1)
+    NUM_PROBES = 10000
+    LOSS = 0.1
+    raw = StateHistory(1, 1, 1)
+    debounced = StateHistory()
+    raw_flips = 0
+    debounced_flips = 0
+    for probe_idx in range(NUM_PROBES):
+        # the device is really there throughout, but a tenth of the probes are lost
+        the_found = the_rng.random() >= LOSS
+        raw_flips += raw.record(probe_idx, the_found)
+        debounced_flips += debounced.record(probe_idx, the_found)
+    print("%d probes at %d%% loss: %d flips raw, %d flips with %d-of-%d debounce" % (
+        NUM_PROBES, LOSS * 100, raw_flips, debounced_flips, DEFAULT_ABSENT_MISSES, DEFAULT_ABSENT_WINDOW))
+    presence = PresenceHistory()
+    start = time.time()
+    for probe_idx in range(NUM_PROBES):
+        presence.record(dict(("device%d" % idx, the_rng.random() >= LOSS) for idx in range(10)), probe_idx)
+    print("%d records/sec, %d samples kept per device" % (
+        (NUM_PROBES * 10) / (time.time() - start), len(presence.samples("device0"))))
+    print("History end")
@@ -10,93 +10,140 @@ www.delaneymorgan.com.au
 
 
 import argparse
+import atexit
 import json
 import os
-import pyping
 import random
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from actions import ACTIONS
-from periodic import Periodic
+from activity import ActivityPoller
+from channels import SamsungTvChannel, make_channels
+from cluster import Coordinator, ShardClient
+from dispatch import Dispatcher
+from events import EventHub
+from history import PresenceHistory
+from logpipe import LogPipeline, RateLimiter, format_json, format_text, DIAGNOSTIC, ERROR, FATAL, NOTE, WARNING
+import metrics
+from metrics import MetricsServer
+from periodic import Periodic, Scheduler
+from pollschedule import AdaptivePoll, intervals_for_types
+from probepool import ProcessSweeper
+from probes import ProbeSet
+from rules import RuleBook, RuleContext, RuleError
+from sharedstate import StatePublisher
 from sharedvar import SharedVarCollection
-from config import HomerConfig
+from snapshot import Snapshotter
+from statecache import StateCache
+from sweeper import Sweeper
+from watcher import FileWatcher
+from config import ConfigError, HomerConfig
 
 
 __VERSION__ = "1.0.0"
 
 CONFIG_FILENAME = "config.ini"
 
+# how often "continuously" rules are re-evaluated when nothing else has changed
+RULINGS_PERIOD = 5
+
+# longest the judge sleeps between time boundaries, so a wall clock step (e.g. NTP) is noticed
+CALENDAR_RECHECK = 60
+
+# how often metrics are written to metrics_filename, if one is configured
+METRICS_DUMP_PERIOD = 60
+
+# how often event subscriptions are renewed, and failed ones retried - less than events.GENA_RENEW_MARGIN
+EVENT_CHECK_PERIOD = 30
+
+# how often the shared state file is brought up to date with device states that changed silently
+STATE_PUBLISH_PERIOD = 1
+
+# how often config.ini, the manifest and the rules are checked for changes
+RELOAD_PERIOD = 2
+
+# config.ini settings a reload applies - changes to the rest need a restart
+RELOADABLE_SETTINGS = ("managed_devices", "monitored_devices", "active_devices", "channels")
+
 
 # =============================================================================
 
 
 class Notifier(object):
+    """
+    Messages are %-templates plus arguments, formatted by the log writer thread - and only if their level is
+    enabled - so logging from the poll loop never waits on stdout.
+    """
+
     def __init__(self, args):
         self._args = args
+        if args.diagnostic:
+            self._level = DIAGNOSTIC
+        elif args.verbose:
+            self._level = NOTE
+        else:
+            self._level = WARNING
+        self._pipeline = LogPipeline(formatter=format_json if args.json else format_text, rate_limiter=RateLimiter())
+        atexit.register(self._pipeline.flush)
         return
 
-    def note(self, string):
-        if self._args.verbose or self._args.diagnostic:
-            print(string)
-        return
+    def enabled(self, level):
+        """
+        :return: True if messages at level are being logged - for callers whose arguments are costly to build
+        """
+        return level >= self._level
 
-    def warning(self, string):
-        print("Warning: %s" % string)
+    def _log(self, level, template, args):
+        if level >= self._level:
+            self._pipeline.put(level, template, args)
         return
 
-    def error(self, string):
-        print("Error: %s" % string)
+    def note(self, template, *args):
+        self._log(NOTE, template, args)
         return
 
-    def diagnostic(self, string):
-        if self._args.diagnostic:
-            print("Diagnostic: %s" % string)
+    def warning(self, template, *args):
+        self._log(WARNING, template, args)
         return
 
-    def fatal(self, string):
-        print("Fatal: %s" % string)
-        sys.stdout.flush()  # force print to flush
-        # noinspection PyProtectedMember
-        os._exit(1)
+    def error(self, template, *args):
+        self._log(ERROR, template, args)
         return
 
-
-# =============================================================================
-
-
-class Channel(object):
-    def __init__(self, name):
-        self._name = name
+    def diagnostic(self, template, *args):
+        self._log(DIAGNOSTIC, template, args)
         return
 
-    def authenticate(self):
-        raise NotImplementedError()
-
-
-# =============================================================================
-
-
-class PhilipsHueChannel(object):
-    def __init__(self, name):
-        super(PhilipsHueChannel, self).__init__(name)
-        self._name = name
+    def fatal(self, template, *args):
+        self._log(FATAL, template, args)
+        self._pipeline.flush()  # make sure it's out before we go
+        sys.stdout.flush()
+        # noinspection PyProtectedMember
+        os._exit(1)
         return
 
-    def authenticate(self):
-        raise NotImplementedError()
-
 
 # =============================================================================
 
 
 class Switch(object):
-    def __init__(self, name, address):
+    def __init__(self, name, address, state_cache, channel=None):
         self._name = name
         self._address = address
+        self._state_cache = state_cache
+        self._channel = channel
         return
 
+    def address(self):
+        return self._address
+
+    def channel(self):
+        # devices reached directly have no channel
+        return self._channel
+
     def turn_on(self):
         raise NotImplementedError()
 
@@ -106,100 +153,109 @@ class Switch(object):
     def _actual_state(self):
         raise NotImplementedError()
 
+    def remember_state(self, state):
+        self._state_cache.put(self._name, state)
+        return
+
     def state(self):
-        raise NotImplementedError()
+        return self._state_cache.get(self._name, self._actual_state)
 
 
 # =============================================================================
 
 
 class Feibit(Switch):
-    def __init__(self, name, address):
-        super(Feibit, self).__init__(name, address)
-        self._state = self._actual_state()
+    def __init__(self, name, address, state_cache, channel=None):
+        super(Feibit, self).__init__(name, address, state_cache, channel)
         return
 
     def turn_on(self):
         print("turning %s on" % self._name)
-        self._state = True
+        self.remember_state(True)
         return
 
     def turn_off(self):
         print("turning %s off" % self._name)
-        self._state = False
+        self.remember_state(False)
         return
 
     def _actual_state(self):
         # get state of device from device itself
         return False
 
-    def state(self):
-        return self._state
-
 
 # =============================================================================
 
 
 class Wemo(Switch):
-    def __init__(self, name, address):
-        super(Wemo, self).__init__(name, address)
-        self._state = self._actual_state()
+    def __init__(self, name, address, state_cache, channel=None):
+        super(Wemo, self).__init__(name, address, state_cache, channel)
         return
 
     def turn_on(self):
         print("turning %s on" % self._name)
-        self._state = True
+        if self._channel is not None:
+            self._channel.set_binary_state(True)
+        self.remember_state(True)
         return
 
     def turn_off(self):
         print("turning %s off" % self._name)
-        self._state = False
+        if self._channel is not None:
+            self._channel.set_binary_state(False)
+        self.remember_state(False)
         return
 
     def _actual_state(self):
         # get state of device from device itself
+        if self._channel is not None:
+            return self._channel.binary_state()
         return False
 
-    def state(self):
-        return self._state
-
 
 # =============================================================================
 
 
 class SamsungTV(Switch):
-    def __init__(self, name, address):
-        super(SamsungTV, self).__init__(name, address)
-        self._state = self._actual_state()
+    def __init__(self, name, address, state_cache, channel=None):
+        super(SamsungTV, self).__init__(name, address, state_cache, channel)
         return
 
     def turn_on(self):
         print("turning %s on" % self._name)
-        self._state = True
+        self.remember_state(True)
         return
 
     def turn_off(self):
         print("turning %s off" % self._name)
-        self._state = False
+        self.remember_state(False)
         return
 
     def _actual_state(self):
         # get state of device from device itself
+        if self._channel is not None:
+            return self._channel.power_state()
         return False
 
-    def state(self):
-        return self._state
-
 
 # =============================================================================
 
 
 class Light(object):
-    def __init__(self, name, address):
+    def __init__(self, name, address, state_cache, channel=None):
         self._name = name
         self._address = address
+        self._state_cache = state_cache
+        self._channel = channel
         return
 
+    def address(self):
+        return self._address
+
+    def channel(self):
+        # devices reached directly have no channel
+        return self._channel
+
     def turn_on(self):
         raise NotImplementedError()
 
@@ -209,114 +265,370 @@ class Light(object):
     def _actual_state(self):
         raise NotImplementedError()
 
+    def remember_state(self, state):
+        self._state_cache.put(self._name, state)
+        return
+
     def state(self):
-        raise NotImplementedError()
+        return self._state_cache.get(self._name, self._actual_state)
 
 
 # =============================================================================
 
 
 class Hue(Light):
-    def __init__(self, name, address):
-        super(Hue, self).__init__(name, address)
-        self._state = self._actual_state()
+    def __init__(self, name, address, state_cache, channel=None):
+        super(Hue, self).__init__(name, address, state_cache, channel)
         return
 
     def turn_on(self):
         print("turning %s on" % self._name)
-        self._state = True
+        if self._channel is not None:
+            self._channel.set_light(self._address, True)
+        self.remember_state(True)
         return
 
     def turn_off(self):
         print("turning %s off" % self._name)
-        self._state = False
+        if self._channel is not None:
+            self._channel.set_light(self._address, False)
+        self.remember_state(False)
         return
 
     def _actual_state(self):
         # get state of device from device itself
+        if self._channel is not None:
+            return self._channel.light_states().get(self._address, False)
         return False
 
-    def state(self):
-        return self._state
+
+# =============================================================================
+
+
+# classes that can be named by a manifest entry's type
+DEVICE_CLASSES = {}
+
+
+def register_device_class(type_name, device_class):
+    DEVICE_CLASSES[type_name.lower()] = device_class
+    return
+
+
+register_device_class("feibit", Feibit)
+register_device_class("hue", Hue)
+register_device_class("samsungtv", SamsungTV)
+register_device_class("wemo", Wemo)
+
+# channels for the device types reached directly, when their manifest entries don't name a channel
+DIRECT_CHANNELS = {"samsungtv": SamsungTvChannel}
+
+
+# =============================================================================
+
+
+class ManifestIndex(object):
+    """
+    the manifest plus lookups by room, type and address - replaced as a whole, never modified
+    """
+
+    def __init__(self, device_manifest, specs):
+        self.device_manifest = device_manifest
+        self.specs = specs
+        self.by_room = {}
+        self.by_type = {}
+        self.by_address = {}
+        for name, info in device_manifest.items():
+            if "room" in info:
+                self.by_room.setdefault(info["room"], []).append(name)
+            self.by_type.setdefault(info["type"], []).append(name)
+            self.by_address[info["address"]] = name
+        return
 
 
 # =============================================================================
 
 
 class Manifest(object):
-    def __init__(self, manifest_filename, managed_devices, notifier):
+    """
+    Managed devices are instantiated on first use (or by warm_up), not all at startup.
+    """
+
+    def __init__(self, manifest_filename, managed_devices, notifier, state_cache, channels):
         the_file = open(manifest_filename, "r")
         json_str = the_file.read()
         the_file.close()
-        self._device_manifest = json.loads(json_str)
-        self._device_manifest = manifest_filename
+        device_manifest = json.loads(json_str)
         self._notifier = notifier
-        self._managed_devices = {}
+        self._state_cache = state_cache
+        self._channels = channels
+        self._direct_channels = {}
+        self._lock = threading.Lock()
+        self._instances = {}
+        try:
+            self._index = ManifestIndex(device_manifest, self._build_specs(device_manifest, managed_devices, channels))
+        except KeyError as e:
+            self._notifier.fatal("%s", e.args[0])
+        return
+
+    def _build_specs(self, device_manifest, managed_devices, channels):
+        """
+        :return: dictionary of managed device name -> (class, address, channel)
+        """
+        for name, info in device_manifest.items():
+            if "address" not in info or "type" not in info:
+                raise KeyError("%s needs an address and a type" % name)
+        specs = {}
         for name in managed_devices:
-            if name in manifest_filename:
-                info = manifest_filename[name]
-                tgt_class = info["type"]
-                try:
-                    constructor = globals()[tgt_class]
-                    self._managed_devices[name] = constructor(name, info["address"])
-                except KeyError as e:
-                    self._notifier.fatal("%s requires %s class implementation in order to be managed" % (name, str(e)))
+            if name not in device_manifest:
+                continue
+            info = device_manifest[name]
+            tgt_class = info["type"].lower()
+            if tgt_class not in DEVICE_CLASSES:
+                raise KeyError("%s requires %s class implementation in order to be managed" % (name, tgt_class))
+            channel = None
+            # channels is None when devices are being simulated
+            if "channel" in info and channels is not None:
+                if info["channel"] not in channels:
+                    raise KeyError("%s uses unknown channel %s" % (name, info["channel"]))
+                channel = channels[info["channel"]]
+            elif tgt_class in DIRECT_CHANNELS and channels is not None:
+                # reached directly, on a channel of its own - the same one for as long as the address stays put
+                key = (name, info["address"])
+                if key not in self._direct_channels:
+                    self._direct_channels[key] = DIRECT_CHANNELS[tgt_class](name, info["address"])
+                channel = self._direct_channels[key]
+            specs[name] = (DEVICE_CLASSES[tgt_class], info["address"], channel)
+        return specs
+
+    def prepare(self, device_manifest, managed_devices, channels):
+        """
+        index a new manifest and work out which existing instances can be kept (their entries and channels are
+        unchanged)
+
+        :raises KeyError: if device_manifest can't be used
+        :return: the new index, instances and channels, for swap
+        """
+        index = ManifestIndex(device_manifest, self._build_specs(device_manifest, managed_devices, channels))
+        with self._lock:
+            kept = dict((name, instance) for name, instance in self._instances.items()
+                        if name in index.specs and
+                        self._index.device_manifest.get(name) == device_manifest.get(name) and
+                        index.specs[name][2] is self._index.specs[name][2])
+        return index, kept, channels
+
+    def swap(self, prepared):
+        index, kept, channels = prepared
+        with self._lock:
+            for name in self._instances:
+                if name not in kept:
+                    self._state_cache.invalidate(name)
+            self._index = index
+            self._instances = kept
+            self._channels = channels
         return
 
+    def channels(self):
+        """
+        :return: dictionary of channel name -> channel, or None when devices are being simulated
+        """
+        return self._channels
+
     def instance(self, name):
-        return self._managed_devices[name]
+        instance = self._instances.get(name)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(name)
+                if instance is None:
+                    constructor, address, channel = self._index.specs[name]
+                    instance = constructor(name, address, self._state_cache, channel)
+                    self._instances[name] = instance
+        return instance
+
+    def warm_up(self, max_workers=8):
+        """
+        instantiate every managed device and fetch its state, concurrently
+        """
+        def warm(name):
+            try:
+                self.instance(name).state()
+            except Exception as e:
+                self._notifier.warning("couldn't warm up %s: %s", name, str(e))
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(warm, list(self._index.specs)))
+        return
+
+    def managed_devices(self):
+        return list(self._index.specs)
 
     def address(self, name):
-        info = self._device_manifest[name]
+        info = self._index.device_manifest[name]
         address = info["address"]
         return address
 
+    def type(self, name):
+        info = self._index.device_manifest[name]
+        return info["type"]
+
+    def room(self, name):
+        return self._index.device_manifest[name].get("room")
+
+    def in_room(self, room):
+        return list(self._index.by_room.get(room, []))
+
+    def of_type(self, device_type):
+        return list(self._index.by_type.get(device_type, []))
+
+    def at_address(self, address):
+        return self._index.by_address.get(address)
+
 
 # =============================================================================
 
 
 class Surveyor(threading.Thread):
-    def __init__(self, args, manifest, monitored_devices, check_period, notifier):
+    def __init__(self, args, manifest, monitored_devices, check_period, notifier, max_in_flight=16,
+                 probe_timeout=2.0, polling_intervals=None, history=None, probe_processes=0):
         super(Surveyor, self).__init__()
+        self.daemon = True
         self._args = args
         self._manifest = manifest
         self._monitored_devices = monitored_devices
         self._notifer = notifier
         self._roll_call = SharedVarCollection({})
-        self._devices_poll = Periodic(check_period, self.poll_devices, "poll_devices")
+        self._history = history if history is not None else PresenceHistory()
+        seed = getattr(args, "seed", None)
+        rng = random.Random(seed) if seed is not None else None
+        if probe_processes:
+            # the workers have probe sets of their own
+            self._probes = None
+            self._sweeper = ProcessSweeper(probe_processes, max_in_flight, probe_timeout, notifier,
+                                           getattr(args, "test", False), seed)
+        else:
+            self._probes = ProbeSet(test=getattr(args, "test", False), rng=rng, notifier=notifier)
+            self._sweeper = Sweeper(None, max_in_flight, probe_timeout, notifier)
+        self._devices_poll = AdaptivePoll(self.poll_devices, "poll_devices", notifier)
+        self._make_interval = intervals_for_types(polling_intervals or {}, check_period)
+        for name in monitored_devices:
+            self._devices_poll.add(name, self._make_interval(manifest.type(name)))
+        self._scheduler = Scheduler(notifier=notifier)
+        self._scheduler.add(self._devices_poll)
         return
 
-    def poll_devices(self):
-        for name in self._monitored_devices:
-            self._notifer.diagnostic("pinging %s" % name)
-            found = self.ping(self._manifest.address(name))
-            if found:
-                self._roll_call.set(name, True)
-                self._notifer.note("%s found" % name)
-            else:
-                self._roll_call.set(name, False)
-                self._notifer.note("%s missing" % name)
+    def add_listener(self, listener):
+        """
+        :param listener: called (from the surveyor thread) whenever the roll call changes
+        """
+        self._roll_call.subscribe(lambda version, changed: listener())
         return
 
-    def ping(self, ip_address):
-        # NOTE: ping requires root access.  Fake it during development with a random#
-        if hasattr(args, 'test') and args.test:
-            found = (random.randint(0, 3) == 3)
+    def poll_devices(self, names=None):
+        """
+        :param names: the devices to poll, or None for all monitored devices
+        :return: dictionary of name -> (found, changed)
+        """
+        if names is None:
+            names = self._monitored_devices
+        targets = {}
+        for name in names:
+            self._notifer.diagnostic("probing %s", name)
+            targets[name] = self._manifest.address(name)
+        if self._probes is None:
+            results = self._sweeper.sweep(targets, dict((name, self._manifest.type(name)) for name in names))
         else:
-            response = pyping.ping(ip_address)
-            found = (response.ret_code == 0)
-        return found
+            probes = dict((name, self._probes.chain_for(self._manifest.type(name))) for name in names)
+            self._probes.begin_sweep()
+            results = self._sweeper.sweep(targets, probes)
+        previous = self._roll_call.snapshot()
+        # the roll call holds debounced presence, so one lost probe doesn't make a device vanish
+        states = self._history.record(results)
+        outcomes = {}
+        for name in names:
+            if results[name]:
+                self._notifer.note("%s found", name)
+            elif states[name]:
+                self._notifer.note("%s missed a probe", name)
+            else:
+                self._notifer.note("%s missing", name)
+            outcomes[name] = (states[name], previous.get(name) != states[name])
+        self._roll_call.set_many(states)
+        return outcomes
+
+    def update_devices(self, monitored_devices):
+        """
+        change the set of monitored devices - safe to call from any thread
+        """
+        def update():
+            for name in monitored_devices:
+                if name not in self._monitored_devices:
+                    self._devices_poll.add(name, self._make_interval(self._manifest.type(name)))
+            for name in self._monitored_devices:
+                if name not in monitored_devices:
+                    self._devices_poll.remove(name)
+                    self._history.remove(name)
+            self._monitored_devices = list(monitored_devices)
+            return
+        self._scheduler.call_soon(update)
+        return
+
+    def add_poll(self, poll):
+        """
+        run another poll (anything with check and next_deadline) on the surveyor's thread
+        """
+        self._scheduler.add(poll)
+        return
+
+    def report(self, name, found):
+        """
+        presence learnt other than by probing (a device pushing its state, say) - safe to call from any thread
+        """
+        def record():
+            if name in self._monitored_devices:
+                self._roll_call.set_many(self._history.record({name: found}))
+            return
+        self._scheduler.call_soon(record)
+        return
+
+    def call_soon(self, task):
+        """
+        run task on the surveyor's thread - safe to call from any thread
+        """
+        self._scheduler.call_soon(task)
+        return
 
     def roll_call(self):
-        return self._roll_call.get()
+        return self._roll_call.snapshot()
+
+    def roll_call_changes(self, since_version):
+        return self._roll_call.changes_since(since_version)
+
+    def history(self):
+        return self._history
+
+    def export(self):
+        return dict(roll_call=dict(self._roll_call.snapshot()), history=self._history.export())
+
+    def restore(self, saved, age):
+        """
+        pick up where a previous run left off, rather than with every device absent
+        """
+        self._history.restore(saved["history"])
+        self._roll_call.set_many(dict((name, bool(state)) for name, state in saved["roll_call"].items()
+                                      if name in self._monitored_devices))
+        return
 
     def check(self):
         self._devices_poll.check()
         return
 
     def run(self):
-        while gRunningFlag:
-            self._devices_poll.check()
+        self._scheduler.run()
+        self._sweeper.shutdown()
+        return
+
+    def stop(self):
+        self._scheduler.stop()
         return
 
 
@@ -324,25 +636,73 @@ class Surveyor(threading.Thread):
 
 
 class Judge(object):
-    def __init__(self, filename, surveyor, notifier):
+    def __init__(self, filename, surveyor, notifier, activity=None):
+        """
+        :param activity: source of the active store - without one, active rules fall back to presence
+        """
         self._surveyor = surveyor
+        self._activity = activity
         self._notifier = notifier
         the_file = open(filename, "r")
         json_str = the_file.read()
         the_file.close()
-        self._rules = json.loads(json_str)
+        try:
+            self._rules = RuleBook(json.loads(json_str))
+        except RuleError as e:
+            self._notifier.fatal("%s: %s", filename, str(e))
+        self._roll_call_version = None
+        self._active_version = None
+        self._duration_metric = metrics.REGISTRY.histogram("rulings_duration_seconds", "time taken to make rulings")
+        return
+
+    def prepare(self, entries):
+        """
+        compile replacement rules, carrying over the state of unchanged ones
+
+        :raises RuleError: if the rules are invalid
+        """
+        return RuleBook(entries, self._rules)
+
+    def swap(self, rules):
+        self._rules = rules
+        # evaluate everything against the new rules next time round
+        self._roll_call_version = None
+        self._active_version = None
+        return
+
+    def export(self):
+        return self._rules.statuses()
+
+    def restore(self, saved, age):
+        self._rules.restore_statuses(saved)
         return
 
-    def _evaluate_rule(self, rule):
-        status = False
-        _ = rule
-        return status
+    def next_deadline(self):
+        """
+        :return: the monotonic time by which the rules must next be evaluated, even if no device changes
+        """
+        time_now = time.monotonic()
+        if self._roll_call_version is None:
+            return time_now
+        delay = RULINGS_PERIOD if self._rules.timed else CALENDAR_RECHECK
+        boundary = self._rules.next_boundary()
+        if boundary is not None:
+            delay = min(delay, max(0.0, boundary - time.time()))
+        return time_now + delay
 
     def make_rulings(self):
+        roll_call, changed = self._surveyor.roll_call_changes(self._roll_call_version)
+        self._roll_call_version = roll_call.version
+        active = None
+        if self._activity is not None:
+            active, active_changed = self._activity.active_changes(self._active_version)
+            self._active_version = active.version
+            changed = changed | active_changed if changed is not None and active_changed is not None else None
         self._notifier.note("evaluating rules")
-        for this_rule in self._rules:
-            self._notifier.diagnostic("evaluating: %s" % this_rule)
-        return []
+        self._notifier.diagnostic("changed devices: %s", changed)
+        with self._duration_metric.time():
+            return self._rules.evaluate(RuleContext(roll_call, active=active, history=self._surveyor.history()),
+                                        changed)
 
 
 # =============================================================================
@@ -355,19 +715,223 @@ class Valet(object):
         self._judge = judge
         self._actions = actions
         self._notifier = notifier
+        self._dispatcher = Dispatcher(notifier)
+        self._dispatch_metric = metrics.REGISTRY.histogram("dispatch_duration_seconds",
+                                                           "time taken to carry out actions")
+        self._commands_metric = metrics.REGISTRY.counter("dispatch_commands_total", "device commands sent")
         return
 
     def check(self):
         required_actions = self._judge.make_rulings()
-        self._notifier.note("actions required: %s" % required_actions)
+        self._notifier.note("actions required: %s", required_actions)
+        desired = {}
         for action in required_actions:
-            self._actions[action]()
+            metrics.REGISTRY.counter("actions_total", "actions required by the rules", action=action).inc()
+            if action in self._actions:
+                # later rulings win where actions disagree
+                desired.update(self._actions[action](self._devices))
+            else:
+                self._notifier.warning("no action defined for %s", action)
+        if desired:
+            groups = self._dispatcher.plan(desired, self._devices)
+            if self._notifier.enabled(DIAGNOSTIC):
+                self._notifier.diagnostic("dispatching: %s", list(groups.values()))
+            with self._dispatch_metric.time():
+                self._dispatcher.dispatch(groups)
+            self._commands_metric.inc(sum(len(commands) for commands in groups.values()))
+        return
+
+    def next_deadline(self):
+        return self._judge.next_deadline()
+
+
+# =============================================================================
+
+
+class Reloader(object):
+    """
+    Watches config.ini, the manifest and the rules.  Changed files are parsed and validated on a background thread,
+    then swapped in on the scheduler's thread.  Invalid files are reported and ignored.
+    """
+
+    def __init__(self, config_filename, manifest_filename, rules_filename, manifest, surveyor, judge, scheduler,
+                 notifier, activity=None, hub=None):
+        self._config_filename = config_filename
+        self._manifest_filename = manifest_filename
+        self._rules_filename = rules_filename
+        self._manifest = manifest
+        self._surveyor = surveyor
+        self._judge = judge
+        self._scheduler = scheduler
+        self._notifier = notifier
+        self._activity = activity
+        self._hub = hub
+        self._watcher = FileWatcher([config_filename, manifest_filename, rules_filename])
+        # what the running homer was configured with, to tell what a reload changes
+        self._config = HomerConfig(config_filename)
+        self._pending = []
+        self._busy = False
+        return
+
+    def check(self):
+        self._pending.extend(self._watcher.changed())
+        if self._pending and not self._busy:
+            self._busy = True
+            changed = self._pending
+            self._pending = []
+            thread = threading.Thread(target=self._prepare, args=(changed,), name="reloader")
+            thread.daemon = True
+            thread.start()
+        return
+
+    @staticmethod
+    def _load_json(filename):
+        with open(filename, "r") as the_file:
+            return json.loads(the_file.read())
+
+    def _restart_needed(self, config):
+        """
+        :return: the changed settings that only take effect when homer is restarted
+        """
+        changed = []
+        for old, new in ((self._config.general_details(), config.general_details()),
+                         (self._config.devices_details(), config.devices_details())):
+            changed.extend(member for member in sorted(new)
+                           if member not in RELOADABLE_SETTINGS and new[member] != old.get(member))
+        return changed
+
+    def _channels(self, config):
+        """
+        :return: channels for the new settings - unchanged ones are kept, with their connections and rate limits
+        """
+        channels = self._manifest.channels()
+        if channels is None:
+            return None  # devices are being simulated
+        old_settings = self._config.devices_details()["channels"]
+        new_settings = config.devices_details()["channels"]
+        new_channels = dict((name, channels[name]) for name, this_setting in new_settings.items()
+                            if name in channels and old_settings.get(name) == this_setting)
+        new_channels.update(make_channels(dict((name, this_setting) for name, this_setting in new_settings.items()
+                                               if name not in new_channels)))
+        return new_channels
+
+    def _prepare(self, changed):
+        swaps = []
+        try:
+            self._notifier.note("reloading %s", changed)
+            config = HomerConfig(self._config_filename)
+            restart_needed = self._restart_needed(config)
+            if restart_needed:
+                self._notifier.warning("%s: changes to %s only take effect when homer is restarted",
+                                       self._config_filename, restart_needed)
+            managed_devices = config.devices_details()["managed_devices"]
+            monitored_devices = config.devices_details()["monitored_devices"]
+            active_devices = config.devices_details()["active_devices"]
+            if self._manifest_filename in changed or self._config_filename in changed:
+                device_manifest = self._load_json(self._manifest_filename)
+                for name in monitored_devices:
+                    if name not in device_manifest:
+                        raise KeyError("monitored device %s is not in the manifest" % name)
+                for name in active_devices:
+                    if name not in managed_devices:
+                        raise KeyError("active device %s is not managed" % name)
+                prepared = self._manifest.prepare(device_manifest, managed_devices, self._channels(config))
+                swaps.append(lambda: self._manifest.swap(prepared))
+                swaps.append(lambda: self._surveyor.update_devices(monitored_devices))
+                if self._activity is not None:
+                    swaps.append(lambda: self._surveyor.call_soon(
+                        lambda: self._activity.update_devices(active_devices)))
+                if self._hub is not None:
+                    swaps.append(lambda: self._hub.sync(*event_sources(self._manifest)))
+            if self._rules_filename in changed:
+                rules = self._judge.prepare(self._load_json(self._rules_filename))
+                swaps.append(lambda: self._judge.swap(rules))
+            self._config = config
+        except Exception as e:
+            self._notifier.error("not reloading %s: %s", changed, str(e))
+            swaps = []
+        self._scheduler.call_soon(lambda: self._swap(swaps))
+        return
+
+    def _swap(self, swaps):
+        for swap in swaps:
+            swap()
+        if swaps:
+            # new rules are due for evaluation straight away, so the valet's deadline has moved
+            self._scheduler.reschedule()
+            self._notifier.note("reloaded")
+        self._busy = False
         return
 
 
 # =============================================================================
 
 
+def event_sources(manifest):
+    """
+    :return: the push sources for the managed devices, as EventHub.sync takes them - dictionary of Wemo name ->
+        channel, and dictionary of Hue bridge channel -> dictionary of light id -> name
+    """
+    wemos = {}
+    bridges = {}
+    for name in manifest.managed_devices():
+        channel = manifest.instance(name).channel()
+        if channel is None:
+            continue
+        device_type = manifest.type(name).lower()
+        if device_type == "wemo":
+            wemos[name] = channel
+        elif device_type == "hue":
+            bridges.setdefault(channel, {})[manifest.address(name)] = name
+    return wemos, bridges
+
+
+def start_event_hub(event_address, event_port, manifest, activity, surveyor, state_cache, notifier):
+    """
+    subscribe to every managed Wemo, and every Hue bridge's event stream - pushed states go into the active store,
+    the state cache and (for monitored devices) the roll call, and polling fills in whenever a subscription is down
+    """
+    def on_update(name, state):
+        state_cache.put(name, state)
+        activity.push(name, state)
+        # only a device that's there can tell us its state
+        surveyor.report(name, True)
+        return
+
+    hub = EventHub(event_address, event_port, on_update, notifier).start()
+    hub.sync(*event_sources(manifest))
+    activity.set_push(hub.covers)
+    return hub
+
+
+def node_spec(spec):
+    """
+    :return: (node name, coordinator host, coordinator port) from NAME@HOST:PORT
+    """
+    name, _, address = spec.partition("@")
+    host, _, port = address.rpartition(":")
+    if not name or not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("%s isn't NAME@HOST:PORT" % spec)
+    return name, host, int(port)
+
+
+def run_node(node, prefers, token, surveyor, notifier):
+    """
+    survey whichever devices the coordinator assigns, until interrupted
+    """
+    node_name, host, port = node
+    client = ShardClient(node_name, host, port, surveyor, notifier, token, prefers)
+    surveyor.start()
+    client.start()
+    try:
+        while client.is_alive():
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        client.stop()
+        surveyor.stop()
+    return
+
+
 def arg_parser():
     """
     parse arguments
@@ -377,7 +941,15 @@ def arg_parser():
     parser = argparse.ArgumentParser(description='Homer.')
     parser.add_argument("-v", "--verbose", help="verbose mode", action="store_true")
     parser.add_argument("-d", "--diagnostic", help="diagnostic mode (includes verbose)", action="store_true")
-    parser.add_argument("-t", "--test", help="use fake pings for simulation", action="store_true")
+    parser.add_argument("-t", "--test", help="use fake probes for simulation", action="store_true")
+    parser.add_argument("-j", "--json", help="log as JSON lines", action="store_true")
+    parser.add_argument("-s", "--seed", help="random seed for the fake probes (with --test)", type=int)
+    parser.add_argument("--coordinate", help="judge for surveying nodes, which connect on this port", type=int,
+                        metavar="PORT")
+    parser.add_argument("--node", help="survey for the coordinator at HOST:PORT", type=node_spec,
+                        metavar="NAME@HOST:PORT")
+    parser.add_argument("--prefer", help="shard (room or subnet) this node should survey (with --node)",
+                        action="append", default=[])
     parser.add_argument("--version", action="version", version='%(prog)s {version}'.format(version=__VERSION__))
     args = parser.parse_args()
     return args
@@ -387,24 +959,133 @@ if __name__ == "__main__":
     print("Homer start")
     args = arg_parser()
     notifier = Notifier(args)
-    config = HomerConfig(CONFIG_FILENAME)
+    try:
+        config = HomerConfig(CONFIG_FILENAME)
+    except ConfigError as e:
+        notifier.fatal("%s", str(e))
+    metrics_port = config.general_details()["metrics_port"]
+    metrics_filename = config.general_details()["metrics_filename"]
+    if metrics_port or metrics_filename:
+        metrics.enable()
+    if metrics_port:
+        MetricsServer(metrics.REGISTRY, metrics_port).start()
     managed_devices = config.devices_details()["managed_devices"]
     manifest_filename = config.general_details()["manifest_filename"]
-    manifest = Manifest(manifest_filename, managed_devices, notifier)
+    state_cache = StateCache(config.general_details()["state_ttl"])
+    if config.general_details()["state_refresh"] > 0:
+        state_cache.start_refresher(config.general_details()["state_refresh"])
+    # no real bridges or hubs while testing
+    channels = make_channels(config.devices_details()["channels"]) if not args.test else None
+    manifest = Manifest(manifest_filename, managed_devices, notifier, state_cache, channels)
     monitored_devices = config.devices_details()["monitored_devices"]
-    # noinspection PyTypeChecker
-    surveyor = Surveyor(args, manifest, monitored_devices, 15, notifier)
+    max_probes_in_flight = config.general_details()["max_probes_in_flight"]
+    probe_timeout = config.general_details()["probe_timeout"]
+    polling_intervals = config.devices_details()["polling_intervals"]
+    try:
+        history = PresenceHistory(config.general_details()["history_length"],
+                                  config.general_details()["absent_misses"],
+                                  config.general_details()["absent_window"])
+    except ValueError as e:
+        notifier.fatal("%s: %s", CONFIG_FILENAME, str(e))
+    cluster_token = config.general_details()["cluster_token"]
+    if (args.coordinate is not None or args.node is not None) and not cluster_token:
+        notifier.fatal("%s: cluster_token must be set to coordinate or run a node", CONFIG_FILENAME)
+    if args.coordinate is not None:
+        # the nodes do the surveying, and this process the judging
+        shard_by = config.general_details()["shard_by"]
+        if shard_by not in ("room", "subnet"):
+            notifier.fatal("%s: shard_by must be room or subnet, not %s", CONFIG_FILENAME, shard_by)
+        try:
+            surveyor = Coordinator(args.coordinate, manifest, monitored_devices, notifier, cluster_token, shard_by,
+                                   config.general_details()["cluster_address"])
+        except (IOError, OSError) as e:
+            notifier.fatal("can't coordinate on port %d: %s", args.coordinate, str(e))
+    else:
+        # a node surveys nothing until the coordinator says what
+        # noinspection PyTypeChecker
+        surveyor = Surveyor(args, manifest, monitored_devices if args.node is None else [], 15, notifier,
+                            max_probes_in_flight, probe_timeout, polling_intervals, history,
+                            config.general_details()["probe_processes"])
+    if args.node is not None:
+        run_node(args.node, args.prefer, cluster_token, surveyor, notifier)
+        print("Homer end")
+        sys.exit(0)
+    active_devices = config.devices_details()["active_devices"]
+    for name in active_devices:
+        if name not in managed_devices:
+            notifier.fatal("%s: active device %s is not managed", CONFIG_FILENAME, name)
+    activity = ActivityPoller(manifest, active_devices, notifier, polling_intervals, args.test,
+                              random.Random(args.seed) if args.seed is not None else None, state_cache=state_cache)
+    surveyor.add_poll(activity)
+    event_port = config.general_details()["event_port"]
+    hub = None
+    # no devices to subscribe to while testing
+    if event_port and not args.test:
+        hub = start_event_hub(config.general_details()["event_address"], event_port, manifest, activity, surveyor,
+                              state_cache, notifier)
     rules_filename = config.general_details()["rules_filename"]
-    judge = Judge(rules_filename, surveyor, notifier)
+    judge = Judge(rules_filename, surveyor, notifier, activity)
     valet = Valet(manifest, surveyor, judge, ACTIONS, notifier)
-    # roll_caller.start()
+    snapshot_filename = config.general_details()["snapshot_filename"]
+    snapshotter = Snapshotter(snapshot_filename, notifier) if snapshot_filename else None
+    if snapshotter is not None:
+        snapshotter.add("surveyor", surveyor.export, surveyor.restore)
+        snapshotter.add("activity", activity.export, activity.restore)
+        snapshotter.add("judge", judge.export, judge.restore)
+        snapshotter.add("device_states", state_cache.export, state_cache.restore)
+        snapshotter.restore(config.general_details()["snapshot_max_age"])
+    # after the restore, so restored device states save querying the devices
+    warm_up = threading.Thread(target=manifest.warm_up, name="warm_up")
+    warm_up.daemon = True
+    warm_up.start()
+
+    state_filename = config.general_details()["state_filename"]
+    publisher = None
+    if state_filename:
+        try:
+            publisher = StatePublisher(state_filename, notifier=notifier)
+        except (IOError, OSError) as e:
+            notifier.warning("can't share state through %s: %s", state_filename, str(e))
+
+    def publish_state():
+        publisher.publish(surveyor.roll_call(), activity.active(), state_cache.export(),
+                          dict((name, since) for name, (_, since) in surveyor.history().export().items()))
+        return
+
+    def review():
+        if notifier.enabled(NOTE):
+            notifier.note("roll call: %s, active: %s", dict(surveyor.roll_call()), dict(activity.active()))
+        valet.check()
+        if publisher is not None:
+            publish_state()
+        return
+
+    scheduler = Scheduler(notifier=notifier)
+    scheduler.add(valet)
+    reloader = Reloader(CONFIG_FILENAME, manifest_filename, rules_filename, manifest, surveyor, judge, scheduler,
+                        notifier, activity, hub)
+    scheduler.add(Periodic(RELOAD_PERIOD, reloader.check, "reload", notifier))
+    if snapshotter is not None:
+        scheduler.add(Periodic(config.general_details()["snapshot_period"], snapshotter.check, "snapshot", notifier))
+    if metrics_filename:
+        scheduler.add(Periodic(METRICS_DUMP_PERIOD, lambda: metrics.REGISTRY.dump(metrics_filename), "metrics",
+                               notifier))
+    if publisher is not None:
+        scheduler.add(Periodic(STATE_PUBLISH_PERIOD, publish_state, "publish_state", notifier))
+    if hub is not None:
+        scheduler.add(Periodic(EVENT_CHECK_PERIOD, hub.check, "events", notifier))
+    surveyor.add_listener(lambda: scheduler.call_soon(review))
+    activity.add_listener(lambda: scheduler.call_soon(review))
+    surveyor.start()
     try:
-        while True:
-            surveyor.check()
-            notifier.note("roll call: %s" % surveyor.roll_call())
-            valet.check()
-            time.sleep(5)
+        scheduler.run()
     except KeyboardInterrupt:
-        gRunningFlag = False
+        surveyor.stop()
         pass
+    if hub is not None:
+        hub.stop()
+    if publisher is not None:
+        publisher.close()
+    if snapshotter is not None:
+        snapshotter.save()
     print("Homer end")
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Log Pipe module - non-blocking log output
+
+Logging threads only check the level and put the unformatted record on a queue.  A background writer formats
+records (as text or JSON lines), drops repeats of a message beyond a rate limit, and writes them out in batches
+with one flush per batch.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import json
+import queue
+import sys
+import threading
+import time
+
+
+DIAGNOSTIC = 10
+NOTE = 20
+WARNING = 30
+ERROR = 40
+FATAL = 50
+
+LEVEL_NAMES = {DIAGNOSTIC: "diagnostic", NOTE: "note", WARNING: "warning", ERROR: "error", FATAL: "fatal"}
+LEVEL_PREFIXES = {DIAGNOSTIC: "Diagnostic: ", NOTE: "", WARNING: "Warning: ", ERROR: "Error: ", FATAL: "Fatal: "}
+
+# records waiting to be written - beyond this, new records are dropped (and counted) rather than block the logger
+QUEUE_LENGTH = 10000
+
+# most records written per write/flush
+BATCH_SIZE = 256
+
+# at most RATE_LIMIT records with the same message per RATE_WINDOW seconds
+RATE_LIMIT = 20
+RATE_WINDOW = 10.0
+
+
+# =============================================================================
+
+
+class LogRecord(object):
+    __slots__ = ("time", "level", "template", "args", "thread")
+
+    def __init__(self, level, template, args):
+        self.time = time.time()
+        self.level = level
+        self.template = template
+        self.args = args
+        self.thread = threading.current_thread().name
+        return
+
+    def message(self):
+        if not self.args:
+            return self.template
+        try:
+            return self.template % self.args
+        except (TypeError, ValueError):
+            return "%s %s" % (self.template, self.args)
+
+
+def format_text(record):
+    return LEVEL_PREFIXES[record.level] + record.message()
+
+
+def format_json(record):
+    return json.dumps(dict(time=round(record.time, 3), level=LEVEL_NAMES[record.level], thread=record.thread,
+                           message=record.message()))
+
+
+# =============================================================================
+
+
+class RateLimiter(object):
+    """
+    passes at most limit records per message (template and arguments) per window, so one chatty device can't
+    silence the same message about the others.  How many were suppressed is reported with the first record of that
+    message in a later window.
+    """
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW):
+        self.limit = limit
+        self.window = window
+        self._counts = {}
+        self._pruned_at = 0.0
+        return
+
+    def _prune(self, now):
+        """
+        forget messages whose window has ended with nothing suppressed, so one-off messages don't accumulate
+        """
+        self._counts = dict((key, (window_start, count)) for key, (window_start, count) in self._counts.items()
+                            if now - window_start < self.window or count > self.limit)
+        self._pruned_at = now
+        return
+
+    def admit(self, record):
+        """
+        :return: records to write in place of this one - itself, plus a summary of any suppressed before it
+        """
+        if record.time - self._pruned_at >= self.window:
+            self._prune(record.time)
+        # the formatted message, as arguments (dictionaries, say) needn't be hashable
+        key = (record.level, record.message())
+        window_start, count = self._counts.get(key, (record.time, 0))
+        admitted = []
+        if record.time - window_start >= self.window:
+            if count > self.limit:
+                admitted.append(LogRecord(record.level, "(%d similar messages suppressed: %s)",
+                                          (count - self.limit, key[1])))
+            window_start, count = record.time, 0
+        count += 1
+        self._counts[key] = (window_start, count)
+        if count <= self.limit:
+            admitted.append(record)
+        return admitted
+
+
+# =============================================================================
+
+
+class LogPipeline(object):
+    def __init__(self, stream=None, formatter=format_text, rate_limiter=None, queue_length=QUEUE_LENGTH):
+        self._stream = stream if stream is not None else sys.stdout
+        self._formatter = formatter
+        self._rate_limiter = rate_limiter
+        self._queue = queue.Queue(queue_length)
+        self._dropped = 0
+        self._writer = threading.Thread(target=self._run, name="log_writer")
+        self._writer.daemon = True
+        self._writer.start()
+        return
+
+    def put(self, level, template, args):
+        if level >= FATAL:
+            # the last word before exiting mustn't be lost to a full queue - waits for room instead
+            self._queue.put(LogRecord(level, template, args))
+            return
+        try:
+            self._queue.put_nowait(LogRecord(level, template, args))
+        except queue.Full:
+            self._dropped += 1  # racy, but only ever reported as an approximate count
+        return
+
+    def _batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            records = []
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                records.append(LogRecord(WARNING, "(%d log records dropped - queue full)", (dropped,)))
+            for record in batch:
+                if self._rate_limiter is None or record.level >= FATAL:
+                    records.append(record)
+                else:
+                    records.extend(self._rate_limiter.admit(record))
+            lines = []
+            for record in records:
+                lines.append(self._formatter(record))
+            try:
+                if lines:
+                    self._stream.write("\n".join(lines) + "\n")
+                    self._stream.flush()
+            except (IOError, OSError, ValueError):
+                pass  # nowhere left to report it
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        block until everything logged so far has been written
+        """
+        self._queue.join()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("LogPipe start")
+    import io
+    NUM_RECORDS = 100000
+    for the_formatter in (format_text, format_json):
+        pipeline = LogPipeline(io.StringIO(), the_formatter, RateLimiter())
+        start = time.time()
+        for idx in range(NUM_RECORDS):
+            pipeline.put(NOTE, "device%d found", (idx % 50,))
+        logged = time.time() - start
+        pipeline.flush()
+        print("%s: %4.2f usec per record for the logging thread, %4.2f usec including writing" % (
+            the_formatter.__name__, logged * 1e6 / NUM_RECORDS, (time.time() - start) * 1e6 / NUM_RECORDS))
+    the_stream = io.StringIO()
+    pipeline = LogPipeline(the_stream, format_json, RateLimiter(limit=3))
+    for idx in range(10):
+        pipeline.put(WARNING, "probe of %s timed out", ("lounge_tv",))
+        pipeline.put(WARNING, "probe of %s timed out", ("craig_mobile",))
+    pipeline.flush()
+    print(the_stream.getvalue(), end="")
+    print("LogPipe end")
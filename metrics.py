@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Metrics module - counters, gauges and latency histograms
+
+Metrics are fetched from a Registry once, when the thing they measure is built, and updated on the hot path.
+A disabled registry hands out a shared do-nothing metric instead, so instrumentation costs next to nothing unless
+metrics are turned on.  Enabled metrics can be served in Prometheus text format over HTTP, or dumped to a JSON file.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# upper bounds (seconds) of the latency histogram buckets - the last bucket catches everything slower
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# =============================================================================
+
+
+class _Timer(object):
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = None
+        return
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.monotonic() - self._start)
+        return False
+
+
+class NullMetric(object):
+    """
+    stands in for every kind of metric when metrics are disabled
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def inc(self, amount=1):
+        return
+
+    def set(self, value):
+        return
+
+    def observe(self, value):
+        return
+
+    def time(self):
+        return self
+
+
+NULL_METRIC = NullMetric()
+
+
+# =============================================================================
+
+
+class Counter(object):
+    kind = "counter"
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+        return
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+        return
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge(object):
+    kind = "gauge"
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+        return
+
+    def set(self, value):
+        self.value = value
+        return
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    """
+    fixed buckets, so observing is a bisect and three additions whatever the number of observations
+    """
+
+    kind = "histogram"
+    __slots__ = ("bounds", "counts", "count", "sum", "_lock")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        return
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+        return
+
+    def time(self):
+        """
+        :return: a context manager observing how long its block takes
+        """
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += bucket_count
+            samples.append((name + "_bucket", labels + (("le", "+Inf" if bound == float("inf") else repr(bound)),),
+                            cumulative))
+        samples.append((name + "_count", labels, count))
+        samples.append((name + "_sum", labels, total))
+        return samples
+
+
+# =============================================================================
+
+
+class Registry(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        return
+
+    def _get(self, constructor, name, description, labels):
+        if not self.enabled:
+            return NULL_METRIC
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = constructor()
+                self._metrics[key] = metric
+                self._help.setdefault(name, (metric.kind, description))
+            return metric
+
+    def counter(self, name, description="", **labels):
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name, description="", **labels):
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name, description="", **labels):
+        return self._get(Histogram, name, description, labels)
+
+    def _samples(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+        by_name = {}
+        for (name, labels), metric in metrics:
+            by_name.setdefault(name, []).extend(metric.samples(name, labels))
+        return by_name
+
+    def render_prometheus(self):
+        """
+        :return: every metric in Prometheus text exposition format
+        """
+        lines = []
+        for name, samples in sorted(self._samples().items()):
+            kind, description = self._help[name]
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_text = ",".join('%s="%s"' % (key, str(label_value).replace('"', '\\"'))
+                                          for key, label_value in labels)
+                    lines.append("%s{%s} %s" % (sample_name, label_text, value))
+                else:
+                    lines.append("%s %s" % (sample_name, value))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        """
+        :return: dictionary of metric name -> list of dict(labels=, value=) samples
+        """
+        return dict((name, [dict(name=sample_name, labels=dict(labels), value=value)
+                            for sample_name, labels, value in samples])
+                    for name, samples in self._samples().items())
+
+    def dump(self, filename):
+        """
+        write every metric to filename as JSON, replacing it atomically
+        """
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as the_file:
+            json.dump(dict(time=time.time(), metrics=self.as_dict()), the_file, sort_keys=True)
+        os.rename(temp_filename, filename)
+        return
+
+
+# the registry homer's modules record into - disabled until enable() is called
+REGISTRY = Registry()
+
+
+def enable():
+    """
+    turn metrics on - only metrics fetched afterwards are live, so call this before building anything
+    """
+    REGISTRY.enabled = True
+    return REGISTRY
+
+
+# =============================================================================
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format_string, *args):
+        return
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.registry.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.server.registry.as_dict(), sort_keys=True).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+
+class MetricsServer(object):
+    """
+    serves /metrics (Prometheus) and /metrics.json from a daemon thread
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics")
+        self._thread.daemon = True
+        return
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Metrics start")
+    NUM_OBSERVATIONS = 200000
+    for the_registry in (Registry(enabled=False), Registry(enabled=True)):
+        the_histogram = the_registry.histogram("benchmark_seconds", "benchmark timings")
+        the_counter = the_registry.counter("benchmark_total", "benchmark runs")
+        start = time.time()
+        for _ in range(NUM_OBSERVATIONS):
+            with the_histogram.time():
+                the_counter.inc()
+        print("%s: %4.0f ns per timed block" % ("enabled" if the_registry.enabled else "disabled",
+                                                 (time.time() - start) * 1e9 / NUM_OBSERVATIONS))
+    server = MetricsServer(the_registry, 0).start()
+    print("serving on http://%s:%d/metrics" % (server.host, server.port))
+    print(the_registry.render_prometheus())
+    server.stop()
+    print("Metrics end")
@@ -8,9 +8,14 @@ Periodic module
 www.delaneymorgan.com.au
 """
 
+import heapq
 import math
+import random
 import threading
 import time
+import traceback
+
+import metrics
 
 
 gRunningFlag = True
@@ -20,32 +25,202 @@ gRunningFlag = True
 
 
 class Periodic(object):
-    def __init__(self, period, task, name=None, notifier=None):
+    """
+    Runs a task every period seconds of a monotonic clock.
+
+    missed decides what happens when a run is late by more than a period:
+        CATCH_UP - run once for every missed period, back to back
+        SKIP     - run once, then carry on at the next period boundary
+        COALESCE - run once, then restart the period from now
+    jitter delays the first run by a random fraction (0..jitter) of a period so many tasks spread out.
+    """
+
+    CATCH_UP = "catch_up"
+    SKIP = "skip"
+    COALESCE = "coalesce"
+
+    def __init__(self, period, task, name=None, notifier=None, missed=SKIP, jitter=0.0, clock=time.monotonic):
         self.period = period
         self.task = task
         self.name = name
         self.notifier = notifier
-        self.start_time = time.time()
+        self.missed = missed
+        self.clock = clock
+        self.start_time = clock() + (random.uniform(0, jitter) * period)
+        self.next_due = self.start_time
         self.num_periods = -1
         self.last_time = 0
+        self.runs = 0
+        self.overruns = 0
+        self.missed_periods = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self._duration_metric = metrics.REGISTRY.histogram("periodic_duration_seconds", "time taken by each run",
+                                                           task=name)
+        self._lateness_metric = metrics.REGISTRY.histogram("periodic_lateness_seconds",
+                                                           "how late each run started", task=name)
+        self._overruns_metric = metrics.REGISTRY.counter("periodic_overruns_total", "runs longer than the period",
+                                                         task=name)
         return
 
-    def check(self):
-        time_now = time.time()
-        elapsed_periods = math.floor((time_now - self.start_time) / self.period)
-        remainder = (time_now - self.start_time) % self.period
-        time_left = max(0, (self.period - remainder))
-        if elapsed_periods > self.num_periods:
+    def next_deadline(self):
+        """
+        :return: when the task is next due, in the clock's timebase
+        """
+        return self.next_due
+
+    def _schedule_next(self, time_now):
+        late_periods = int(math.floor((time_now - self.next_due) / self.period))
+        if self.missed == Periodic.CATCH_UP:
+            self.next_due += self.period
             self.num_periods += 1
-            self.last_time = time_now
-            if self.name is not None:
-                if self.notifier is not None:
-                    self.notifier.diagnostic("doing %s" % self.name)
+            return
+        self.missed_periods += late_periods
+        if self.missed == Periodic.COALESCE and late_periods > 0:
+            self.next_due = time_now + self.period
+        else:
+            self.next_due += (late_periods + 1) * self.period
+        self.num_periods += 1 + late_periods
+        return
+
+    def check(self):
+        time_now = self.clock()
+        if time_now < self.next_due:
+            return self.next_due - time_now
+        lateness = time_now - self.next_due
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self._schedule_next(time_now)
+        self.last_time = time_now
+        if self.name is not None:
+            if self.notifier is not None:
+                self.notifier.diagnostic("doing %s", self.name)
+            else:
+                print("doing %s" % self.name)
+        self.task()
+        time_done = self.clock()
+        duration = time_done - time_now
+        self.runs += 1
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        self._duration_metric.observe(duration)
+        self._lateness_metric.observe(lateness)
+        if duration > self.period:
+            self.overruns += 1
+            self._overruns_metric.inc()
+        return max(0, self.next_due - time_done)
+
+    def stats(self):
+        return dict(name=self.name, runs=self.runs, overruns=self.overruns, missed_periods=self.missed_periods,
+                    mean_duration=(self.total_duration / self.runs) if self.runs else 0.0,
+                    max_duration=self.max_duration,
+                    mean_lateness=(self.total_lateness / self.runs) if self.runs else 0.0,
+                    max_lateness=self.max_lateness)
+
+
+# =============================================================================
+
+
+class Scheduler(object):
+    """
+    Runs a set of Periodics from one thread, sleeping until the next one is due.
+    Other threads may queue one-off tasks with call_soon, which wakes the scheduler.
+    A task or periodic that raises is reported, and the scheduler carries on with the rest.
+    """
+
+    def __init__(self, clock=time.monotonic, notifier=None):
+        self._clock = clock
+        self._notifier = notifier
+        self._heap = []
+        self._pending = []
+        self._sequence = 0
+        self._running = True
+        self._condition = threading.Condition()
+        return
+
+    def add(self, periodic):
+        with self._condition:
+            self._push(periodic.next_deadline(), periodic)
+            self._condition.notify()
+        return
+
+    def _push(self, deadline, periodic):
+        # sequence number keeps heap ordering away from comparing Periodics
+        self._sequence += 1
+        heapq.heappush(self._heap, (deadline, self._sequence, periodic))
+        return
+
+    def call_soon(self, task):
+        with self._condition:
+            self._pending.append(task)
+            self._condition.notify()
+        return
+
+    def reschedule(self):
+        """
+        re-read every deadline, for when something other than a periodic's own check has moved one
+        """
+        with self._condition:
+            self._heap = [(periodic.next_deadline(), sequence, periodic) for _, sequence, periodic in self._heap]
+            heapq.heapify(self._heap)
+            self._condition.notify()
+        return
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        return
+
+    def _wait(self):
+        with self._condition:
+            while self._running and not self._pending:
+                # an AdaptivePoll with no devices has an infinite deadline, which Condition.wait can't take
+                if self._heap and not math.isinf(self._heap[0][0]):
+                    delay = self._heap[0][0] - self._clock()
+                    if delay <= 0:
+                        break
                 else:
-                    print("doing %s" % self.name)
-            self.task()
-            return time_left
-        return time_left
+                    delay = None
+                self._condition.wait(delay)
+            tasks = self._pending
+            self._pending = []
+            return tasks
+
+    def _due(self):
+        with self._condition:
+            due = []
+            time_now = self._clock()
+            while self._heap and self._heap[0][0] <= time_now:
+                due.append(heapq.heappop(self._heap)[2])
+            return due
+
+    def _call(self, callback, name):
+        try:
+            callback()
+        except Exception as e:
+            if self._notifier is not None:
+                self._notifier.error("%s failed: %s: %s", name, type(e).__name__, str(e))
+                self._notifier.diagnostic("%s", traceback.format_exc())
+            else:
+                traceback.print_exc()
+        return
+
+    def run(self):
+        while self._running:
+            tasks = self._wait()
+            for task in tasks:
+                self._call(task, "queued task")
+            if tasks:
+                # a task may have brought a deadline forward (a device added to a poll, say)
+                self.reschedule()
+            for periodic in self._due():
+                self._call(periodic.check, getattr(periodic, "name", None) or type(periodic).__name__)
+                with self._condition:
+                    self._push(periodic.next_deadline(), periodic)
+        return
 
 
 # =============================================================================
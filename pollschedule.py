@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Poll Schedule module - adaptive per-device polling intervals
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import heapq
+import time
+
+import metrics
+
+
+DEFAULT_BACKOFF = 2.0
+
+
+# =============================================================================
+
+
+class AdaptiveInterval(object):
+    """
+    Polling interval for one device.  Drops to the minimum whenever the device changes state, then backs off
+    exponentially while it stays put, up to a cap.  Absent devices may have a lower cap so arrivals are still
+    noticed quickly.
+    """
+
+    __slots__ = ("min_interval", "max_interval", "absent_max_interval", "backoff", "interval", "next_due")
+
+    def __init__(self, min_interval, max_interval=None, absent_max_interval=None, backoff=DEFAULT_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max_interval if max_interval is not None else min_interval
+        self.absent_max_interval = absent_max_interval if absent_max_interval is not None else self.max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.next_due = 0.0
+        return
+
+    def record(self, time_now, state, changed):
+        if changed:
+            self.interval = self.min_interval
+        else:
+            cap = self.max_interval if state else self.absent_max_interval
+            self.interval = min(self.interval * self.backoff, cap)
+        self.next_due = time_now + self.interval
+        return
+
+
+# =============================================================================
+
+
+class AdaptivePoll(object):
+    """
+    Polls each device when its own interval comes due.  Presents the same check/next_deadline interface as
+    periodic.Periodic, so a periodic.Scheduler can run it.
+
+    task is called with the names of the due devices and returns a dictionary of name -> (state, changed).
+    """
+
+    def __init__(self, task, name=None, notifier=None, clock=time.monotonic):
+        self.task = task
+        self.name = name
+        self.notifier = notifier
+        self.clock = clock
+        self._intervals = {}
+        self._heap = []
+        self._duration_metric = metrics.REGISTRY.histogram("periodic_duration_seconds", "time taken by each run",
+                                                           task=name)
+        return
+
+    def add(self, device_name, interval):
+        interval.next_due = self.clock()
+        self._intervals[device_name] = interval
+        heapq.heappush(self._heap, (interval.next_due, device_name))
+        return
+
+    def remove(self, device_name):
+        # its heap entry is discarded when it comes due
+        self._intervals.pop(device_name, None)
+        return
+
+    def interval(self, device_name):
+        return self._intervals[device_name].interval
+
+    def next_deadline(self):
+        """
+        :return: when the next device is due, or infinity when there are none
+        """
+        return self._heap[0][0] if self._heap else float("inf")
+
+    def check(self):
+        time_now = self.clock()
+        due = []
+        due_set = set()  # due stays a list, to poll in deadline order
+        while self._heap and self._heap[0][0] <= time_now:
+            next_due, device_name = heapq.heappop(self._heap)
+            interval = self._intervals.get(device_name)
+            # skip entries left behind by removed (or removed and re-added) devices
+            if interval is not None and interval.next_due == next_due and device_name not in due_set:
+                due.append(device_name)
+                due_set.add(device_name)
+        if due:
+            if self.name is not None and self.notifier is not None:
+                self.notifier.diagnostic("doing %s: %s", self.name, due)
+            results = {}
+            try:
+                results = self.task(due)
+            finally:
+                # rescheduled even if the task failed, or these devices would never be polled again
+                time_done = self.clock()
+                self._duration_metric.observe(time_done - time_now)
+                for device_name in due:
+                    state, changed = results.get(device_name, (False, False))
+                    interval = self._intervals[device_name]
+                    interval.record(time_done, state, changed)
+                    heapq.heappush(self._heap, (interval.next_due, device_name))
+        return max(0, self.next_deadline() - self.clock())
+
+
+# =============================================================================
+
+
+def intervals_for_types(settings, default_period):
+    """
+    :param settings: dictionary of device type -> dict(min=, max=, absent_max=, backoff=)
+    :param default_period: fixed interval for types without settings
+    :return: function mapping a device type to a fresh AdaptiveInterval
+    """
+    def make_interval(device_type):
+        if device_type not in settings:
+            return AdaptiveInterval(default_period)
+        this_setting = settings[device_type]
+        return AdaptiveInterval(this_setting.get("min", default_period), this_setting.get("max"),
+                                this_setting.get("absent_max"), this_setting.get("backoff", DEFAULT_BACKOFF))
+    return make_interval
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("PollSchedule start")
+
+    class FakeClock(object):
+        def __init__(self):
+            self.now = 0.0
+            return
+
+        def __call__(self):
+            return self.now
+
+    the_clock = FakeClock()
+    probes = {"phone": 0, "tv": 0}
+    states = {"phone": True, "tv": True}
+
+    def fake_poll(names):
+        results = {}
+        for this_name in names:
+            probes[this_name] += 1
+            # the phone leaves at 600 sec, the tv never changes
+            state = (the_clock.now < 600) if this_name == "phone" else True
+            results[this_name] = (state, state != states[this_name])
+            states[this_name] = state
+        return results
+
+    poll = AdaptivePoll(fake_poll, clock=the_clock)
+    make = intervals_for_types({"mobile": dict(min=5, max=60, absent_max=15)}, 15)
+    poll.add("phone", make("mobile"))
+    poll.add("tv", AdaptiveInterval(15, 300))
+    while the_clock.now < 3600:
+        the_clock.now += poll.check() or 1
+    print("probes in an hour: %s (fixed 15 sec polling would be 240 each)" % probes)
+    print("PollSchedule end")
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Probe pool module - presence sweeps spread over worker processes
+
+Probing (pyping's packet handling above all) is CPU work done under the GIL, so with every probe on threads of
+one process, a 4 core Pi sweeps on one core.  Here each worker process runs its own probe set and threaded sweeper
+over a share of the devices.  Requests and results cross pipes as compact binary messages: a request is the time
+the worker has and the addresses and device types of its share, and the results one bit per device.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import random
+import signal
+import struct
+import time
+
+import metrics
+from probes import ProbeSet, unavailable_probes
+from sweeper import SWEEP_GRACE, Sweeper
+
+
+# job id and number of devices, at the head of every request and result
+HEADER = struct.Struct("!IH")
+# seconds the worker has to answer, following the header of a request
+BUDGET = struct.Struct("!f")
+TEXT_LENGTH = struct.Struct("!B")
+
+
+# =============================================================================
+
+
+def _pack_text(text):
+    data = text.encode("utf-8")
+    return TEXT_LENGTH.pack(len(data)) + data
+
+
+def encode_request(job_id, targets, budget):
+    """
+    :param targets: list of (address, device type)
+    :param budget: seconds the worker has to answer
+    """
+    parts = [HEADER.pack(job_id, len(targets)), BUDGET.pack(budget)]
+    for address, device_type in targets:
+        parts.append(_pack_text(address))
+        parts.append(_pack_text(device_type))
+    return b"".join(parts)
+
+
+def decode_request(data):
+    """
+    :return: (job id, list of (address, device type), budget)
+    """
+    job_id, count = HEADER.unpack_from(data)
+    budget = BUDGET.unpack_from(data, HEADER.size)[0]
+    offset = HEADER.size + BUDGET.size
+    targets = []
+    for _ in range(count):
+        fields = []
+        for _ in range(2):
+            length = data[offset]
+            fields.append(data[offset + 1:offset + 1 + length].decode("utf-8"))
+            offset += 1 + length
+        targets.append(tuple(fields))
+    return job_id, targets, budget
+
+
+def encode_results(job_id, found):
+    """
+    :param found: list of booleans, in request order
+    """
+    bits = 0
+    for idx, this_found in enumerate(found):
+        if this_found:
+            bits |= 1 << idx
+    return HEADER.pack(job_id, len(found)) + bits.to_bytes((len(found) + 7) // 8, "little")
+
+
+def decode_results(data):
+    """
+    :return: (job id, list of booleans)
+    """
+    job_id, count = HEADER.unpack_from(data)
+    bits = int.from_bytes(data[HEADER.size:], "little")
+    return job_id, [bool(bits & (1 << idx)) for idx in range(count)]
+
+
+# =============================================================================
+
+
+def worker_main(connection, max_in_flight, probe_timeout, test, seed):
+    """
+    a worker process - answers sweep requests until the pipe closes
+    """
+    # Ctrl-C is the parent's to handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    probe_set = ProbeSet(test=test, rng=random.Random(seed) if seed is not None else None)
+    sweeper = Sweeper(None, max_in_flight, probe_timeout)
+    while True:
+        try:
+            job_id, targets, budget = decode_request(connection.recv_bytes())
+        except (EOFError, IOError, OSError):
+            break
+        addresses = {}
+        probes = {}
+        for idx, (address, device_type) in enumerate(targets):
+            addresses[idx] = address
+            probes[idx] = probe_set.chain_for(device_type)
+        probe_set.begin_sweep()
+        # answers whatever it has when the budget runs out, so one slow probe doesn't lose the whole share
+        results = sweeper.sweep(addresses, probes, budget)
+        try:
+            connection.send_bytes(encode_results(job_id, [results[idx] for idx in range(len(targets))]))
+        except (IOError, OSError):
+            break
+    sweeper.shutdown()
+    return
+
+
+# =============================================================================
+
+
+class ProcessSweeper(object):
+    """
+    Sweeper look-alike that shares each sweep among worker processes.  Workers are started on first use, and
+    restarted if they die.
+
+    Each worker builds probe chains from device types itself, so sweep takes types rather than probes.  Probe metrics
+    are counted in the workers, and aren't seen by the main process's registry.
+    """
+
+    def __init__(self, processes, max_in_flight=16, probe_timeout=2.0, notifier=None, test=False, seed=None):
+        # spawned rather than forked, as the parent has threads (and their locks) that a fork would copy mid-use
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [None] * processes
+        self._in_flight = max(1, -(-max_in_flight // processes))
+        self._probe_timeout = probe_timeout
+        self._notifier = notifier
+        self._test = test
+        self._seed = seed
+        self._job_id = 0
+        self._duration_metric = metrics.REGISTRY.histogram("sweep_duration_seconds", "time taken by each sweep")
+        self._targets_metric = metrics.REGISTRY.gauge("sweep_targets", "devices in the last sweep")
+        self._timeouts_metric = metrics.REGISTRY.counter("sweep_timeouts_total", "probes abandoned at the deadline")
+        self._restarts_metric = metrics.REGISTRY.counter("probe_worker_restarts_total", "probe workers (re)started")
+        if not test:
+            # the workers leave out the same probes, but have no notifier to say so
+            unavailable_probes(notifier)
+        return
+
+    def _worker(self, idx):
+        """
+        :return: the pipe to worker idx, starting it if need be
+        """
+        worker = self._workers[idx]
+        if worker is not None and worker[0].is_alive():
+            return worker[1]
+        if worker is not None:
+            worker[1].close()
+            if self._notifier is not None:
+                self._notifier.warning("probe worker %d died, restarting it", idx)
+        connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=worker_main, name="probe_worker%d" % idx, args=(
+            child_connection, self._in_flight, self._probe_timeout, self._test,
+            self._seed + idx if self._seed is not None else None))
+        process.daemon = True
+        process.start()
+        child_connection.close()
+        self._workers[idx] = (process, connection)
+        self._restarts_metric.inc()
+        return connection
+
+    def sweep(self, targets, device_types):
+        """
+        probe every target, the work shared among the workers
+
+        :param targets: dictionary of name -> address
+        :param device_types: dictionary of name -> manifest device type, which decides the probes used
+        :return: dictionary of name -> found
+        """
+        start = time.time()
+        self._job_id = (self._job_id + 1) % (1 << 32)
+        names = list(targets)
+        shares = [names[idx::len(self._workers)] for idx in range(len(self._workers))]
+        # as for Sweeper, allow one timeout per "wave" of probes queued in a worker - the workers answer by
+        # worker_deadline, and the extra grace is for their answers to come back
+        waves = max(1, -(-max(len(share) for share in shares) // self._in_flight)) if names else 1
+        worker_deadline = start + (waves * self._probe_timeout) + SWEEP_GRACE
+        deadline = worker_deadline + SWEEP_GRACE
+        pending = {}
+        results = {}
+        for idx, share in enumerate(shares):
+            if not share:
+                continue
+            connection = self._worker(idx)
+            try:
+                connection.send_bytes(encode_request(self._job_id, [(targets[name], device_types[name])
+                                                                    for name in share],
+                                                     max(0.0, worker_deadline - time.time())))
+                pending[connection] = share
+            except (IOError, OSError):
+                results.update((name, False) for name in share)
+        while pending and time.time() < deadline:
+            for connection in multiprocessing.connection.wait(list(pending), max(0, deadline - time.time())):
+                try:
+                    job_id, found = decode_results(connection.recv_bytes())
+                except (EOFError, IOError, OSError):
+                    # worker died mid-sweep - restarted next sweep
+                    results.update((name, False) for name in pending.pop(connection))
+                    continue
+                if job_id != self._job_id:
+                    continue  # a late answer to an earlier sweep
+                results.update(zip(pending.pop(connection), found))
+        for share in pending.values():
+            if self._notifier is not None:
+                self._notifier.warning("probes of %s timed out", share)
+            self._timeouts_metric.inc(len(share))
+            results.update((name, False) for name in share)
+        self._duration_metric.observe(time.time() - start)
+        self._targets_metric.set(len(targets))
+        return results
+
+    def shutdown(self):
+        for worker in self._workers:
+            if worker is not None:
+                # closing the pipe ends the worker's loop
+                worker[1].close()
+                worker[0].join(1.0)
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Probe pool start")
+    NUM_DEVICES = 2000
+    the_targets = dict(("device%d" % idx, "10.0.%d.%d" % (idx // 250, idx % 250)) for idx in range(NUM_DEVICES))
+    the_types = dict((name, "mobile") for name in the_targets)
+    the_probe_set = ProbeSet(test=True, rng=random.Random(1))
+    the_probes = dict((name, the_probe_set.chain_for("mobile")) for name in the_targets)
+    thread_sweeper = Sweeper(None, 16)
+    start = time.time()
+    thread_sweeper.sweep(the_targets, the_probes)
+    print("threads: %d devices in %4.3f sec" % (NUM_DEVICES, time.time() - start))
+    thread_sweeper.shutdown()
+    process_sweeper = ProcessSweeper(4, 16, test=True, seed=1)
+    process_sweeper.sweep(dict(list(the_targets.items())[:4]), the_types)  # start the workers
+    start = time.time()
+    the_found = process_sweeper.sweep(the_targets, the_types)
+    print("4 processes: %d devices in %4.3f sec, %d found" % (NUM_DEVICES, time.time() - start,
+                                                               sum(the_found.values())))
+    the_share = list(the_targets.items())[:NUM_DEVICES // 4]
+    print("per worker: %d byte request, %d byte result for %d devices" % (
+        len(encode_request(1, [(address, "mobile") for _, address in the_share], 2.0)),
+        len(encode_results(1, [True] * len(the_share))), len(the_share)))
+    process_sweeper.shutdown()
+    print("Probe pool end")
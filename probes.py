@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Probes module - pluggable presence probes
+
+Each probe answers True (present), False (absent) or None (can't tell, try the next probe).  Probes for a device
+are tried cheapest first.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import errno
+import random
+import shutil
+import socket
+import subprocess
+import time
+
+import metrics
+
+
+# the kernel's neighbour table, with each entry's state - /proc/net/arp can't tell a fresh entry from a stale one
+NEIGHBOUR_COMMAND = ["ip", "-4", "neigh", "show"]
+NEIGHBOUR_REACHABLE = "REACHABLE"
+
+# pyping sends this many echo requests per probe
+PING_COUNT = 3
+
+
+# =============================================================================
+
+
+class Probe(object):
+    cost = 0
+
+    def begin_sweep(self):
+        """
+        called once before each sweep so bulk probes can gather everything up front
+        """
+        return
+
+    def probe(self, address, timeout):
+        raise NotImplementedError()
+
+
+# =============================================================================
+
+
+class ArpProbe(Probe):
+    """
+    Passive probe - reads the kernel's neighbour table once per sweep and answers for every device in it.
+    Only a reachable entry (confirmed within the last half minute or so) counts as present.  Anything else - stale
+    entries above all, which Linux keeps indefinitely on a small network - is left to the next probe, whose traffic
+    is what moves the entry on.
+    """
+
+    cost = 1
+
+    def __init__(self, command=NEIGHBOUR_COMMAND):
+        self._command = command
+        self._reachable = frozenset()
+        return
+
+    @staticmethod
+    def available():
+        return shutil.which(NEIGHBOUR_COMMAND[0]) is not None
+
+    def begin_sweep(self):
+        reachable = set()
+        try:
+            output = subprocess.run(self._command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=5.0,
+                                    check=True).stdout.decode("utf-8", "replace")
+            for line in output.splitlines():
+                # e.g. 192.168.1.230 dev wlan0 lladdr 3c:22:fb:00:00:01 REACHABLE
+                fields = line.split()
+                if len(fields) >= 2 and fields[-1] == NEIGHBOUR_REACHABLE:
+                    reachable.add(fields[0])
+        except (IOError, OSError, subprocess.SubprocessError):
+            pass
+        self._reachable = frozenset(reachable)
+        return
+
+    def probe(self, address, timeout):
+        if address in self._reachable:
+            return True
+        return None
+
+
+# =============================================================================
+
+
+class TcpProbe(Probe):
+    """
+    Connects to well-known ports.  A refused connection still proves the host is up.
+    """
+
+    cost = 2
+
+    def __init__(self, ports):
+        self._ports = ports
+        return
+
+    def probe(self, address, timeout):
+        for port in self._ports:
+            try:
+                connection = socket.create_connection((address, port), timeout / max(1, len(self._ports)))
+                connection.close()
+                return True
+            except socket.timeout:
+                continue
+            except (IOError, OSError) as e:
+                if e.errno == errno.ECONNREFUSED:
+                    return True
+                continue
+        return None
+
+
+# =============================================================================
+
+
+class IcmpProbe(Probe):
+    """
+    ICMP echo via pyping.  Requires root access.
+    """
+
+    cost = 3
+
+    @staticmethod
+    def available():
+        """
+        :return: None if pyping can be used, else why not
+        """
+        try:
+            import pyping
+        except Exception as e:
+            return str(e)
+        return None
+
+    def __init__(self):
+        import pyping
+        self._pyping = pyping
+        return
+
+    def probe(self, address, timeout):
+        response = self._pyping.ping(address, timeout=int(timeout * 1000 / PING_COUNT), count=PING_COUNT)
+        return response.ret_code == 0
+
+
+# =============================================================================
+
+
+class FakeProbe(Probe):
+    """
+    Random answers for development without root access
+    """
+
+    def __init__(self, rng=None):
+        self._rng = rng if rng is not None else random
+        return
+
+    def probe(self, address, timeout):
+        return self._rng.randint(0, 3) == 3
+
+
+# =============================================================================
+
+
+class ProbeChain(object):
+    """
+    tries each probe in cost order until one gives an answer, within one timeout for the lot
+    """
+
+    def __init__(self, probes):
+        self.probes = sorted(probes, key=lambda this_probe: this_probe.cost)
+        self._metrics = []
+        for this_probe in self.probes:
+            probe_name = type(this_probe).__name__
+            self._metrics.append((
+                metrics.REGISTRY.histogram("probe_duration_seconds", "time taken by each probe", probe=probe_name),
+                dict((found, metrics.REGISTRY.counter("probe_results_total", "probe answers", probe=probe_name,
+                                                      result=result))
+                     for found, result in ((True, "present"), (False, "absent"), (None, "unknown")))))
+        return
+
+    def __call__(self, address, timeout):
+        # the whole chain has timeout seconds, so it finishes within the sweep's deadline; each probe gets what's left
+        deadline = time.monotonic() + timeout
+        for this_probe, (duration_metric, results_metric) in zip(self.probes, self._metrics):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with duration_metric.time():
+                found = this_probe.probe(address, remaining)
+            results_metric[found].inc()
+            if found is not None:
+                return found
+        return False
+
+
+# =============================================================================
+
+
+# probes to use for each manifest device type, by name
+PROBES_BY_TYPE = {
+    "mobile": ["arp", "tcp", "icmp"],
+    "samsungtv": ["arp", "tcp", "icmp"],
+}
+DEFAULT_PROBES = ["arp", "icmp"]
+
+# ports worth knocking on for each manifest device type
+TCP_PORTS_BY_TYPE = {
+    "mobile": [62078],  # iOS lockdown
+    "samsungtv": [8001, 8002],  # Samsung remote control API
+}
+
+
+def unavailable_probes(notifier=None):
+    """
+    :return: set of names of the probes that can't work here, each reported through notifier
+    """
+    unavailable = set()
+    if not ArpProbe.available():
+        unavailable.add("arp")
+        if notifier is not None:
+            notifier.warning("no %s command, so no ARP probes", NEIGHBOUR_COMMAND[0])
+    reason = IcmpProbe.available()
+    if reason is not None:
+        unavailable.add("icmp")
+        if notifier is not None:
+            notifier.warning("can't use pyping, so no ICMP probes: %s", reason)
+    return unavailable
+
+
+class ProbeSet(object):
+    """
+    Shares probe instances between devices, so bulk probes only gather once per sweep.  Probes that can't work here
+    (no pyping, say) are found out up front, reported once, and left out of every chain.
+    """
+
+    def __init__(self, test=False, rng=None, notifier=None):
+        """
+        :param rng: random.Random for the fake probes, to make test runs repeatable
+        """
+        self._test = test
+        self._rng = rng
+        self._shared = {}
+        self._chains = {}
+        self._unavailable = unavailable_probes(notifier) if not test else set()
+        return
+
+    def _shared_probe(self, key, constructor):
+        if key not in self._shared:
+            self._shared[key] = constructor()
+        return self._shared[key]
+
+    def _make_probe(self, probe_name, device_type):
+        if probe_name in self._unavailable:
+            return None
+        elif probe_name == "arp":
+            return self._shared_probe("arp", ArpProbe)
+        elif probe_name == "tcp":
+            ports = TCP_PORTS_BY_TYPE.get(device_type)
+            if not ports:
+                return None
+            return self._shared_probe("tcp:%s" % device_type, lambda: TcpProbe(ports))
+        elif probe_name == "icmp":
+            return self._shared_probe("icmp", IcmpProbe)
+        raise KeyError("unknown probe: %s" % probe_name)
+
+    def chain_for(self, device_type):
+        if device_type not in self._chains:
+            if self._test:
+                probes = [self._shared_probe("fake", lambda: FakeProbe(self._rng))]
+            else:
+                probes = [self._make_probe(probe_name, device_type)
+                          for probe_name in PROBES_BY_TYPE.get(device_type, DEFAULT_PROBES)]
+            self._chains[device_type] = ProbeChain([this_probe for this_probe in probes if this_probe is not None])
+        return self._chains[device_type]
+
+    def begin_sweep(self):
+        for this_probe in list(self._shared.values()):
+            this_probe.begin_sweep()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Probes start")
+    arp = ArpProbe()
+    arp.begin_sweep()
+    # no ICMP here, so the demo doesn't need root
+    chain = ProbeChain([TcpProbe([22, 80]), arp])
+    print("chain: %s" % [this_probe.__class__.__name__ for this_probe in chain.probes])
+    for the_address in ["127.0.0.1", "192.0.2.1"]:
+        print("%s present: %s" % (the_address, chain(the_address, 1.0)))
+    print("Probes end")
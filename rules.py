@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Rules module - compiles rules.json into predicates
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import hashlib
+import heapq
+import json
+import random
+import time
+
+import metrics
+
+
+DAYS_OF_WEEK = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+# =============================================================================
+
+
+class RuleError(Exception):
+    pass
+
+
+# =============================================================================
+
+
+class RuleContext(object):
+    """
+    everything a predicate may look at during one evaluation pass
+    """
+
+    def __init__(self, roll_call, now=None, active=None, history=None):
+        """
+        :param history: optional history.PresenceHistory, letting "continuously" see state held before this pass
+        """
+        self.roll_call = roll_call
+        self.active = active if active is not None else roll_call
+        self.history = history
+        self.now = now if now is not None else time.time()
+        self.local = time.localtime(self.now)
+        return
+
+
+# =============================================================================
+
+
+def _tod(hhmm):
+    hours, minutes = divmod(int(hhmm), 100)
+    if hours > 23 or minutes > 59:
+        raise RuleError("bad time of day: %s" % hhmm)
+    return (hours * 60) + minutes
+
+
+def _local_time(time_now, day_offset, minute):
+    """
+    :return: the epoch time of minute past local midnight, day_offset days after time_now's date
+    """
+    local = time.localtime(time_now)
+    hours, minutes = divmod(minute, 60)
+    return time.mktime((local.tm_year, local.tm_mon, local.tm_mday + day_offset, hours, minutes, 0, 0, 0, -1))
+
+
+def _utc_offset_change(begin, end):
+    """
+    :return: when the local UTC offset (i.e. DST) changes in (begin, end], to the second, or None if it doesn't
+    """
+    offset = time.localtime(begin).tm_gmtoff
+    if time.localtime(end).tm_gmtoff == offset:
+        return None
+    while end - begin > 1:
+        middle = (begin + end) / 2.0
+        if time.localtime(middle).tm_gmtoff == offset:
+            begin = middle
+        else:
+            end = middle
+    return end
+
+
+def _next_boundary(time_now, boundary):
+    # times of day shift at a DST change, so that is a boundary too
+    change = _utc_offset_change(time_now, boundary)
+    return change if change is not None else boundary
+
+
+def _compile_devices(clause):
+    condition = clause.get("condition")
+    if condition == "present":
+        lookup = "roll_call"
+    elif condition == "active":
+        lookup = "active"
+    else:
+        raise RuleError("unknown condition: %s" % condition)
+    devices = tuple(clause.get("devices", []))
+    if not devices:
+        raise RuleError("%s clause has no devices" % condition)
+    negate = (clause.get("modifier") == "not")
+    selection = clause.get("selection", "any")
+    if selection == "any":
+        selector = any
+    elif selection == "all":
+        selector = all
+    else:
+        raise RuleError("unknown selection: %s" % selection)
+
+    def predicate(ctx):
+        states = getattr(ctx, lookup)
+        return selector((bool(states.get(name, False)) != negate) for name in devices)
+    return predicate, devices
+
+
+def _compile_tod(clause):
+    begin = _tod(clause["tod_begin"])
+    end = _tod(clause["tod_end"])
+    if begin <= end:
+        def predicate(ctx):
+            minute = (ctx.local.tm_hour * 60) + ctx.local.tm_min
+            return begin <= minute < end
+    else:
+        # window wraps past midnight
+        def predicate(ctx):
+            minute = (ctx.local.tm_hour * 60) + ctx.local.tm_min
+            return minute >= begin or minute < end
+
+    def next_boundary(time_now):
+        if begin == end:
+            return None
+        for day_offset in range(3):
+            candidates = [boundary for boundary in (_local_time(time_now, day_offset, begin),
+                                                    _local_time(time_now, day_offset, end)) if boundary > time_now]
+            if candidates:
+                return _next_boundary(time_now, min(candidates))
+        return None
+    return predicate, next_boundary
+
+
+def _compile_days(clause):
+    try:
+        days = frozenset(DAYS_OF_WEEK.index(day.lower()[:3]) for day in clause["days_of_week"])
+    except ValueError:
+        raise RuleError("bad days_of_week: %s" % clause["days_of_week"])
+
+    def predicate(ctx):
+        return ctx.local.tm_wday in days
+
+    def next_boundary(time_now):
+        today = time.localtime(time_now).tm_wday
+        for day_offset in range(1, 8):
+            if (((today + day_offset) % 7) in days) != (today in days):
+                # mktime already puts midnight on the right side of any DST change
+                return _local_time(time_now, day_offset, 0)
+        return None
+    return predicate, next_boundary
+
+
+def _compile_continuously(lhs, seconds, devices=None):
+    """
+    :param devices: if lhs depends only on these devices' presence, the history can vouch for how long it has held
+    """
+    state = {"since": None}
+
+    def predicate(ctx):
+        if not lhs(ctx):
+            state["since"] = None
+            return False
+        if state["since"] is None:
+            state["since"] = ctx.now
+        held = ctx.now - state["since"]
+        if devices and ctx.history is not None:
+            # lhs can't have changed while none of its devices did
+            held = max(held, ctx.history.unchanged_for(devices))
+        return held >= seconds
+    return predicate
+
+
+def _join(join, lhs, rhs):
+    # both sides are always evaluated so stateful clauses see every pass
+    if join == "and":
+        def predicate(ctx):
+            left = lhs(ctx)
+            right = rhs(ctx)
+            return left and right
+    elif join == "or":
+        def predicate(ctx):
+            left = lhs(ctx)
+            right = rhs(ctx)
+            return left or right
+    else:
+        raise RuleError("unknown join: %s" % join)
+    return predicate
+
+
+# =============================================================================
+
+
+class CompiledRule(object):
+    """
+    a single rules.json entry, resolved into one predicate closure
+    """
+
+    def __init__(self, entry):
+        if not isinstance(entry, dict):
+            raise RuleError("rule isn't an object: %s" % entry)
+        self.source = json.dumps(entry, sort_keys=True)
+        self.event = entry.get("event", entry.get("action"))
+        if self.event is None:
+            raise RuleError("rule has no event: %s" % entry)
+        self.devices = set()
+        self.timed = False
+        self.boundaries = []
+        self.predicate = self._compile(entry.get("rules", []))
+        self.last_status = False
+        return
+
+    def _compile(self, clauses):
+        predicate = None
+        join = None
+        presence_only = True
+        if not isinstance(clauses, list):
+            raise RuleError("%s: rules isn't a list: %s" % (self.event, clauses))
+        for clause in clauses:
+            try:
+                predicate, join, presence_only = self._compile_clause(clause, predicate, join, presence_only)
+            except RuleError as e:
+                raise RuleError("%s: %s" % (self.event, str(e)))
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                # a missing or mistyped field - tod_begin without tod_end, say
+                raise RuleError("%s: bad clause %s: %s %s" % (self.event, clause, type(e).__name__, str(e)))
+        if predicate is None:
+            raise RuleError("%s has no clauses" % self.event)
+        return predicate
+
+    def _compile_clause(self, clause, predicate, join, presence_only):
+        """
+        :return: (predicate, join, presence_only) with clause added
+        """
+        if not isinstance(clause, dict):
+            raise RuleError("clause isn't an object: %s" % clause)
+        if "join" in clause:
+            return predicate, clause["join"], presence_only
+        if "continuously" in clause:
+            if predicate is None:
+                raise RuleError("continuously has nothing to qualify")
+            rhs = _compile_continuously(predicate, float(clause["continuously"]),
+                                        tuple(sorted(self.devices)) if presence_only else None)
+            presence_only = False
+            self.timed = True
+        elif "devices" in clause:
+            rhs, devices = _compile_devices(clause)
+            self.devices.update(devices)
+            presence_only = presence_only and clause.get("condition") == "present"
+        elif "tod_begin" in clause or "tod_end" in clause:
+            rhs, next_boundary = _compile_tod(clause)
+            presence_only = False
+            self.boundaries.append(next_boundary)
+        elif "days_of_week" in clause:
+            rhs, next_boundary = _compile_days(clause)
+            presence_only = False
+            self.boundaries.append(next_boundary)
+        else:
+            raise RuleError("unknown clause %s" % clause)
+        predicate = rhs if predicate is None else _join(join or "and", predicate, rhs)
+        return predicate, None, presence_only
+
+    def next_boundary(self, time_now):
+        """
+        :return: the next (epoch) time a time of day or day of week clause changes value, or None
+        """
+        boundaries = [boundary for boundary in (next_boundary(time_now) for next_boundary in self.boundaries)
+                      if boundary is not None]
+        return min(boundaries) if boundaries else None
+
+    def evaluate(self, ctx):
+        status = bool(self.predicate(ctx))
+        fired = status and not self.last_status
+        self.last_status = status
+        return fired
+
+
+# =============================================================================
+
+
+class RuleBook(object):
+    """
+    compiled rules with a reverse index from device name to the rules that mention it
+
+    Rules with time of day or day of week clauses are kept in a heap by the next time one of those clauses changes
+    value, and are only re-evaluated (for the clock's sake) once that time has passed.
+    """
+
+    def __init__(self, entries, previous=None):
+        """
+        :param previous: an earlier RuleBook whose unchanged rules (and their state) are carried over
+        """
+        reusable = {}
+        if previous is not None:
+            reusable = dict((rule.source, rule) for rule in previous.rules)
+        self.rules = []
+        for entry in entries:
+            rule = reusable.pop(json.dumps(entry, sort_keys=True), None)
+            self.rules.append(rule if rule is not None else CompiledRule(entry))
+        self.by_device = {}
+        self.timed = []
+        self.calendar = []
+        for idx, rule in enumerate(self.rules):
+            for name in rule.devices:
+                self.by_device.setdefault(name, []).append(idx)
+            if rule.timed:
+                self.timed.append(idx)
+            if rule.boundaries:
+                self.calendar.append(idx)
+        # (boundary time, rule index), built by the first evaluation
+        self._boundaries = None
+        self._evaluations_metric = metrics.REGISTRY.counter("rule_evaluations_total", "rules evaluated")
+        self._fired_metric = metrics.REGISTRY.counter("rule_events_total", "rules that became satisfied")
+        return
+
+    def affected(self, changed, due=()):
+        """
+        :param changed: names of devices whose state changed, or None for everything
+        :param due: indices of rules whose time boundary has passed
+        :return: the rules needing re-evaluation, in rules.json order
+        """
+        if changed is None:
+            return self.rules
+        selected = set(self.timed)
+        selected.update(due)
+        for name in changed:
+            selected.update(self.by_device.get(name, ()))
+        return [self.rules[idx] for idx in sorted(selected)]
+
+    def _due(self, time_now):
+        due = []
+        while self._boundaries and self._boundaries[0][0] <= time_now:
+            due.append(heapq.heappop(self._boundaries)[1])
+        return due
+
+    def _schedule(self, indices, time_now):
+        for idx in indices:
+            boundary = self.rules[idx].next_boundary(time_now)
+            if boundary is not None:
+                heapq.heappush(self._boundaries, (boundary, idx))
+        return
+
+    @staticmethod
+    def _key(rule):
+        # short but stable across restarts, unlike the rule's position
+        return hashlib.sha1(rule.source.encode("utf-8")).hexdigest()[:16]
+
+    def statuses(self):
+        """
+        :return: dictionary of rule key -> whether it was satisfied when last evaluated
+        """
+        return dict((self._key(rule), rule.last_status) for rule in self.rules)
+
+    def restore_statuses(self, statuses):
+        """
+        carry over saved statuses, so rules already satisfied before a restart don't fire again
+        """
+        for rule in self.rules:
+            key = self._key(rule)
+            if key in statuses:
+                rule.last_status = bool(statuses[key])
+        return
+
+    def next_boundary(self):
+        """
+        :return: the (epoch) time the next time-based rule needs re-evaluating, or None
+        """
+        if self._boundaries is None:
+            return None
+        return self._boundaries[0][0] if self._boundaries else None
+
+    def evaluate(self, ctx, changed=None):
+        """
+        :return: events whose rules have just become satisfied
+        """
+        if self._boundaries is None:
+            self._boundaries = []
+            due = self.calendar
+        else:
+            due = self._due(ctx.now)
+        events = []
+        rules = self.affected(changed, due)
+        for rule in rules:
+            if rule.evaluate(ctx):
+                events.append(rule.event)
+        self._schedule(due, ctx.now)
+        self._evaluations_metric.inc(len(rules))
+        self._fired_metric.inc(len(events))
+        return events
+
+
+# =============================================================================
+
+
+def synthetic_rules(num_rules, num_devices, rng):
+    entries = []
+    for idx in range(num_rules):
+        devices = ["device%d" % rng.randrange(num_devices) for _ in range(rng.randint(1, 4))]
+        clauses = [dict(condition=rng.choice(["present", "active"]), devices=devices,
+                        selection=rng.choice(["any", "all"]))]
+        if rng.random() < 0.3:
+            clauses.append(dict(join=rng.choice(["and", "or"])))
+            clauses.append(dict(tod_begin=rng.choice([300, 1800]), tod_end=rng.choice([300, 2300])))
+        entries.append(dict(event="event%d" % idx, rules=clauses))
+    return entries
+
+
+if __name__ == "__main__":
+    print("Rules start")
+    NUM_RULES = 5000
+    NUM_DEVICES = 500
+    the_rng = random.Random(1)
+    the_entries = synthetic_rules(NUM_RULES, NUM_DEVICES, the_rng)
+    start = time.time()
+    book = RuleBook(the_entries)
+    print("compiled %d rules in %5.3f sec" % (NUM_RULES, time.time() - start))
+    the_roll_call = dict(("device%d" % idx, the_rng.random() < 0.5) for idx in range(NUM_DEVICES))
+    passes = 20
+    start = time.time()
+    for _ in range(passes):
+        book.evaluate(RuleContext(the_roll_call))
+    elapsed = time.time() - start
+    print("full: %d rule evaluations/sec" % ((passes * NUM_RULES) / elapsed))
+    passes = 2000
+    start = time.time()
+    evaluated = 0
+    for _ in range(passes):
+        name = "device%d" % the_rng.randrange(NUM_DEVICES)
+        the_roll_call[name] = not the_roll_call[name]
+        evaluated += len(book.affected([name]))
+        book.evaluate(RuleContext(the_roll_call), [name])
+    elapsed = time.time() - start
+    print("incremental: %d changes/sec, %3.1f rules per change" % (passes / elapsed, evaluated / float(passes)))
+    print("Rules end")
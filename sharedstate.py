@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Shared state module - the roll call and device states, readable from other processes
+
+homer publishes each device's presence, activity and on/off state into a fixed layout, memory mapped file (in
+/dev/shm, so it never touches the SD card).  A display or monitoring tool maps the same file and reads it directly,
+never taking homer's locks or waiting on homer's threads.  A sequence lock keeps reads consistent: the writer makes
+the sequence number odd while it writes and even again when done, and a reader whose read overlapped a write (odd,
+or changed underneath it) simply reads again - for a while, as a writer that died mid-write leaves it odd for good.
+Python has no memory barriers to offer, and on a weakly ordered CPU (the Pi's ARM) a reader could see the
+sequence number settled around rows still being written, so each publish also carries a CRC32 of its contents,
+which the reader checks too.
+
+Layout (little endian): a 64 byte header - magic, layout version, capacity, sequence, version, device count, CRC32
+(of the version, count, publish time and rows), publish time - then capacity rows of device name (32 bytes, UTF-8,
+NUL padded), present, active, on (1, 0, or -1 for unknown) and the time presence last changed (0.0 if unknown).
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import collections
+import mmap
+import os
+import struct
+import time
+import zlib
+
+
+MAGIC = b"HOMR"
+LAYOUT_VERSION = 2
+DEFAULT_CAPACITY = 256
+
+HEADER = struct.Struct("<4sHHQQHxxId")
+CHECKED = struct.Struct("<QHd")
+HEADER_SIZE = 64
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+VERSION_OFFSET = 16
+NAME_LENGTH = 32
+ROW = struct.Struct("<%dsbbb5xd" % NAME_LENGTH)
+
+UNKNOWN = -1
+
+# seconds a reader keeps retrying a read that overlaps writes before giving up - a publish takes microseconds
+SNAPSHOT_TIMEOUT = 0.5
+
+DeviceState = collections.namedtuple("DeviceState", ["present", "active", "on", "since"])
+
+
+# =============================================================================
+
+
+def _tristate(value):
+    return UNKNOWN if value is None else int(bool(value))
+
+
+def _from_tristate(value):
+    return None if value == UNKNOWN else bool(value)
+
+
+def _checksum(version, count, published_at, rows):
+    """
+    :param rows: the packed rows, as bytes or a buffer
+    """
+    return zlib.crc32(rows, zlib.crc32(CHECKED.pack(version, count, published_at)))
+
+
+class StatePublisher(object):
+    """
+    The writer - there must only be one per file.  Call publish from one thread only.
+    """
+
+    def __init__(self, filename, capacity=DEFAULT_CAPACITY, notifier=None):
+        self._filename = filename
+        self._capacity = capacity
+        self._notifier = notifier
+        self._size = HEADER_SIZE + capacity * ROW.size
+        # a fresh file renamed into place, so readers still mapping a previous run's file never see it shrink
+        temp_filename = filename + ".tmp"
+        self._file = open(temp_filename, "w+b")
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        self._sequence = 0
+        self._version = 0
+        self._last_rows = None
+        self._overflowed = False
+        self._map[:HEADER.size] = HEADER.pack(MAGIC, LAYOUT_VERSION, capacity, 0, 0, 0, _checksum(0, 0, 0.0, b""), 0.0)
+        os.rename(temp_filename, filename)
+        return
+
+    def publish(self, presence, active=None, states=None, since=None):
+        """
+        :param presence: the roll call - dictionary of device name -> present
+        :param active: dictionary of device name -> active
+        :param states: dictionary of device name -> on
+        :param since: dictionary of device name -> wall clock time presence last changed
+        :return: True if anything had changed, and so was written
+        """
+        active = active or {}
+        states = states or {}
+        since = since or {}
+        names = sorted(set(presence) | set(active) | set(states))
+        if len(names) > self._capacity:
+            if not self._overflowed and self._notifier is not None:
+                self._notifier.warning("%s only has room for %d of %d devices", self._filename, self._capacity,
+                                       len(names))
+            self._overflowed = True
+            names = names[:self._capacity]
+        rows = [(name.encode("utf-8")[:NAME_LENGTH], _tristate(presence.get(name)), _tristate(active.get(name)),
+                 _tristate(states.get(name)), float(since.get(name) or 0.0)) for name in names]
+        if rows == self._last_rows:
+            return False
+        # odd while writing, so readers know to try again
+        self._sequence += 1
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+        packed = b"".join(ROW.pack(*row) for row in rows)
+        self._map[HEADER_SIZE:HEADER_SIZE + len(packed)] = packed
+        self._version += 1
+        published_at = time.time()
+        HEADER.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION, self._capacity, self._sequence, self._version, len(rows),
+                         _checksum(self._version, len(rows), published_at, packed), published_at)
+        # even again only once everything else is in place
+        self._sequence += 1
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+        self._last_rows = rows
+        return True
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        try:
+            os.remove(self._filename)
+        except (IOError, OSError):
+            pass
+        return
+
+
+# =============================================================================
+
+
+class StateReader(object):
+    """
+    Maps a publisher's file read-only.  Each read copies just the rows in use, and only once.
+
+    A restarted homer publishes to a new file, so a reader that outlives it should reopen the file when the version
+    stops moving, or snapshot gives up.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, layout_version, self.capacity = HEADER.unpack_from(self._map)[:3]
+        if magic != MAGIC or layout_version != LAYOUT_VERSION:
+            self.close()
+            raise ValueError("%s isn't a homer state file (layout %d)" % (filename, LAYOUT_VERSION))
+        self.retries = 0
+        return
+
+    def version(self):
+        """
+        :return: the publish count, cheap enough to poll every frame - re-read only when it changes
+        """
+        return SEQUENCE.unpack_from(self._map, VERSION_OFFSET)[0]
+
+    def snapshot(self, timeout=SNAPSHOT_TIMEOUT):
+        """
+        :param timeout: seconds to keep retrying reads that overlap a write
+        :return: (version, publish time, dictionary of device name -> DeviceState), all from one publish - or None
+            if no consistent read could be had in time (the writer died mid-write, say), when the file should be
+            reopened
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]
+            if not sequence & 1:
+                _, _, _, _, version, count, checksum, published_at = HEADER.unpack_from(self._map)
+                if count <= self.capacity:
+                    # one copy of the rows, so what's unpacked is exactly what was checked
+                    packed = self._map[HEADER_SIZE:HEADER_SIZE + count * ROW.size]
+                    if (_checksum(version, count, published_at, packed) == checksum and
+                            SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0] == sequence):
+                        rows = [ROW.unpack_from(packed, idx * ROW.size) for idx in range(count)]
+                        break
+            # mid-write - let the writer finish
+            self.retries += 1
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0)
+        devices = dict((name.rstrip(b"\0").decode("utf-8", "replace"),
+                        DeviceState(_from_tristate(present), _from_tristate(active), _from_tristate(on),
+                                    since or None))
+                       for name, present, active, on, since in rows)
+        return version, published_at, devices
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Shared state start")
+    import multiprocessing
+    import tempfile
+
+    DURATION = 2.0
+    NUM_DEVICES = 100
+
+    def read_flat_out(filename, duration, queue):
+        """
+        every publish sets all devices alike, so a torn read would show up as a mix
+        """
+        reader = StateReader(filename)
+        reads = torn = 0
+        end = time.time() + duration
+        while time.time() < end:
+            snapshot = reader.snapshot()
+            if snapshot is None:
+                break  # the publisher has gone
+            _, _, devices = snapshot
+            if len(set(device.present for device in devices.values())) > 1:
+                torn += 1
+            reads += 1
+        queue.put((reads, torn, reader.retries))
+        reader.close()
+        return
+
+    the_filename = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "homer_demo.state")
+    publisher = StatePublisher(the_filename)
+    the_names = ["device%d" % idx for idx in range(NUM_DEVICES)]
+    publisher.publish(dict((name, False) for name in the_names))
+    the_queue = multiprocessing.Queue()
+    reader_process = multiprocessing.Process(target=read_flat_out, args=(the_filename, DURATION, the_queue))
+    reader_process.start()
+    publishes = 0
+    start = time.time()
+    while reader_process.is_alive() and time.time() - start < DURATION + 5:
+        publishes += publisher.publish(dict((name, publishes % 2 == 0) for name in the_names))
+    the_reads, the_torn, the_retries = the_queue.get()
+    reader_process.join()
+    print("%d devices: %d publishes/sec, another process read %d snapshots/sec, %d retried, %d torn" % (
+        NUM_DEVICES, publishes / (time.time() - start), the_reads / DURATION, the_retries, the_torn))
+    # a publisher that dies mid-write leaves the sequence odd
+    # noinspection PyProtectedMember
+    SEQUENCE.pack_into(publisher._map, SEQUENCE_OFFSET, 1)
+    the_reader = StateReader(the_filename)
+    start = time.time()
+    print("reading a half written file gave %s after %4.2f sec" % (the_reader.snapshot(), time.time() - start))
+    the_reader.close()
+    publisher.close()
+    print("Shared state end")
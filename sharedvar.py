@@ -9,7 +9,16 @@ Shared Variable module
 www.delaneymorgan.com.au
 """
 
+import array
+import collections
+import random
 import threading
+import time
+from collections.abc import Mapping
+
+
+# how many versions of change history a collection remembers for changes_since
+CHANGE_LOG_LENGTH = 1024
 
 
 # =============================================================================
@@ -43,43 +52,220 @@ class SharedVar(object):
 # =============================================================================
 
 
+class Snapshot(Mapping):
+    """
+    immutable view of a SharedVarCollection at one version
+    """
+
+    def __init__(self, values, version):
+        self._values = values
+        self.version = version
+        return
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(self._values)
+
+
+# =============================================================================
+
+
 class SharedVarCollection(object):
     """
-    thread-safe variable collection
+    thread-safe variable collection, versioned so readers can wait for and fetch just the changes
+
+    Values live in slot-indexed lists behind a single writer lock.  Readers never take the lock for a
+    single value or for an up-to-date published snapshot.
     """
 
+    __slots__ = ("version", "_index", "_names", "_values", "_changed_at", "_condition", "_change_log", "_published",
+                 "_subscribers")
+
     def __init__(self, initial_values):
-        self.collection = {}
+        self.version = 0
+        self._index = {}
+        self._names = []
+        self._values = []
+        self._changed_at = array.array("L")
+        self._condition = threading.Condition()
+        self._change_log = collections.deque(maxlen=CHANGE_LOG_LENGTH)
+        self._published = Snapshot({}, 0)
+        self._subscribers = []
         for this_name, this_value in initial_values.items():
-            self.collection[this_name] = SharedVar(this_value)
+            self._add(this_name, this_value)
         return
 
+    def __len__(self):
+        return len(self._names)
+
     def get(self, name=None):
         if name is not None:
-            return self.collection[name].get()
+            return self._values[self._index[name]]
         else:
-            stats = {}
-            for this_name, this_stat in self.collection.items():
-                stats[this_name] = this_stat.get()
-            return stats
+            return dict(self.snapshot())
+
+    def snapshot(self):
+        snapshot = self._published
+        if snapshot.version == self.version:
+            return snapshot
+        # copy the slots under the lock, but build the dictionary outside it so writers aren't held up
+        with self._condition:
+            if self._published.version == self.version:
+                return self._published
+            version = self.version
+            names = self._names[:]
+            values = self._values[:]
+        snapshot = Snapshot(dict(zip(names, values)), version)
+        with self._condition:
+            if self._published.version < version:
+                self._published = snapshot
+        return snapshot
+
+    def _add(self, name, value):
+        # caller holds self._condition; the value slot exists before the index can point at it
+        self._names.append(name)
+        self._values.append(value)
+        self._changed_at.append(self.version + 1)
+        self._index[name] = len(self._names) - 1
+        return
+
+    def _store(self, name, updater):
+        # caller holds self._condition
+        slot = self._index.get(name)
+        if slot is None:
+            self._add(name, updater(None))
+            return True
+        old_value = self._values[slot]
+        new_value = updater(old_value)
+        if new_value == old_value:
+            return False
+        self._values[slot] = new_value
+        self._changed_at[slot] = self.version + 1
+        return True
+
+    def _modify(self, updaters):
+        with self._condition:
+            changed = [name for name, updater in updaters if self._store(name, updater)]
+            if not changed:
+                return
+            self.version += 1
+            version = self.version
+            self._change_log.append((version, frozenset(changed)))
+            self._condition.notify_all()
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber(version, changed)
+        return
 
     def set(self, name, value):
-        if name not in self.collection:
-            self.collection[name] = SharedVar(value)
-        else:
-            self.collection[name].set(value)
+        self._modify([(name, lambda _: value)])
+        return
+
+    def set_many(self, values):
+        self._modify([(name, (lambda v: lambda _: v)(value)) for name, value in values.items()])
         return
 
     def update(self, name, updater):
-        if name not in self.collection:
-            self.collection[name] = SharedVar(0)
-        self.collection[name].update(updater)
+        self._modify([(name, lambda old: updater(0 if old is None else old))])
+        return
+
+    def changes_since(self, since_version):
+        """
+        :param since_version: a version previously seen by the caller, or None
+        :return: (snapshot, changed names) - changed names is None if since_version is None
+        """
+        with self._condition:
+            snapshot = self.snapshot()
+            if since_version is None:
+                return snapshot, None
+            if since_version == self.version:
+                return snapshot, set()
+            if self._change_log and self._change_log[0][0] <= since_version + 1:
+                changed = set()
+                for version, names in reversed(self._change_log):
+                    if version <= since_version:
+                        break
+                    changed.update(names)
+                return snapshot, changed
+            # history has rolled past since_version, so fall back to the per-slot versions
+            return snapshot, set(name for name, version in zip(self._names, self._changed_at)
+                                 if version > since_version)
+
+    def wait_for_change(self, since_version, timeout=None):
+        """
+        block until the collection moves past since_version
+
+        :return: the current version (unchanged if timed out)
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != since_version, timeout)
+            return self.version
+
+    def subscribe(self, subscriber):
+        """
+        :param subscriber: called as subscriber(version, changed_names) after each change, from the writer's thread
+        """
+        with self._condition:
+            self._subscribers.append(subscriber)
         return
 
 
 # =============================================================================
 
 
+def benchmark(num_keys, num_readers, num_writers, duration):
+    the_collection = SharedVarCollection(dict(("key%d" % idx, 0) for idx in range(num_keys)))
+    counts = SharedVarCollection({})
+    stop = threading.Event()
+
+    def reader(idx):
+        rng = random.Random(idx)
+        gets = snapshots = 0
+        while not stop.is_set():
+            for _ in range(100):
+                the_collection.get("key%d" % rng.randrange(num_keys))
+            gets += 100
+            the_collection.snapshot()
+            snapshots += 1
+        counts.update("gets", lambda x: x + gets)
+        counts.update("snapshots", lambda x: x + snapshots)
+        return
+
+    def writer(idx):
+        rng = random.Random(-idx)
+        sets = 0
+        while not stop.is_set():
+            the_collection.set("key%d" % rng.randrange(num_keys * 2), rng.random())
+            sets += 1
+        counts.update("sets", lambda x: x + sets)
+        return
+
+    threads = [threading.Thread(target=reader, args=(idx,)) for idx in range(num_readers)]
+    threads.extend(threading.Thread(target=writer, args=(idx,)) for idx in range(num_writers))
+    for this_thread in threads:
+        this_thread.start()
+    time.sleep(duration)
+    stop.set()
+    for this_thread in threads:
+        this_thread.join()
+    print("%d keys grew to %d, %d readers, %d writers over %3.1f sec:" % (
+        num_keys, len(the_collection), num_readers, num_writers, duration))
+    for name, total in sorted(counts.get().items()):
+        print("    %10d %s/sec" % (total / duration, name))
+    return
+
+
+# =============================================================================
+
+
 if __name__ == "__main__":
     print("SharedVar start")
     count = SharedVar()
@@ -103,4 +289,10 @@ if __name__ == "__main__":
     print(the_stats.get())
     print(the_stats.get("count"))
     print(the_stats.get("memoryUsage"))
+    the_version = the_stats.version
+    the_stats.set_many(dict(count=5, other=the_stats.get("other")))
+    if the_stats.wait_for_change(the_version, 0) == the_version:
+        print("Error")
+    print(the_stats.changes_since(the_version))
+    benchmark(10000, 8, 4, 2.0)
     print("SharedVar end")
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Simulation module - deterministic, hardware-free runs of the presence -> rules pipeline
+
+A seeded RNG scripts when thousands of synthetic devices (cloned from manifest.json and rules.json) come and go,
+and a virtual clock drives the real polling, history, roll call and rule evaluation code, so a run is repeatable
+and hours of activity take seconds.  The benchmark reports sweep time, rule evaluation throughput and how long
+decisions take, for measuring the hot paths without real hardware.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import random
+import time
+
+import metrics
+from history import PresenceHistory
+from periodic import Periodic
+from pollschedule import AdaptivePoll, intervals_for_types
+from rules import RuleBook, RuleContext
+from sharedvar import SharedVarCollection
+from sweeper import Sweeper
+
+
+# the virtual clock starts at this wall clock time (a Monday morning), so time-based rules behave the same each run
+EPOCH = 1546812000.0
+
+# mean seconds a synthetic device stays, and stays away
+MEAN_PRESENT = 4 * 3600.0
+MEAN_ABSENT = 2 * 3600.0
+
+RULINGS_PERIOD = 5
+DEFAULT_POLL_PERIOD = 15
+
+
+# =============================================================================
+
+
+class VirtualClock(object):
+    """
+    monotonic clock that only moves when told to
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+        return
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, time_now):
+        self.now = max(self.now, time_now)
+        return
+
+    def wall_time(self):
+        return EPOCH + self.now
+
+
+# =============================================================================
+
+
+class World(object):
+    """
+    The simulated truth - when each device is present.  Answers probes as of the virtual clock's time.
+    """
+
+    def __init__(self, script, clock):
+        """
+        :param script: list of (time, device name, present) - devices start absent
+        """
+        self._clock = clock
+        self._changes = {}
+        for change_time, name, present in sorted(script):
+            self._changes.setdefault(name, ([], []))
+            self._changes[name][0].append(change_time)
+            self._changes[name][1].append(bool(present))
+        self.script = sorted(script)
+        return
+
+    @classmethod
+    def random(cls, names, duration, rng, clock, mean_present=MEAN_PRESENT, mean_absent=MEAN_ABSENT):
+        script = []
+        for name in names:
+            change_time = rng.uniform(0, mean_absent)
+            present = True
+            while change_time < duration:
+                script.append((change_time, name, present))
+                change_time += rng.expovariate(1.0 / (mean_present if present else mean_absent))
+                present = not present
+        return cls(script, clock)
+
+    def present(self, name, time_now=None):
+        if time_now is None:
+            time_now = self._clock()
+        times, states = self._changes.get(name, ((), ()))
+        idx = bisect.bisect_right(times, time_now)
+        return states[idx - 1] if idx else False
+
+    def last_change(self, name, time_now=None):
+        """
+        :return: when the device last came or went, or None if it hasn't yet
+        """
+        if time_now is None:
+            time_now = self._clock()
+        times = self._changes.get(name, ((), ()))[0]
+        idx = bisect.bisect_right(times, time_now)
+        return times[idx - 1] if idx else None
+
+    def probe(self, address, timeout):
+        # devices are addressed by name in the simulation
+        return self.present(address)
+
+
+# =============================================================================
+
+
+def synthetic_setup(manifest, rule_entries, copies):
+    """
+    clone the monitored devices and rules copies times over
+
+    :param manifest: device manifest, supplying the device types
+    :param rule_entries: rules.json entries - the devices they mention become the monitored devices
+    :return: (dictionary of device name -> type, list of rule entries)
+    """
+    device_types = {}
+    entries = []
+    for copy in range(copies):
+        for entry in rule_entries:
+            clauses = []
+            for clause in entry.get("rules", []):
+                clause = dict(clause)
+                if "devices" in clause:
+                    clause["devices"] = ["%s_%d" % (name, copy) for name in clause["devices"]]
+                    for name in clause["devices"]:
+                        base_name = name.rsplit("_", 1)[0]
+                        device_types[name] = manifest.get(base_name, {}).get("type", "mobile").lower()
+                clauses.append(clause)
+            entries.append(dict(event="%s_%d" % (entry.get("event", entry.get("action")), copy), rules=clauses))
+    return device_types, entries
+
+
+# =============================================================================
+
+
+class Simulation(object):
+    """
+    The surveyor -> roll call -> judge pipeline, run on a virtual clock.  Same seed, same run.
+    """
+
+    def __init__(self, device_types, rule_entries, world, clock, polling_intervals=None, max_in_flight=16):
+        self._clock = clock
+        self._world = world
+        self._rules = RuleBook(rule_entries)
+        self._roll_call = SharedVarCollection({})
+        self._roll_call_version = None
+        self._history = PresenceHistory(clock=clock)
+        self._sweeper = Sweeper(world.probe, max_in_flight)
+        self._poll = AdaptivePoll(self._poll_devices, "poll_devices", clock=clock)
+        make_interval = intervals_for_types(polling_intervals or {}, DEFAULT_POLL_PERIOD)
+        for name, device_type in sorted(device_types.items()):
+            self._poll.add(name, make_interval(device_type))
+        self._rulings = Periodic(RULINGS_PERIOD, self._make_rulings, clock=clock)
+        self.events = []
+        self.sweep_times = []
+        self.swept = 0
+        self.ruling_times = []
+        self.detection_latencies = []
+        self.decision_times = []
+        return
+
+    def _poll_devices(self, names):
+        start = time.perf_counter()
+        results = self._sweeper.sweep(dict((name, name) for name in names))
+        self.sweep_times.append(time.perf_counter() - start)
+        self.swept += len(names)
+        previous = self._roll_call.snapshot()
+        states = self._history.record(results)
+        self._roll_call.set_many(states)
+        outcomes = {}
+        for name in names:
+            changed = previous.get(name) != states[name]
+            outcomes[name] = (states[name], changed)
+            last_change = self._world.last_change(name)
+            if changed and last_change is not None and states[name] == self._world.present(name):
+                self.detection_latencies.append(self._clock() - last_change)
+        if any(changed for _, changed in outcomes.values()):
+            self._make_rulings()
+            self.decision_times.append(time.perf_counter() - start)
+        return outcomes
+
+    def _make_rulings(self):
+        roll_call, changed = self._roll_call.changes_since(self._roll_call_version)
+        self._roll_call_version = roll_call.version
+        start = time.perf_counter()
+        fired = self._rules.evaluate(RuleContext(roll_call, now=self._clock.wall_time(), history=self._history),
+                                     changed)
+        self.ruling_times.append(time.perf_counter() - start)
+        self.events.extend((round(self._clock(), 3), event) for event in fired)
+        return
+
+    def run(self, duration):
+        """
+        run until the virtual clock reaches duration, jumping straight from one deadline to the next
+        """
+        tasks = [self._poll, self._rulings]
+        while True:
+            task = min(tasks, key=lambda this_task: this_task.next_deadline())
+            deadline = task.next_deadline()
+            if deadline > duration:
+                break
+            self._clock.advance_to(deadline)
+            task.check()
+        self._sweeper.shutdown()
+        return
+
+    def digest(self):
+        """
+        :return: a fingerprint of every event fired and when - equal for equal seeds
+        """
+        return hashlib.sha1(json.dumps(self.events).encode("utf-8")).hexdigest()[:12]
+
+
+# =============================================================================
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def benchmark(copies, hours, seed, manifest_filename="manifest.json", rules_filename="rules.json",
+              trace_filename=None, polling_intervals=None):
+    registry = metrics.enable()
+    with open(manifest_filename, "r") as the_file:
+        manifest = json.load(the_file)
+    with open(rules_filename, "r") as the_file:
+        rule_entries = json.load(the_file)
+    device_types, entries = synthetic_setup(manifest, rule_entries, copies)
+    clock = VirtualClock()
+    duration = hours * 3600.0
+    if trace_filename is not None:
+        with open(trace_filename, "r") as the_file:
+            world = World([tuple(change) for change in json.load(the_file)], clock)
+    else:
+        world = World.random(sorted(device_types), duration, random.Random(seed), clock)
+    simulation = Simulation(device_types, entries, world, clock, polling_intervals)
+    start = time.perf_counter()
+    simulation.run(duration)
+    elapsed = time.perf_counter() - start
+    evaluations = registry.counter("rule_evaluations_total").value
+    ruling_time = sum(simulation.ruling_times)
+    print("%d devices, %d rules, %d scripted changes, %3.1f virtual hours in %4.2f sec (%d times real time)" % (
+        len(device_types), len(entries), len(world.script), hours, elapsed, duration / elapsed))
+    print("sweeps: %d, %3.1f devices each, mean %5.2f ms, p95 %5.2f ms" % (
+        len(simulation.sweep_times), simulation.swept / float(max(1, len(simulation.sweep_times))),
+        1000 * sum(simulation.sweep_times) / max(1, len(simulation.sweep_times)),
+        1000 * _percentile(simulation.sweep_times, 0.95)))
+    print("rules: %d evaluations in %d passes, %d evaluations/sec" % (
+        evaluations, len(simulation.ruling_times), evaluations / ruling_time if ruling_time else 0))
+    print("detection latency (virtual): mean %4.1f sec, p95 %4.1f sec over %d changes" % (
+        sum(simulation.detection_latencies) / max(1, len(simulation.detection_latencies)),
+        _percentile(simulation.detection_latencies, 0.95), len(simulation.detection_latencies)))
+    print("decision time (sweep to rulings, real): p50 %5.2f ms, p95 %5.2f ms" % (
+        1000 * _percentile(simulation.decision_times, 0.5), 1000 * _percentile(simulation.decision_times, 0.95)))
+    print("%d events fired, digest %s" % (len(simulation.events), simulation.digest()))
+    return simulation
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Homer simulation benchmark.")
+    parser.add_argument("-c", "--copies", help="clones of the rules.json devices and rules", type=int, default=1000)
+    parser.add_argument("-H", "--hours", help="virtual hours to simulate", type=float, default=2.0)
+    parser.add_argument("-s", "--seed", help="random seed", type=int, default=1)
+    parser.add_argument("-t", "--trace", help="JSON list of [time, device, present] changes to replay")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print("Simulation start")
+    args = arg_parser()
+    benchmark(args.copies, args.hours, args.seed, trace_filename=args.trace,
+              polling_intervals={"mobile": {"min": 5, "max": 60, "absent_max": 15}})
+    print("Simulation end")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Snapshot module - persists homer's state across restarts
+
+Each part of homer that has state worth keeping registers an export and a restore function.  The snapshot is
+written as compact JSON, atomically (write, fsync, rename), and only when its content has changed - and then at
+most once per period - to spare the SD card.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import json
+import os
+import time
+
+
+# snapshots older than this (seconds) are ignored at startup
+DEFAULT_MAX_AGE = 3600.0
+
+
+# =============================================================================
+
+
+def write_atomically(filename, data):
+    """
+    replace filename with data, so a crash or power cut leaves either the old file or the new one
+    """
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as the_file:
+        the_file.write(data)
+        the_file.flush()
+        os.fsync(the_file.fileno())
+    os.rename(temp_filename, filename)
+    return
+
+
+# =============================================================================
+
+
+class Snapshotter(object):
+    def __init__(self, filename, notifier=None, clock=time.time):
+        self._filename = filename
+        self._notifier = notifier
+        self._clock = clock
+        self._parts = {}
+        self._last_content = None
+        self.writes = 0
+        return
+
+    def add(self, name, export, restore):
+        """
+        :param export: returns the part's state, as something JSON can represent
+        :param restore: called with that state, and how old (in seconds) the snapshot is
+        """
+        self._parts[name] = (export, restore)
+        return
+
+    def _content(self):
+        # serialised, so later changes to the exported objects can't alter what we compare against
+        return json.dumps(dict((name, export()) for name, (export, _) in self._parts.items()), separators=(",", ":"),
+                          sort_keys=True)
+
+    def restore(self, max_age=DEFAULT_MAX_AGE):
+        """
+        :return: True if a snapshot was restored
+        """
+        try:
+            with open(self._filename, "rb") as the_file:
+                snapshot = json.loads(the_file.read().decode("utf-8"))
+            age = self._clock() - snapshot["saved_at"]
+            content = snapshot["content"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+        if not 0 <= age <= max_age:
+            if self._notifier is not None:
+                self._notifier.note("ignoring %s: %d seconds old", self._filename, age)
+            return False
+        for name, (_, restore) in self._parts.items():
+            if name in content:
+                try:
+                    restore(content[name], age)
+                except (ValueError, KeyError, TypeError) as e:
+                    if self._notifier is not None:
+                        self._notifier.warning("can't restore %s from %s: %s", name, self._filename, str(e))
+        if self._notifier is not None:
+            self._notifier.note("restored %s (%d seconds old)", self._filename, age)
+        return True
+
+    def save(self, force=False):
+        """
+        write the snapshot, unless nothing has changed since the last one
+
+        :return: True if it was written
+        """
+        content = self._content()
+        if content == self._last_content and not force:
+            return False
+        data = '{"saved_at":%r,"content":%s}' % (self._clock(), content)
+        try:
+            write_atomically(self._filename, data.encode("utf-8"))
+        except (IOError, OSError) as e:
+            if self._notifier is not None:
+                self._notifier.error("can't write %s: %s", self._filename, str(e))
+            return False
+        self._last_content = content
+        self.writes += 1
+        return True
+
+    def check(self):
+        self.save()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Snapshot start")
+    import tempfile
+    the_filename = os.path.join(tempfile.mkdtemp(), "snapshot.json")
+    roll_call = dict(("device%d" % idx, False) for idx in range(100))
+    snapshotter = Snapshotter(the_filename)
+    snapshotter.add("roll_call", lambda: roll_call, lambda saved, age: roll_call.update(saved))
+    start = time.time()
+    for tick in range(1000):
+        if tick % 100 == 0:
+            roll_call["device%d" % (tick // 100)] = True
+        snapshotter.save()
+    print("1000 saves requested, %d written, %4.2f sec" % (snapshotter.writes, time.time() - start))
+    roll_call = {}
+    restorer = Snapshotter(the_filename)
+    restorer.add("roll_call", lambda: roll_call, lambda saved, age: roll_call.update(saved))
+    restorer.restore()
+    print("restored %d devices, %d present, from %d bytes" % (
+        len(roll_call), sum(roll_call.values()), os.path.getsize(the_filename)))
+    print("Snapshot end")
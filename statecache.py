@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+State Cache module - device state with a time-to-live
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import threading
+import time
+
+
+DEFAULT_TTL = 30.0
+
+
+# =============================================================================
+
+
+class _Flight(object):
+    """
+    one in-progress device query that concurrent lookups share
+    """
+
+    __slots__ = ("event", "value", "error", "generation")
+
+    def __init__(self, generation):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.generation = generation
+        return
+
+
+# =============================================================================
+
+
+class StateCache(object):
+    """
+    Caches device state for ttl seconds.
+
+    Concurrent lookups of the same stale key are merged into a single query.  A put (after the device was commanded)
+    replaces the cached state straight away, and any query already in flight for that key is not allowed to
+    overwrite it.  An optional background thread refreshes entries before they expire.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._loaders = {}
+        self._generations = {}
+        self._in_flight = {}
+        self._refresher = None
+        self._stop = threading.Event()
+        return
+
+    def get(self, key, loader):
+        """
+        :param loader: queries the device when the cached state is missing or stale
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self._clock() - entry[1]) < self.ttl:
+                return entry[0]
+            self._loaders[key] = loader
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight(self._generations.get(key, 0))
+                self._in_flight[key] = flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        return self._load(key, loader, flight)
+
+    def _load(self, key, loader, flight):
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and self._generations.get(key, 0) == flight.generation:
+                    self._entries[key] = (flight.value, self._clock())
+                del self._in_flight[key]
+            flight.event.set()
+        return flight.value
+
+    def put(self, key, value):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries[key] = (value, self._clock())
+        return
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+        return
+
+    def refresh(self, margin):
+        """
+        re-query every entry due to expire within margin seconds - entries that were only ever put (or restored)
+        have no loader to re-query with, and are left to expire
+        """
+        with self._lock:
+            time_now = self._clock()
+            flights = []
+            for key, entry in self._entries.items():
+                loader = self._loaders.get(key)
+                if loader is None or key in self._in_flight or (time_now - entry[1]) < (self.ttl - margin):
+                    continue
+                # only registered as in flight once there's a loader to complete it, or get() would wait forever
+                flight = _Flight(self._generations.get(key, 0))
+                self._in_flight[key] = flight
+                flights.append((key, loader, flight))
+        for key, loader, flight in flights:
+            try:
+                self._load(key, loader, flight)
+            except Exception:
+                pass
+        return
+
+    def export(self):
+        """
+        :return: dictionary of key -> cached state, for entries still within their ttl
+        """
+        with self._lock:
+            time_now = self._clock()
+            return dict((key, entry[0]) for key, entry in self._entries.items() if (time_now - entry[1]) < self.ttl)
+
+    def restore(self, saved, age):
+        """
+        :param saved: from export
+        :param age: seconds since saved was exported - entries are only trusted for what's left of their ttl
+        """
+        with self._lock:
+            for key, value in saved.items():
+                if key not in self._entries:
+                    self._entries[key] = (value, self._clock() - age)
+        return
+
+    def start_refresher(self, period):
+        """
+        refresh entries from a background thread every period seconds, ahead of their expiry
+        """
+        def refresher():
+            while not self._stop.wait(period):
+                self.refresh(period)
+            return
+        self._refresher = threading.Thread(target=refresher, name="state_refresher")
+        self._refresher.daemon = True
+        self._refresher.start()
+        return
+
+    def stop(self):
+        self._stop.set()
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("StateCache start")
+    queries = []
+
+    def slow_query():
+        queries.append(1)
+        time.sleep(0.2)
+        return True
+
+    cache = StateCache(ttl=1.0)
+    threads = [threading.Thread(target=cache.get, args=("lamp", slow_query)) for _ in range(10)]
+    start = time.time()
+    for this_thread in threads:
+        this_thread.start()
+    for this_thread in threads:
+        this_thread.join()
+    print("10 concurrent lookups: %d device queries, %4.2f sec" % (len(queries), time.time() - start))
+    start = time.time()
+    for _ in range(100000):
+        cache.get("lamp", slow_query)
+    print("100000 cached lookups: %4.2f sec, %d device queries" % (time.time() - start, len(queries)))
+    cache.put("lamp", False)
+    print("after put: %s" % cache.get("lamp", slow_query))
+    print("StateCache end")
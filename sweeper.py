@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Sweeper module - concurrent presence sweeps
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import metrics
+
+
+# allowance for thread scheduling on top of the probe's own timeout
+SWEEP_GRACE = 0.5
+
+
+# =============================================================================
+
+
+class Sweeper(object):
+    """
+    Runs a probe against many addresses at once, with a cap on in-flight probes
+    """
+
+    def __init__(self, probe=None, max_in_flight=16, probe_timeout=2.0, notifier=None):
+        self._probe = probe
+        self._max_in_flight = max_in_flight
+        self._probe_timeout = probe_timeout
+        self._notifier = notifier
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._duration_metric = metrics.REGISTRY.histogram("sweep_duration_seconds", "time taken by each sweep")
+        self._targets_metric = metrics.REGISTRY.gauge("sweep_targets", "devices in the last sweep")
+        self._timeouts_metric = metrics.REGISTRY.counter("sweep_timeouts_total", "probes abandoned at the deadline")
+        return
+
+    def _run_probe(self, probe, address):
+        try:
+            return bool(probe(address, self._probe_timeout))
+        except Exception as e:
+            if self._notifier is not None:
+                self._notifier.warning("probe of %s failed: %s", address, str(e))
+            return False
+
+    def sweep(self, targets, probes=None, budget=None):
+        """
+        probe every target concurrently
+
+        :param targets: dictionary of name -> address
+        :param probes: optional dictionary of name -> probe, overriding the sweeper's own probe
+        :param budget: optional seconds the whole sweep may take, in place of the sweeper's own allowance
+        :return: dictionary of name -> found - probes not done by the deadline count as not found
+        """
+        start = time.monotonic()
+        futures = {}
+        for name, address in targets.items():
+            probe = probes[name] if probes is not None else self._probe
+            futures[name] = self._pool.submit(self._run_probe, probe, address)
+        # probes queued behind a full pool start late, so allow one timeout per "wave"
+        waves = max(1, -(-len(futures) // self._max_in_flight))
+        deadline = time.monotonic() + (budget if budget is not None else (waves * self._probe_timeout) + SWEEP_GRACE)
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                # one still queued behind the pool is dropped, so it can't hold up the next sweep
+                future.cancel()
+                if self._notifier is not None:
+                    self._notifier.warning("probe of %s timed out", name)
+                self._timeouts_metric.inc()
+                results[name] = False
+        self._duration_metric.observe(time.monotonic() - start)
+        self._targets_metric.set(len(targets))
+        return results
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+        return
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Sweeper start")
+
+    def fake_probe(address, timeout):
+        delay = random.uniform(0, timeout)
+        time.sleep(delay)
+        return delay < (timeout / 2)
+
+    the_targets = dict(("device%d" % idx, "192.168.1.%d" % idx) for idx in range(50))
+    sweeper = Sweeper(fake_probe, max_in_flight=50, probe_timeout=1.0)
+    start = time.time()
+    found = sweeper.sweep(the_targets)
+    print("swept %d devices in %5.2f sec, %d found" % (len(found), time.time() - start, sum(found.values())))
+    sweeper.shutdown()
+    print("Sweeper end")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Watcher module - notices when files change on disk
+
+Polls each file's mtime, size and inode, which is cheap enough to do every few seconds and works on any filesystem
+(including editors that save by renaming a new file over the old one).
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import os
+import sys
+import time
+
+
+# =============================================================================
+
+
+class FileWatcher(object):
+    def __init__(self, filenames):
+        self._signatures = dict((filename, self._signature(filename)) for filename in filenames)
+        return
+
+    @staticmethod
+    def _signature(filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def changed(self):
+        """
+        :return: the files that have changed since the last call
+        """
+        changed = []
+        for filename, signature in self._signatures.items():
+            latest = self._signature(filename)
+            if latest != signature:
+                self._signatures[filename] = latest
+                changed.append(filename)
+        return changed
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print("Watcher start")
+    watcher = FileWatcher(sys.argv[1:])
+    try:
+        while True:
+            for the_filename in watcher.changed():
+                print("%s changed" % the_filename)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    print("Watcher end")